@@ -33,7 +33,12 @@ try:
     import uuid
 
     from vault.helpers import constants
+    from vault.helpers import jobs
+    from vault.helpers import kdf
     from vault.helpers import legacy_load
+    from vault.helpers import search
+    from vault.helpers import ssh
+    from vault.helpers import steganography
     from vault.vault import Vault
     from vault.vault import VaultError
     from vault.widgets import widgets
@@ -59,6 +64,8 @@ class GUI:
         self.file_config = {}
         self.last_update = False
         self.file_lock = threading.Lock()
+        # Slow operations run as jobs, one at a time.
+        self.jobs = jobs.JobRunner()
 
         top = tkinter.Frame(master)
         top.pack(side='top', fill=tkinter.X)
@@ -79,6 +86,7 @@ class GUI:
                                       textvariable=self.password)
 
         password.bind('<Return>', self.on_return_key)
+        master.bind('<Escape>', self.cancel_job)
         # Activity sensor.
         timer = widgets.Timer(self.master, self.lock, 5000*60, True)
         master.bind_all('<Enter>', timer.reset)
@@ -98,6 +106,12 @@ class GUI:
                                     state=tkinter.DISABLED)
         add_pass = tkinter.Button(
             bottom, command=self.add_password, text='Add Password')
+        self.search = tkinter.StringVar()
+        self.search.trace(
+            'w', lambda *args: self.passbox.filter(self.search.get()))
+        search_entry = widgets.LabelEntry(bottom,
+                                          label='Search',
+                                          textvariable=self.search)
         edit_profiles = widgets.Box(
             top, 'Button', command=self.edit_profiles, text='Edit Profiles')
 
@@ -131,8 +145,11 @@ class GUI:
             label='Load encrypted',
             command=lambda *args, **kwargs: self.ask_for_file('load'))
         filemenu.add_command(
-            label='Force lock',
-            command=self.force_lock)
+            label='Break stale lock',
+            command=self.break_lock)
+        filemenu.add_command(
+            label='Calibrate key derivation',
+            command=self.calibrate_kdf)
         helpmenu.add_command(
             label='About',
             command=lambda: widgets.About(self.master, 'About'))
@@ -148,9 +165,11 @@ class GUI:
         edit_profiles.pack(side='left', fill=tkinter.Y)
         self.profile_selector.pack(side='right', fill=tkinter.Y)
         file_location.pack(side='right', fill=tkinter.Y)
+        search_entry.pack(side='left')
         add_pass.pack()
         self.onstart()
         password.focus_set()
+        self.poll_jobs()
         self.startup_ok = True
 
     def onclose(self):
@@ -175,6 +194,8 @@ class GUI:
         except Exception as err:
             print(err)
         finally:
+            self.jobs.shutdown()
+            ssh.POOL.close_all()
             self.master.destroy()
 
     def onstart(self):
@@ -241,6 +262,8 @@ class GUI:
 
     def change_profile(self, key):
         """Change profile when profile selector is changed."""
+        if self.busy():
+            return
         # Save old config.
         self.save_profile(self.profile.get())
         self.lock()
@@ -358,97 +381,201 @@ class GUI:
             return
         return True
 
+    def poll_jobs(self):
+        """Hand progress and results of jobs to the gui, from its thread."""
+        try:
+            self.jobs.poll()
+        finally:
+            # A failing callback must not stop later ones from coming.
+            self.master.after(jobs.POLL_INTERVAL, self.poll_jobs)
+
+    def busy(self, quiet=False):
+        """True if a job is running, shown in status bar unless quiet."""
+        job = self.jobs.busy
+        if job and not quiet:
+            self.status.set(f'Busy: {job.name}, Esc to cancel', color='red')
+        return bool(job)
+
+    def run(self, name, work, on_done):
+        """Run work(job) in the background, on_done(job, result) when done."""
+        return self.jobs.submit(work,
+                                name=name,
+                                on_progress=self.on_progress,
+                                on_done=on_done,
+                                on_error=self.on_job_error)
+
+    def on_progress(self, job, phase):
+        self.status.set(f'{job.name}: {PHASES.get(phase, phase)}...'
+                        ' (Esc to cancel)')
+
+    def on_job_error(self, job, err):
+        if isinstance(err, jobs.Cancelled):
+            self.status.set(f'{job.name} cancelled', color='red')
+        elif isinstance(err, ssh.HostKeyError):
+            self.trust_host_key(err)
+        else:
+            self.status.set(err, color='red')
+
+    def trust_host_key(self, err):
+        """Ask if an unknown or changed host key is to be trusted."""
+        if tkinter.messagebox.askokcancel(err.title,
+                                          f'{err}\n Continue anyway?'):
+            ssh.add_host_key(err.hostname, err.key)
+            self.status.set('Host key saved, try again')
+        else:
+            self.status.set(err, color='red')
+
+    def cancel_job(self, *event):
+        """Cancel running jobs, they stop at their next phase."""
+        self.jobs.cancel_all()
+
+    def acquire_file_lock(self, job):
+        """Wait for file lock in a job, giving up if it is cancelled."""
+        job.progress('lock')
+        while not self.file_lock.acquire(timeout=0.2):
+            job.check()
+
     def remote_sync(self):
-        def sync_worker():
+        vault = self.vault
+        profile = self.profile.get()
+        password = self._password
+        params = self.get_params()
+
+        def sync_worker(job):
+            # Changes are made to a copy, the password box keeps reading
+            # the vault while the job runs.
             try:
-                params = self.get_params()
-                data = self.vault.check_remote(*params)
-                if data:
-                    self.vault.merge(self._password, data, *params)
-            except VaultError:
-                self.status.set('Version missmatch in remote sync.')
-                return
+                return vault.synced_copy(password, *params)
             finally:
                 self.file_lock.release()
+
+        def done(job, result):
+            if not result or self.vault is not vault:
+                return
+            synced, merged = result
+            self.vault = self.vaults[profile] = synced
+            # Sync goes on after lock, the list is empty while locked.
+            if merged and not synced.locked:
+                self.passbox.reload(synced)
+
+        def on_error(job, err):
+            if isinstance(err, VaultError):
+                self.status.set('Version missmatch in remote sync.')
+            else:
+                self.on_job_error(job, err)
         if (self.file_config.get('sync') and
-                self.vault and self.file_lock.acquire(timeout=1)):
-            threading.Thread(target=sync_worker).start()
+                self.vault and
+                not self.busy(quiet=True) and
+                self.file_lock.acquire(blocking=False)):
+            self.jobs.submit(sync_worker, name='Sync', on_done=done,
+                             on_error=on_error)
 
     def get_params(self, path=None):
         ssh_params = None
         if not path:
             path = self.file_config.get('file_location', '')
             ssh_params = (self.file_location.get() == 'Remote' and
-                          self.ssh_config)
+                          ssh.replicas(self.ssh_config))
         original_file_path = (self.file_config.get('use_steganography') and
                               self.file_config.get('original_file'))
         return path, ssh_params, original_file_path
 
+    def get_quorum(self):
+        """Replicas that have to acknowledge a save, None for majority."""
+        quorum = str(self.ssh_config.get('quorum') or '').strip()
+        return int(quorum) if quorum.isdigit() else None
+
+    def get_stego_mode(self):
+        """Steganography density to save with."""
+        return (self.file_config.get('stego_mode') or
+                steganography.DEFAULT_MODE)
+
     def load(self, path=None):
         """Get and unlock passwords from vault."""
         # If we have loaded a local backup we don't
         # want to push to the server.
         update = not path
-        if not self.verify():
+        if self.busy() or not self.verify():
             return
         get_lock = self.file_location.get() == 'Remote'
-        if get_lock:
-            self.status.set('Acquiring file lock')
-            self.file_lock.acquire()
-        try:
-            path, ssh_params, original_file_path = self.get_params(path)
-            if not path:
-                self.status.set('No path to load', color='red')
-                return
-            msg = f'Loading passwords from {path}, this may take a while...'
-            self.status.set(msg)
+        path, ssh_params, original_file_path = self.get_params(path)
+        if not path:
+            self.status.set('No path to load', color='red')
+            return
+        profile = self.profile.get()
+        use_journal = self.file_config.get('use_journal', True)
+        stego_mode = self.get_stego_mode()
+        quorum = self.get_quorum()
+
+        def work(job):
+            if get_lock:
+                self.acquire_file_lock(job)
             try:
-                self.vault = Vault(
-                    path, ssh_params, original_file_path, update=update)
-                self.vaults[self.profile.get()] = self.vault
-            except Exception as err:
-                self.status.set(err, color='red')
-                return
+                vault = Vault(path, ssh_params, original_file_path,
+                              update=update, use_journal=use_journal,
+                              progress=job.progress, quorum=quorum,
+                              stego_mode=stego_mode)
+            finally:
+                if get_lock:
+                    self.file_lock.release()
+            vault.progress = None
+            return vault
+
+        def done(job, vault):
+            self.vault = vault
+            self.vaults[profile] = vault
             self.status.set('Passwords successfully loaded')
             self.update_password_box()
-        finally:
-            if get_lock:
-                self.file_lock.release()
+        self.status.set(f'Loading passwords from {path}')
+        self.run('Load', work, done)
 
     def save(self, path=None):
         """Lock and save vault in to file."""
+        if self.busy() or not self.verify():
+            return
+        if not self.vault:
+            self.vault = Vault()
+        vault = self.vault
+        vault.use_journal = self.file_config.get('use_journal', True)
+        vault.quorum = self.get_quorum()
+        vault.stego_mode = self.get_stego_mode()
+        # Cannot do self.vault.update = not path here due
+        # to that it's not all cases where it holds.
+        if not path:
+            vault.update = True
         get_lock = self.file_location.get() == 'Remote'
-        if get_lock:
-            self.status.set('Acquiring file lock')
-            self.file_lock.acquire()
-        try:
-            if not self.verify():
-                return
-            if not self.vault:
-                self.vault = Vault()
-            # Cannot do self.vault.update = not path here due
-            # to that it's not all cases where it holds.
-            if not path:
-                self.vault.update = True
-            path, ssh_params, original_file_path = self.get_params(path)
-            if not path:
-                self.status.set('Empty path, aborting', color='red')
-                return
-            self._password = self.password.get()
-            self.status.set(f'Saving passwords to {path} this may take '
-                            'a while...')
+        path, ssh_params, original_file_path = self.get_params(path)
+        if not path:
+            self.status.set('Empty path, aborting', color='red')
+            return
+        self._password = password = self.password.get()
+        vault.upsert(self.passbox.pop_changes())
+        vault.remove_deleted()
+        # Rows are positions in records, these moved.
+        self.passbox.reload(vault)
 
-            objects = self.passbox.get_objects()
-            self.vault.set_objects(objects)
-            self.vault.remove_deleted()
-            self.vault.lock(self._password)
-            self.vault.save(path, ssh_params, original_file_path)
-            self.vault.unlock(self._password)
+        def work(job):
+            if get_lock:
+                self.acquire_file_lock(job)
+            try:
+                vault.progress = job.progress
+                vault.lock(password)
+                try:
+                    vault.save(path, ssh_params, original_file_path)
+                finally:
+                    # Not cancellable, vault has to be unlocked again.
+                    vault.progress = None
+                    vault.unlock(password)
+            finally:
+                vault.progress = None
+                if get_lock:
+                    self.file_lock.release()
+
+        def done(job, result):
             self.passbox.dirty.set(False)
             self.status.set('Passwords saved')
-        finally:
-            if get_lock:
-                self.file_lock.release()
+        self.status.set(f'Saving passwords to {path}')
+        self.run('Save', work, done)
 
     def save_clear(self, file_path):
         """Make a dump of all password as a clear text file."""
@@ -474,27 +601,44 @@ class GUI:
             self.update_password_box()
 
     def update_password_box(self):
-        """Load passwords in to GUI."""
-        self.status.set('Updating password box')
+        """Unlock vault in the background and load passwords in to GUI."""
+        if self.busy():
+            return
         self.passbox.clear()
-        self._password = self.password.get()
-        if self.vault.update_version(self._password):
-            self.status.set('Saving updated file format to server')
-            if not self.vault.locked:
-                self.vault.lock(self._password)
-            self.vault.save(*self.get_params())
-        if self.vault.locked:
-            self.status.set('Unlocking vault')
-            if not self.vault.unlock(self._password):
+        self._password = password = self.password.get()
+        vault = self.vault
+        params = self.get_params()
+
+        def work(job):
+            vault.progress = job.progress
+            try:
+                if vault.update_version(password):
+                    # Saving updated file format to server.
+                    if not vault.locked:
+                        vault.lock(password)
+                    vault.save(*params)
+                if vault.locked:
+                    return bool(vault.unlock(password))
+                return True
+            finally:
+                vault.progress = None
+
+        def done(job, unlocked):
+            if not unlocked:
                 self.status.set("Failed to unlock, is password correct?")
                 return
             self.lock_btn.config(text='Lock')
             self.lock_btn.config(state=tkinter.NORMAL)
-
-        for password in sorted(self.vault.get_objects(), key=lambda obj: obj[2]):
-            self.passbox.add(password)
-        self.passbox.dirty.set(False)
-        self.status.set('Passwords updated')
+            self.status.set('Updating password box')
+            self.passbox.load(vault)
+            self.passbox.dirty.set(False)
+            if vault.offline:
+                self.status.set('Remote unreachable, showing cached copy',
+                                color='yellow')
+            else:
+                self.status.set('Passwords updated')
+        self.status.set('Unlocking vault')
+        self.run('Unlock', work, done)
 
     def setup_files(self):
         """Setup files through dialog."""
@@ -522,15 +666,65 @@ class GUI:
         if dirname:
             os.makedirs(dirname, exist_ok=True)
 
-    def force_lock(self):
-        self.vault.force_lock(self.get_params()[1])
+    def break_lock(self):
+        """Break remote locks whose holder has stopped sending heartbeats."""
+        ssh_params = self.get_params()[1]
+        if not ssh_params:
+            self.status.set('Only remote files are locked', color='red')
+            return
+        try:
+            holders = [holder for params in ssh_params for
+                       holder in ssh.break_lock(params)]
+        except ssh.HostKeyError as err:
+            self.trust_host_key(err)
+            return
+        except Exception as err:
+            self.status.set(err, color='red')
+            return
+        if holders:
+            self.status.set(f'Broke lock held by {", ".join(holders)}')
+        else:
+            self.status.set('No stale locks')
+
+    def calibrate_kdf(self):
+        """Tune key derivation to this computer, used on next save."""
+        if self.busy():
+            return
+        if not self.vault or self.vault.locked:
+            self.status.set('Unlock vault first', color='red')
+            return
+        vault = self.vault
+
+        def work(job):
+            # Only times key derivations, vault is set on the Tk thread.
+            return kdf.calibrate()
+
+        def done(job, key_derivation):
+            if self.vault is not vault or vault.locked:
+                self.status.set('Vault changed, calibrate again',
+                                color='red')
+                return
+            vault.set_kdf(key_derivation)
+            self.passbox.dirty.set(True)
+            self.status.set(f'Key derivation set to {key_derivation}, '
+                            'save to apply')
+        self.status.set('Calibrating key derivation')
+        self.run('Calibrate', work, done)
 
     def lock(self):
         """Lock vault, and clear local password list."""
+        if self.busy():
+            # Vault is in use by a job, next lock timer will try again.
+            return
         self.status.set('Locking vault')
         if self.vault and not self.vault.locked:
             self.vault.lock(self._password)
             self.lock_btn.config(text='Unlock')
+        if self.vault:
+            self.vault.forget_key()
+        # No logged in connections or decoded images are kept while locked.
+        ssh.POOL.close_all()
+        steganography.CARRIERS.clear()
         self.password.set('')
         self.passbox.clear()
         self.status.set('Vault locked')
@@ -549,29 +743,55 @@ class GUI:
         return bool(dirty)
 
 
+# Status bar text of job phases.
+PHASES = {'lock': 'Acquiring file lock',
+          'kdf': 'Deriving key',
+          'transfer': 'Transferring file',
+          'stego': 'Steganography',
+          'decode': 'Reading vault',
+          'decrypt': 'Decrypting passwords'}
+SEARCH_LIMIT = 50
+# Rows inserted per call when filling the list, between chunks the gui
+# handles its events so it does not freeze on large vaults.
+CHUNK_ROWS = 500
+# Above this many rows only the visible rows are given to the Treeview.
+VIRTUAL_ROWS = 5000
+
+
 class PasswordBox(tkinter.ttk.Treeview):
-    """Class to display password list."""
-    def __init__(self, master):
+    """
+    Class to display password list.
+    Passwords are kept sorted in Python (rows), the Treeview shows them all,
+    inserted in chunks, or in virtual mode only the rows in view.
+    virtual None picks virtual mode for lists longer than VIRTUAL_ROWS.
+    """
+    def __init__(self, master, virtual=None):
         self.columns = ('Uid', 'Date', 'System', 'User Name', 'Password', 'Notes', 'Delete')
         self.f = tkinter.Frame(master)
         self.pw = None
         self.timer = False
-        self.objects = {}
+        self.virtual = virtual
         super().__init__(self.f,
                          columns=self.columns,
                          displaycolumns=('System', 'User Name'),
                          show='headings')
         super().pack(fill=tkinter.BOTH, expand=1, side='left')
-        sb = tkinter.ttk.Scrollbar(
+        self.sb = tkinter.ttk.Scrollbar(
             self.f, orient="vertical", command=self.yview)
-        sb.pack(side='right', fill=tkinter.Y)
-        self.configure(yscrollcommand=sb.set)
+        self.sb.pack(side='right', fill=tkinter.Y)
+        self.configure(yscrollcommand=self.sb.set)
         for name in self.columns:
             self.heading(name, text=name)
         self.bind('<ButtonPress-1>', self.on_click)
         self.bind('<ButtonPress-3>', self.on_right_click)
+        self.bind('<MouseWheel>', self.on_wheel)
+        self.bind('<Button-4>', self.on_wheel)
+        self.bind('<Button-5>', self.on_wheel)
+        self.bind('<Configure>', lambda event: self.windowed and self._draw())
         self.dirty = tkinter.BooleanVar()
         self.dirty.set(False)
+        self._job = None
+        self.clear()
 
     def pack(self, *args, **kwargs):
         self.f.pack(*args, **kwargs)
@@ -584,11 +804,184 @@ class PasswordBox(tkinter.ttk.Treeview):
 
     def clear(self):
         """Remove all unlocked passwords from the list."""
-        children = self.get_children()
         self.dirty.set(False)
+        # Records of the vault shown, only edits are kept here.
+        self.records = None
+        self.changes = {}
+        # Search index over shown passwords, built on first search.
+        self.index = None
+        self.query = ''
+        # Passwords not deleted sorted on System, as positions in records
+        # or as uids (str) of edits. Values are read when rows are drawn.
+        self.rows = []
+        self._show(self.rows)
+
+    def load(self, vault):
+        """Show passwords of unlocked vault, sorted on System."""
+        self.clear()
+        # Lock and unlock replace the records, these stay readable.
+        self.records = records = vault.get_objects()
+        systems = [system.lower() for system in records.column('system')]
+        deleted = records.column('deleted')
+        self.rows = [index for index in
+                     sorted(range(len(records)), key=systems.__getitem__)
+                     if not deleted[index]]
+        self._show(self.rows)
+
+    def reload(self, vault):
+        """Show passwords of vault, keeping edits that are not saved."""
+        changes = self.changes
+        query = self.query
+        dirty = self.dirty.get()
+        self.load(vault)
+        for password in changes.values():
+            self.add(password)
+        self.dirty.set(dirty)
+        if query:
+            self.filter(query)
+
+    def _record(self, row):
+        """Password of row, an edit or a record in vault."""
+        if isinstance(row, str):
+            return self.changes[row]
+        return self.records[row]
+
+    def _position(self, key):
+        """Index in rows to insert System key at, after equal keys."""
+        low, high = 0, len(self.rows)
+        while low < high:
+            middle = (low + high) // 2
+            if key < self._record(self.rows[middle])[2].lower():
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _find(self, uid):
+        """Row of password with uid (bytes), None if not shown."""
+        key = str(uuid.UUID(bytes=uid))
+        if key in self.changes:
+            return None if self.changes[key][6] else key
+        if self.records is None:
+            return None
+        index = self.records.find(uid)
+        if index is None or self.records[index][6]:
+            return None
+        return index
+
+    def _insert(self, index, password):
+        # Uid as item id, so rows can be found when edited.
+        iid = str(password[0])
+        if self.exists(iid):
+            iid = None
+        self.insert('', index, iid=iid, values=password)
+
+    def _show(self, rows):
+        """Replace shown passwords with rows."""
+        if self._job:
+            self.after_cancel(self._job)
+            self._job = None
+        children = self.get_children()
         if children:
             self.delete(*children)
-        self.objects = {}
+        self.shown = rows
+        self.top = 0
+        if self.virtual is None:
+            self.windowed = len(rows) > VIRTUAL_ROWS
+        else:
+            self.windowed = self.virtual
+        if self.windowed:
+            # Scrollbar moves through rows, not through Treeview items.
+            self.sb.configure(command=self.on_scroll)
+            self.configure(yscrollcommand='')
+            self._draw()
+        else:
+            self.sb.configure(command=self.yview)
+            self.configure(yscrollcommand=self.sb.set)
+            self._fill(0)
+
+    def _fill(self, start, count=CHUNK_ROWS):
+        """Insert count shown rows from start and schedule the rest."""
+        end = start + count
+        for row in self.shown[start:end]:
+            self._insert('end', self._record(row))
+        self._filled = min(end, len(self.shown))
+        if end < len(self.shown):
+            self._job = self.after(1, self._fill, end)
+        else:
+            self._job = None
+
+    def _finish(self):
+        """Insert rows not yet filled in, so Treeview matches shown."""
+        if self._job:
+            self.after_cancel(self._job)
+            self._fill(self._filled, len(self.shown))
+
+    def _page(self):
+        """Number of rows that fit in view."""
+        height = self.winfo_height()
+        if height <= 1:
+            # Not drawn yet.
+            return int(self.cget('height'))
+        style = tkinter.ttk.Style(self)
+        row_height = int(style.lookup('Treeview', 'rowheight') or 20)
+        # One row for the headings.
+        return max(1, height // row_height - 1)
+
+    def _draw(self):
+        """Show the rows in view, reusing items already in Treeview."""
+        page = self._page()
+        self.top = max(0, min(self.top, len(self.shown) - page))
+        rows = [self._record(row) for row in
+                self.shown[self.top:self.top + page]]
+        children = self.get_children()
+        for iid, row in zip(children, rows):
+            self.item(iid, values=row)
+        if len(children) > len(rows):
+            self.delete(*children[len(rows):])
+        for row in rows[len(children):]:
+            self.insert('', 'end', values=row)
+        if self.shown:
+            self.sb.set(self.top / len(self.shown),
+                        (self.top + len(rows)) / len(self.shown))
+        else:
+            self.sb.set(0, 1)
+
+    def on_scroll(self, action, amount, unit=None):
+        """Scrollbar command in virtual mode."""
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.shown))
+        elif unit == 'pages':
+            self.top += int(amount) * self._page()
+        else:
+            self.top += int(amount)
+        self._draw()
+
+    def on_wheel(self, event):
+        """Scroll rows in virtual mode, Treeview scrolls itself otherwise."""
+        if not self.windowed:
+            return
+        if event.num == 4 or event.delta > 0:
+            self.top -= 3
+        else:
+            self.top += 3
+        self._draw()
+        return 'break'
+
+    def filter(self, query):
+        """Show only passwords matching query, best first, all if empty."""
+        self.query = query.strip()
+        if not self.query:
+            if self.shown is not self.rows:
+                self._show(self.rows)
+            return
+        if self.index is None:
+            self.index = search.SearchIndex(
+                self.records if self.records is not None else ())
+            self.index.extend(self.changes.values())
+        matches = [self._find(uid) for
+                   uid in self.index.search(self.query, SEARCH_LIMIT)]
+        self._show([row for row in matches if row is not None])
 
     def clear_clipboard(self):
         try:
@@ -618,18 +1011,44 @@ class PasswordBox(tkinter.ttk.Treeview):
             password = [uuid.uuid4(), datetime.datetime.utcnow(), *password]
         if len(password) == 6:
             password = [*password, False]
-        self.objects[str(password[0])] = password
+        uid = str(password[0])
+        self._finish()
+        self._discard(uid)
+        self.changes[uid] = password
+        if self.index is not None:
+            self.index.add(password)
         # If password is not deleted show it.
         if not password[6]:
             # Insert Alphabetically sorted on System.
-            for index, iid in enumerate(self.get_children()):
-                if self.set(iid, 'System').lower() > password[2].lower():
-                    self.insert('', index, values=password)
-                    break
+            index = self._position(password[2].lower())
+            self.rows.insert(index, uid)
+            if self.query:
+                self.filter(self.query)
+            elif self.windowed:
+                # Scroll so the new password is in view.
+                self.top = index - self._page() // 2
+                self._draw()
             else:
-                self.insert('', 'end', values=password)
+                self._insert(index, password)
+        elif self.query:
+            self.filter(self.query)
+        elif self.windowed:
+            self._draw()
         self.dirty.set(True)
 
+    def _discard(self, uid):
+        """Remove password with uid (str) from rows and Treeview."""
+        if uid in self.changes:
+            row = uid
+        elif self.records is not None:
+            row = self.records.find(uuid.UUID(uid).bytes)
+        else:
+            row = None
+        if row is not None and row in self.rows:
+            self.rows.remove(row)
+        if not self.windowed and self.exists(uid):
+            self.delete(uid)
+
     def edit(self, iid):
         """Edit password."""
         if not iid:
@@ -637,11 +1056,13 @@ class PasswordBox(tkinter.ttk.Treeview):
         values = self.item(iid, 'values')
         result = widgets.AddPassword(self.master, 'Password', values).result
         if result:
-            self.delete(iid)
             self.add(result)
 
-    def get_objects(self):
-        return [self.objects[key] for key in self.objects]
+    def pop_changes(self):
+        """Added and edited passwords, not yet in vault."""
+        changes = list(self.changes.values())
+        self.changes = {}
+        return changes
 
     def on_click(self, event):
         """Open Edit dialog on click."""
@@ -1,4 +1,4 @@
-VERSION = '1.1.1'
+VERSION = '1.7.0'
 VALID_PASSWORD_TYPES = ('alpha',
                         'alphanum',
                         'alphanumspecial',
@@ -7,6 +7,11 @@ VALID_PASSWORD_TYPES = ('alpha',
                         'mobilealphanumspecial',
                         'numerical')
 KEEP_DAYS = 30
+# Seconds a derived key is kept in memory.
+KEY_CACHE_TTL = 5*60
+# Journal is folded in to a new snapshot when bigger or older than this.
+JOURNAL_MAX_SIZE = 256*1024
+JOURNAL_MAX_DAYS = 7
 
 UUID = 0
 DATE = 1
@@ -0,0 +1,95 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Local copy of remote vault files, under the data dir.
+Vault files are encrypted so they are cached as they are on the remote.
+Entries are keyed by host, port, user and path. An entry is only used if
+size and sha256 match the remote file. Mtime is not enough, writes put
+the old times back (see StorageBackend.restore_times), so a remote that
+could not hash the file is always read. The content is checked against
+its stored hash before it is used, a damaged entry is a miss.
+'''
+import hashlib
+import json
+import os
+
+from . import constants
+
+CACHE_DIR = 'cache'
+
+
+def key(ssh_params, file_path):
+    '''Cache key of remote file.'''
+    return (ssh_params.get('host'),
+            int(ssh_params.get('port') or 22),
+            ssh_params.get('username'),
+            file_path)
+
+
+def _paths(cache_key):
+    name = hashlib.sha256(repr(cache_key).encode('utf-8')).hexdigest()
+    base = os.path.join(constants.data_dir(), CACHE_DIR, name)
+    return base + '.bin', base + '.json'
+
+
+def matches(meta, stat):
+    '''True if cached meta data is for file with stat.'''
+    if meta.get('size') != stat.st_size:
+        return False
+    digest = getattr(stat, 'sha256', None)
+    return bool(digest) and digest == meta.get('sha256')
+
+
+def get(cache_key, stat=None):
+    '''Cached content if it matches stat (any content if None), or None.'''
+    data_path, meta_path = _paths(cache_key)
+    try:
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        if stat is not None and not matches(meta, stat):
+            return
+        with open(data_path, 'rb') as fh:
+            data = fh.read()
+    except (OSError, ValueError):
+        return
+    if hashlib.sha256(data).hexdigest() != meta.get('sha256'):
+        return
+    return data
+
+
+def put(cache_key, data):
+    '''Store content of remote file.'''
+    data_path, meta_path = _paths(cache_key)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    meta = {'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest()}
+    # Meta data last, an entry is never used with content of another.
+    discard(cache_key)
+    for path, content, mode in ((data_path, data, 'wb'),
+                                (meta_path, json.dumps(meta), 'w')):
+        with open(path + '.tmp', mode) as fh:
+            fh.write(content)
+        os.replace(path + '.tmp', path)
+
+
+def discard(cache_key):
+    '''Remove cached file if there is one.'''
+    for path in _paths(cache_key)[::-1]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,194 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Binary codec for vault records.
+
+A record is (uid, date, system, user, password, notes, deleted) and is
+encoded as a fixed part followed by its strings
+
+    tag      1 byte, RECORD
+    uid      16 raw bytes
+    date     int64 microseconds since epoch
+    flags    1 byte, deleted and missing date
+    lengths  uint32 length in characters of system, user, password, notes
+    strings  utf-8 encoded, all four concatenated
+
+A list of records is a uint32 count, all fixed parts and then all strings,
+so the strings of the whole list are decoded in one go.
+Anything else (old record formats) is tagged LITERAL and stored as its
+repr, it is read back with ast.literal_eval. Nothing is ever unpickled.
+'''
+import ast
+import datetime
+import struct
+import uuid
+
+FIELDS = ('uid', 'date', 'system', 'user', 'password', 'notes', 'deleted')
+RECORD = 0
+LITERAL = 1
+EPOCH = datetime.datetime(1970, 1, 1)
+# Uid is packed as two uint64, faster to join than int.from_bytes.
+FIXED = struct.Struct('>BQQqBIIII')
+COUNT = struct.Struct('>I')
+DELETED_FLAG = 1
+NO_DATE_FLAG = 2
+_MICRO = datetime.timedelta(microseconds=1)
+
+
+class CodecError(Exception):
+    '''Record can not be encoded or data can not be decoded.'''
+    pass
+
+
+# UUID is immutable, set its slots directly like UUID.__setstate__ does,
+# this is several times faster than uuid.UUID(int=value).
+_set_int = uuid.UUID.__dict__['int'].__set__
+_set_is_safe = uuid.UUID.__dict__['is_safe'].__set__
+
+
+def new_uuid(value):
+    '''UUID from its int value, without the checks of uuid.UUID.'''
+    uid = object.__new__(uuid.UUID)
+    _set_int(uid, value)
+    _set_is_safe(uid, uuid.SafeUUID.unknown)
+    return uid
+
+
+def is_record(record):
+    '''True if record has the current record layout.'''
+    return (isinstance(record, (tuple, list)) and
+            len(record) == 7 and
+            isinstance(record[0], uuid.UUID) and
+            (isinstance(record[1], datetime.datetime) or not record[1]) and
+            all(isinstance(value, str) for value in record[2:6]))
+
+
+def _encode(record):
+    """Fixed part and strings of record."""
+    if not is_record(record):
+        text = repr(record)
+        try:
+            ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise CodecError(f'Record can not be encoded: {text}')
+        return FIXED.pack(LITERAL, 0, 0, 0, 0, len(text), 0, 0, 0), text
+    uid, date, system, user, password, notes, deleted = record
+    flags = DELETED_FLAG if deleted else 0
+    if date:
+        if date.tzinfo:
+            raise CodecError(f'Date has to be naive utc: {date}')
+        micros = (date - EPOCH) // _MICRO
+    else:
+        micros = 0
+        flags |= NO_DATE_FLAG
+    return (FIXED.pack(RECORD,
+                       uid.int >> 64,
+                       uid.int & 0xffffffffffffffff,
+                       micros,
+                       flags,
+                       len(system),
+                       len(user),
+                       len(password),
+                       len(notes)),
+            system + user + password + notes)
+
+
+def _decode(fixed, text):
+    """Decode fixed parts against text to list of records."""
+    records = []
+    append = records.append
+    new = object.__new__
+    set_int = _set_int
+    set_is_safe = _set_is_safe
+    unknown = uuid.SafeUUID.unknown
+    UUID = uuid.UUID
+    epoch = EPOCH
+    micro = _MICRO
+    position = 0
+    try:
+        for (tag, high, low, micros, flags,
+             len1, len2, len3, len4) in fixed:
+            if tag == RECORD:
+                uid = new(UUID)
+                set_int(uid, high << 64 | low)
+                set_is_safe(uid, unknown)
+                user = position + len1
+                password = user + len2
+                notes = password + len3
+                end = notes + len4
+                append((uid,
+                        '' if flags & NO_DATE_FLAG else epoch + micros * micro,
+                        text[position:user],
+                        text[user:password],
+                        text[password:notes],
+                        text[notes:end],
+                        flags & DELETED_FLAG == DELETED_FLAG))
+            elif tag == LITERAL:
+                end = position + len1
+                append(ast.literal_eval(text[position:end]))
+            else:
+                raise CodecError(f'Unknown record tag: {tag}')
+            position = end
+    except (ValueError, SyntaxError, OverflowError) as err:
+        raise CodecError(f'Broken record: {err}')
+    if position != len(text):
+        raise CodecError('Record lengths do not match data')
+    return records
+
+
+def _text(data, start):
+    try:
+        return bytes(data[start:]).decode('utf-8')
+    except UnicodeDecodeError as err:
+        raise CodecError(f'Broken record: {err}')
+
+
+def encode_record(record):
+    """Encode one record to bytes."""
+    fixed, text = _encode(record)
+    return fixed + text.encode('utf-8')
+
+
+def decode_record(data):
+    """Decode one record from bytes."""
+    try:
+        fixed = FIXED.unpack_from(data)
+    except struct.error:
+        raise CodecError('Truncated record')
+    return _decode((fixed,), _text(data, FIXED.size))[0]
+
+
+def encode_records(records):
+    """Encode a list of records to bytes."""
+    encoded = [_encode(record) for record in records]
+    return b''.join([COUNT.pack(len(encoded)),
+                     *[fixed for fixed, _ in encoded],
+                     ''.join([text for _, text in encoded]).encode('utf-8')])
+
+
+def decode_records(data):
+    """Decode bytes from encode_records to a list of records."""
+    data = memoryview(data)
+    try:
+        count, = COUNT.unpack_from(data)
+    except struct.error:
+        raise CodecError('Truncated record list')
+    end = COUNT.size + count * FIXED.size
+    if end > len(data):
+        raise CodecError('Truncated record list')
+    fixed = FIXED.iter_unpack(data[COUNT.size:end])
+    return _decode(fixed, _text(data, end))
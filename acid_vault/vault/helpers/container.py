@@ -0,0 +1,295 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Binary vault container, format 3.
+
+    prefix   magic, format version, flags, timestamp, vault version,
+             digest, committed length and header length
+    header   json with kdf, salt, wrapped data key, seal and snapshot time
+    frames   one per record: uid, length, AES-GCM nonce + ciphertext + tag
+    journal  optional entries appended after the frames: operation, uid,
+             length and payload, see helpers.journal
+
+The prefix has a fixed size and is in clear text, so freshness of a file
+can be checked with one short read, see read_probe.
+Frames are the records as encrypted by helpers.envelope, they are written
+and read in chunks so the whole file never has to be held in memory.
+
+Journal entries are appended in place and committed by rewriting the
+prefix afterwards. The digest is sha256 of the frames, chained over each
+committed journal entry, and the committed length tells where the last
+entry ends, so anything after it from an interrupted append is ignored.
+As the digest is chained, a reader that knows the digest and length of an
+earlier state can read only the entries appended since, see read_tail.
+Files that do not start with the magic are pickled (format 1 and 2).
+'''
+import base64
+import datetime
+import hashlib
+import io
+import json
+import struct
+
+from .envelope import digest
+from .legacy_load import safe_loads
+
+MAGIC = b'AVLT'
+FORMAT_VERSION = 3
+PREFIX = struct.Struct('>4sHHqHHH32sQI')
+FRAME = struct.Struct('>16sI')
+ENTRY = struct.Struct('>B16sI')
+CHUNK_SIZE = 64 * 1024
+EPOCH = datetime.datetime(1970, 1, 1)
+BINARY_KEYS = ('salt', 'dek', 'seal')
+# Kept in prefix or only in memory, not in header.
+NOT_IN_HEADER = ('vault', 'timestamp', 'version', 'digest', 'journal',
+                 'journal_size', 'length')
+
+
+class ContainerError(Exception):
+    '''Broken or unsupported container.'''
+    pass
+
+
+def to_micros(timestamp):
+    '''Naive utc datetime to microseconds since epoch.'''
+    if not timestamp:
+        return 0
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    if not micros:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def is_container(data):
+    '''True if locked vault data can be written as a container.'''
+    return 'dek' in data and 'seal' in data
+
+
+def _pack_prefix(timestamp, vault_version, frames_digest, length,
+                 header_length):
+    major, minor, patch = [int(x) for x in vault_version.split('.')]
+    return PREFIX.pack(MAGIC,
+                       FORMAT_VERSION,
+                       0,
+                       to_micros(timestamp),
+                       major,
+                       minor,
+                       patch,
+                       frames_digest,
+                       length,
+                       header_length)
+
+
+def write(fh, data):
+    '''
+    Write locked vault data to open file as a snapshot without journal.
+    Returns digest and length of written container.
+    '''
+    header = {key: value for key, value in data.items() if
+              key not in NOT_IN_HEADER}
+    for key in BINARY_KEYS:
+        header[key] = base64.b64encode(header[key]).decode('ascii')
+    header['count'] = len(data['vault'])
+    header['snapshot'] = to_micros(data.get('timestamp'))
+    header = json.dumps(header, sort_keys=True).encode('utf-8')
+    frames_digest = digest(data['vault'])
+    length = PREFIX.size + len(header) + sum(
+        [FRAME.size + len(ciphertext) for _, ciphertext in data['vault']])
+    fh.write(_pack_prefix(data.get('timestamp'),
+                          data['version'],
+                          frames_digest,
+                          length,
+                          len(header)))
+    fh.write(header)
+    chunk = bytearray()
+    for uid, ciphertext in data['vault']:
+        chunk += FRAME.pack(uid.rjust(16, b'\0'), len(ciphertext))
+        chunk += ciphertext
+        if len(chunk) >= CHUNK_SIZE:
+            fh.write(bytes(chunk))
+            chunk.clear()
+    if chunk:
+        fh.write(bytes(chunk))
+    return frames_digest, length
+
+
+def parse_probe(prefix):
+    '''
+    Parse prefix bytes to dict with timestamp, version, digest and length.
+    Returns None if prefix is not from a container.
+    '''
+    if len(prefix) < PREFIX.size or not prefix.startswith(MAGIC):
+        return None
+    (_, format_version, _, timestamp, major, minor, patch,
+     frames_digest, length, header_length) = PREFIX.unpack(
+         prefix[:PREFIX.size])
+    if format_version != FORMAT_VERSION:
+        raise ContainerError(f'Unsupported format: {format_version}')
+    return {'timestamp': from_micros(timestamp),
+            'version': f'{major}.{minor}.{patch}',
+            'digest': frames_digest,
+            'length': length,
+            'header_length': header_length}
+
+
+def read_probe(fh):
+    '''
+    Read only the fixed size prefix from open file.
+    Returns probe dict (None if not a container) and the bytes read.
+    '''
+    prefix = fh.read(PREFIX.size)
+    return parse_probe(prefix), prefix
+
+
+def _read_exact(fh, size):
+    data = fh.read(size)
+    if len(data) < size:
+        raise ContainerError('Truncated container')
+    return data
+
+
+def read_frames(fh, count):
+    '''Iterate (uid, ciphertext) frames from open file.'''
+    for _ in range(count):
+        uid, length = FRAME.unpack(_read_exact(fh, FRAME.size))
+        yield (uid.lstrip(b'\0') and uid), _read_exact(fh, length)
+
+
+def pack_entry(operation, uid, payload):
+    '''Journal entry as bytes.'''
+    fixed = ENTRY.pack(operation, uid.rjust(16, b'\0'), len(payload))
+    return fixed + payload
+
+
+def chain(frames_digest, entry):
+    '''Digest after entry has been committed.'''
+    return hashlib.sha256(frames_digest + entry).digest()
+
+
+def read_journal(fh, size):
+    '''Read size bytes of journal entries, returns entries and raw entries.'''
+    entries = []
+    raw = []
+    while size > 0:
+        fixed = _read_exact(fh, ENTRY.size)
+        operation, uid, length = ENTRY.unpack(fixed)
+        payload = _read_exact(fh, length)
+        entries.append((operation, uid.lstrip(b'\0') and uid, payload))
+        raw.append(fixed + payload)
+        size -= ENTRY.size + length
+    if size:
+        raise ContainerError('Journal does not end at committed length')
+    return entries, raw
+
+
+def read_tail(fh, probe, frames_digest, length):
+    '''
+    Journal entries appended to open file since it had frames_digest and
+    length, only the appended bytes are read.
+    Returns None if the file is not the same container with entries
+    appended, e.g. it has been rewritten as a new snapshot.
+    File position is left as it was, so the file can be read in full after.
+    '''
+    size = probe['length'] - length
+    if size <= 0:
+        return None
+    if hasattr(fh, 'read_range'):
+        data = fh.read_range(length, size)
+    else:
+        position = fh.tell()
+        fh.seek(length)
+        try:
+            data = fh.read(size)
+        finally:
+            fh.seek(position)
+    try:
+        entries, raw = read_journal(io.BytesIO(data), size)
+    except ContainerError:
+        return None
+    for entry in raw:
+        frames_digest = chain(frames_digest, entry)
+    if frames_digest != probe['digest']:
+        return None
+    return entries
+
+
+def read(fh, probe=None, prefix=b''):
+    '''
+    Read vault data from open file, container or pickled.
+    If read_probe already has been called pass its result.
+    '''
+    if not prefix:
+        probe, prefix = read_probe(fh)
+    if probe is None:
+        try:
+            return safe_loads(prefix + fh.read())
+        except Exception as err:
+            raise ContainerError(f'Not a vault file: {err}')
+    try:
+        raw_header = _read_exact(fh, probe['header_length'])
+        header = json.loads(raw_header.decode('utf-8'))
+        for key in BINARY_KEYS:
+            header[key] = base64.b64decode(header[key])
+    except (ValueError, KeyError) as err:
+        raise ContainerError(f'Broken header: {err}')
+    header['vault'] = list(read_frames(fh, header.pop('count')))
+    snapshot_length = PREFIX.size + len(raw_header) + sum(
+        [FRAME.size + len(ciphertext) for _, ciphertext in header['vault']])
+    journal_size = probe['length'] - snapshot_length
+    if journal_size < 0:
+        raise ContainerError('Truncated container')
+    header['journal'], raw = read_journal(fh, journal_size)
+    frames_digest = digest(header['vault'])
+    for entry in raw:
+        frames_digest = chain(frames_digest, entry)
+    if frames_digest != probe['digest']:
+        raise ContainerError('Content does not match digest')
+    header['timestamp'] = probe['timestamp']
+    header['version'] = probe['version']
+    header['digest'] = probe['digest']
+    header['length'] = probe['length']
+    header['journal_size'] = journal_size
+    return header
+
+
+def append(fh, probe, entries, timestamp, vault_version):
+    '''
+    Append journal entries to open file (opened r+b) and commit them.
+    probe is the prefix currently in file.
+    Returns new digest and length.
+    '''
+    frames_digest = probe['digest']
+    raw = [pack_entry(*entry) for entry in entries]
+    for entry in raw:
+        frames_digest = chain(frames_digest, entry)
+    data = b''.join(raw)
+    fh.seek(probe['length'])
+    fh.write(data)
+    fh.flush()
+    length = probe['length'] + len(data)
+    fh.seek(0)
+    # Rewriting the prefix is what commits the entries.
+    fh.write(_pack_prefix(timestamp,
+                          vault_version,
+                          frames_digest,
+                          length,
+                          probe['header_length']))
+    return frames_digest, length
@@ -0,0 +1,256 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Envelope encryption.
+Every record is encrypted on its own with a random data key, the data key
+is in turn encrypted (wrapped) with the key derived from the password.
+Records are only decrypted when accessed and only changed records are
+encrypted again when sealed.
+'''
+import hashlib
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from . import codec
+from .legacy_load import safe_loads
+from .store import EMPTY_FLAG, RecordStore, record_uid
+
+NONCE_SIZE = 12
+
+
+class EnvelopeError(Exception):
+    '''Record could not be decrypted.'''
+    pass
+
+
+def new_data_key():
+    '''Random key for record encryption.'''
+    return AESGCM.generate_key(bit_length=256)
+
+
+def wrap_key(key, data_key):
+    '''Encrypt data key with password derived (Fernet) key.'''
+    return Fernet(key).encrypt(data_key)
+
+
+def unwrap_key(key, wrapped):
+    '''Decrypt data key, raises cryptography.fernet.InvalidToken.'''
+    return Fernet(key).decrypt(wrapped)
+
+
+def encrypt_record(aead, record):
+    '''Encrypt record, uid is authenticated so records can't be swapped.'''
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + aead.encrypt(
+        nonce, codec.encode_record(record), record_uid(record))
+
+
+def decrypt_record(aead, uid, sealed):
+    try:
+        data = aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], uid)
+    except InvalidTag:
+        raise EnvelopeError(f'Record {uid.hex()} failed to decrypt')
+    if data[:1] == b'\x80':
+        # Pickled by a version before the record codec.
+        return safe_loads(data)
+    try:
+        return codec.decode_record(data)
+    except codec.CodecError as err:
+        raise EnvelopeError(f'Record {uid.hex()}: {err}')
+
+
+def digest(sealed):
+    '''Hash of sealed records, order and uids included.'''
+    sha = hashlib.sha256()
+    for uid, ciphertext in sealed:
+        sha.update(len(uid).to_bytes(1, 'big') + uid)
+        sha.update(len(ciphertext).to_bytes(4, 'big') + ciphertext)
+    return sha.digest()
+
+
+def make_seal(data_key, sealed):
+    '''
+    Authenticate the set of records, so records can not be dropped or
+    rolled back one at a time.
+    '''
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(data_key).encrypt(nonce, digest(sealed), b'seal')
+
+
+def verify_seal(data_key, sealed, seal):
+    try:
+        expected = AESGCM(data_key).decrypt(
+            seal[:NONCE_SIZE], seal[NONCE_SIZE:], b'seal')
+    except InvalidTag:
+        raise EnvelopeError('Seal failed to decrypt')
+    if expected != digest(sealed):
+        raise EnvelopeError('Records do not match seal')
+
+
+class SealedRecords(RecordStore):
+    '''
+    Record store backed by per record ciphertexts.
+    Sealed form is a list of (uid bytes, ciphertext) tuples.
+    '''
+    def __init__(self, data_key, sealed=()):
+        super().__init__()
+        self.data_key = data_key
+        self._aead = AESGCM(data_key)
+        self._sealed = []
+        for uid, ciphertext in sealed:
+            self._insert_row(len(self), self._empty_row(uid))
+            self._sealed.append(ciphertext)
+        # Uids at last seal, to know what has changed since.
+        self._base = list(self._uids)
+
+    @classmethod
+    def from_records(cls, data_key, records):
+        '''Create from clear records, all of them will be encrypted.'''
+        sealed_records = cls(data_key)
+        sealed_records.extend(records)
+        return sealed_records
+
+    def __reduce__(self):
+        # Pickling would write the data key in clear.
+        raise TypeError('SealedRecords has to be sealed before pickling')
+
+    def copy(self):
+        other = super().copy()
+        other._sealed = list(self._sealed)
+        other._base = list(self._base)
+        return other
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self._flags[index] & EMPTY_FLAG:
+            record = decrypt_record(
+                self._aead, self._uids[index], self._sealed[index])
+            self._set_row(index, self._row(record))
+        return self._record(index)
+
+    def __setitem__(self, index, record):
+        super().__setitem__(index, record)
+        self._sealed[index] = None
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        del self._sealed[index]
+
+    def delete(self, indices):
+        drop = set(indices)
+        self._sealed = [ciphertext for index, ciphertext in
+                        enumerate(self._sealed) if index not in drop]
+        super().delete(drop)
+
+    def __iter__(self):
+        self._decrypt_all()
+        return super().__iter__()
+
+    def column(self, name):
+        self._decrypt_all()
+        return super().column(name)
+
+    def _decrypt_all(self):
+        for index, flags in enumerate(self._flags):
+            if flags & EMPTY_FLAG:
+                self[index]
+
+    def insert(self, index, record):
+        super().insert(index, record)
+        self._sealed.insert(index, None)
+
+    def uid(self, index):
+        '''Uid bytes of record at index, without decrypting it.'''
+        return self._uids[index]
+
+    def sealed(self, index):
+        '''Ciphertext of record at index, None if changed since sealed.'''
+        return self._sealed[index]
+
+    def put_sealed(self, uid, ciphertext):
+        '''Set ciphertext of record with uid, appended if uid is new.'''
+        index = self.find(uid)
+        if index is None:
+            self._add_to_index(uid)
+            self._insert_row(len(self), self._empty_row(uid))
+            self._sealed.append(ciphertext)
+        else:
+            self._set_row(index, self._empty_row(uid))
+            self._sealed[index] = ciphertext
+        # Content is not known until decrypted.
+        self._search = None
+
+    def discard(self, uid):
+        '''Remove record with uid if it exists.'''
+        index = self.find(uid)
+        if index is not None:
+            del self[index]
+
+    def reorder(self, uids):
+        '''Put records in order of uids, which has to hold all uids.'''
+        position = {uid: index for index, uid in enumerate(self._uids)}
+        order = [position[uid] for uid in uids]
+        self._take(order)
+        self._sealed = [self._sealed[index] for index in order]
+        self._index = None
+
+    def base(self):
+        '''Uids as they were at last seal.'''
+        return list(self._base)
+
+    def rebase(self):
+        '''Make current uids the base that changes are counted from.'''
+        self._base = list(self._uids)
+
+    def changed(self):
+        '''Number of records that have to be encrypted on next seal.'''
+        return self._sealed.count(None)
+
+    def assign(self, records):
+        '''
+        Replace content with records, keeping ciphertexts of records
+        that are unchanged.
+        '''
+        rows, sealed = [], []
+        for record in records:
+            row = self._row(record)
+            index = self.find(row[0])
+            ciphertext = None
+            if index is not None and self._sealed[index] is not None:
+                if tuple(self[index]) == tuple(record):
+                    ciphertext = self._sealed[index]
+            rows.append(row)
+            sealed.append(ciphertext)
+        self._take([])
+        for row in rows:
+            self._insert_row(len(self), row)
+        self._sealed = sealed
+        self._index = None
+        self._search = None
+
+    def seal(self):
+        '''Encrypt changed records and return sealed form.'''
+        for index, ciphertext in enumerate(self._sealed):
+            if ciphertext is None:
+                self._sealed[index] = encrypt_record(
+                    self._aead, self._record(index))
+        self.rebase()
+        return list(zip(self._uids, self._sealed))
@@ -0,0 +1,217 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Timing of slow phases (key derivation, ssh, steganography, decoding).
+A span measures the wall time of a named phase and optionally how many
+bytes it handled. Finished spans are kept in a ring buffer and can be
+written as json lines.
+
+Tracing is off unless enable is called or the environment variable
+ACID_VAULT_TRACE is set, span then returns a shared no-op context.
+
+    ACID_VAULT_TRACE=1             keep spans in the ring buffer
+    ACID_VAULT_TRACE=trace.jsonl   also append each span to the file
+    ACID_VAULT_PROFILE=directory   cProfile outermost spans to directory
+'''
+import collections
+import cProfile
+import json
+import os
+import threading
+import time
+
+BUFFER_SIZE = 1000
+ENV_TRACE = 'ACID_VAULT_TRACE'
+ENV_PROFILE = 'ACID_VAULT_PROFILE'
+
+_enabled = False
+_path = None
+_profile_dir = None
+_buffer = collections.deque(maxlen=BUFFER_SIZE)
+_write_lock = threading.Lock()
+# Only one cProfile can be active at a time.
+_profile_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoSpan():
+    '''Returned by span when tracing is off.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add_bytes(self, count):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+class Span():
+    '''Timing of one phase, use as context manager.'''
+    __slots__ = ('name', 'fields', 'bytes', 'start', 'wall', 'depth',
+                 'parent', 'error', '_started', '_profiler')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.bytes = 0
+        self.wall = None
+        self.error = None
+        self._profiler = None
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+    def __enter__(self):
+        stack = _stack()
+        self.depth = len(stack)
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        if (_profile_dir and
+                not self.depth and
+                _profile_lock.acquire(blocking=False)):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.wall = time.perf_counter() - self._started
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(os.path.join(
+                _profile_dir, f'{self.name}-{int(self.start * 1000)}.prof'))
+            self._profiler = None
+            _profile_lock.release()
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type:
+            self.error = exc_type.__name__
+        _record(self)
+        return False
+
+    def to_dict(self):
+        return {'name': self.name,
+                'start': self.start,
+                'wall': self.wall,
+                'bytes': self.bytes,
+                'depth': self.depth,
+                'parent': self.parent,
+                'error': self.error,
+                'thread': threading.current_thread().name,
+                **self.fields}
+
+
+def _record(finished):
+    record = finished.to_dict()
+    _buffer.append(record)
+    if _path:
+        line = json.dumps(record, default=str) + '\n'
+        with _write_lock:
+            with open(_path, 'a') as fh:
+                fh.write(line)
+
+
+def span(name, **fields):
+    '''
+    Context manager timing phase name, fields are added to the record.
+    Callable fields are called when the span starts, only if tracing is on.
+    '''
+    if not _enabled:
+        return NO_SPAN
+    return Span(name, {key: value() if callable(value) else value for
+                       key, value in fields.items()})
+
+
+def enable(path=None, profile_dir=None, size=BUFFER_SIZE):
+    '''
+    Start recording spans, to path as json lines if given.
+    With profile_dir outermost spans are profiled with cProfile.
+    '''
+    global _enabled, _path, _profile_dir, _buffer
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    if size != _buffer.maxlen:
+        _buffer = collections.deque(_buffer, maxlen=size)
+    _path = path
+    _profile_dir = profile_dir
+    _enabled = True
+
+
+def disable():
+    '''Stop recording, recorded spans are kept.'''
+    global _enabled, _path, _profile_dir
+    _enabled = False
+    _path = None
+    _profile_dir = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def spans(name=None):
+    '''Recorded spans as dicts, oldest first, only name if given.'''
+    return [record for record in list(_buffer) if
+            name is None or record['name'] == name]
+
+
+def clear():
+    _buffer.clear()
+
+
+def export(fh):
+    '''Write recorded spans to open text file as json lines.'''
+    for record in spans():
+        print(json.dumps(record, default=str), file=fh)
+
+
+def summary():
+    '''Count, total wall time and bytes per span name.'''
+    result = {}
+    for record in spans():
+        count, wall, size = result.get(record['name'], (0, 0.0, 0))
+        result[record['name']] = (count + 1,
+                                  wall + record['wall'],
+                                  size + record['bytes'])
+    return result
+
+
+def _from_environment():
+    value = os.environ.get(ENV_TRACE)
+    if not value:
+        return
+    path = None if value.lower() in ('1', 'true', 'yes', 'on') else value
+    enable(path, os.environ.get(ENV_PROFILE))
+
+
+_from_environment()
@@ -0,0 +1,136 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Background jobs for slow vault operations.
+Jobs run in a thread pool, their progress and results are queued and only
+handed to callbacks by poll, so a gui can call poll from its own thread
+(with after) and never touch widgets from a worker.
+Cancelling is cooperative, a job stops the next time it reports progress.
+'''
+import concurrent.futures
+import queue
+import threading
+
+# Milliseconds between polls, for the gui.
+POLL_INTERVAL = 50
+
+
+class Cancelled(Exception):
+    '''Job was cancelled.'''
+    pass
+
+
+class Job():
+    '''Handle to a submitted job.'''
+    def __init__(self, name, events, on_progress, on_done, on_error):
+        self.name = name
+        self.phase = None
+        self.future = None
+        self._events = events
+        self._cancel = threading.Event()
+        # Set by poll, when the result has been handed over.
+        self._done = False
+        self._callbacks = {'progress': on_progress,
+                           'done': on_done,
+                           'error': on_error}
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        '''True once poll has handed over result or error.'''
+        return self._done
+
+    def cancel(self):
+        '''Ask job to stop, its on_error gets Cancelled.'''
+        self._cancel.set()
+
+    def check(self):
+        '''Raise Cancelled if job has been cancelled.'''
+        if self._cancel.is_set():
+            raise Cancelled(f'{self.name} cancelled')
+
+    def progress(self, phase):
+        '''Report phase from worker, raises Cancelled if cancelled.'''
+        self.check()
+        self.phase = phase
+        self._events.put((self, 'progress', phase))
+
+    def _run(self, func, args, kwargs):
+        try:
+            self.check()
+            result = func(self, *args, **kwargs)
+        except Exception as err:
+            self._events.put((self, 'error', err))
+        else:
+            self._events.put((self, 'done', result))
+
+
+class JobRunner():
+    '''Thread pool that queues job callbacks until poll.'''
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='vault-job')
+        self._events = queue.Queue()
+        self.jobs = []
+
+    @property
+    def busy(self):
+        '''First job not yet done, None if there is none.'''
+        self.jobs = [job for job in self.jobs if not job.done]
+        return self.jobs[0] if self.jobs else None
+
+    def submit(self, func, *args, name='job', on_progress=None,
+               on_done=None, on_error=None, **kwargs):
+        '''
+        Run func(job, *args, **kwargs) in a worker.
+        Callbacks are called by poll, on_progress(job, phase),
+        on_done(job, result) and on_error(job, exception).
+        Without on_error the exception is raised by poll.
+        '''
+        job = Job(name, self._events, on_progress, on_done, on_error)
+        self.jobs.append(job)
+        job.future = self._executor.submit(job._run, func, args, kwargs)
+        return job
+
+    def poll(self):
+        '''Call queued callbacks in the calling thread, returns how many.'''
+        count = 0
+        while True:
+            try:
+                job, kind, value = self._events.get_nowait()
+            except queue.Empty:
+                return count
+            count += 1
+            if kind != 'progress':
+                job._done = True
+            callback = job._callbacks[kind]
+            if callback:
+                callback(job, value)
+            elif kind == 'error':
+                raise value
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def shutdown(self, wait=False):
+        '''Cancel all jobs and stop the workers.'''
+        self.cancel_all()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,130 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Journal of record changes, appended to a container after its snapshot.
+
+    PUT     uid and ciphertext of an added or changed record
+    DELETE  uid of a removed record
+    SEAL    seal of all records after the entries before it
+
+Every batch of entries ends with a SEAL, so the records after a replay are
+authenticated the same way as a snapshot is.
+'''
+PUT = 0
+DELETE = 1
+SEAL = 2
+
+
+class JournalError(Exception):
+    '''Journal can not be replayed or written.'''
+    pass
+
+
+def can_journal(records):
+    '''True if all records have unique uids, needed to address them.'''
+    uids = [records.uid(index) for index in range(len(records))]
+    return all(uids) and len(set(uids)) == len(uids)
+
+
+def replay(records, entries):
+    '''
+    Apply entries to SealedRecords.
+    Returns the last seal, None if there were no entries.
+    '''
+    seal = None
+    for operation, uid, payload in entries:
+        if operation == PUT:
+            records.put_sealed(uid, payload)
+        elif operation == DELETE:
+            records.discard(uid)
+        elif operation == SEAL:
+            seal = payload
+        else:
+            raise JournalError(f'Unknown journal operation: {operation}')
+    if entries and entries[-1][0] != SEAL:
+        raise JournalError('Journal does not end with a seal')
+    records.rebase()
+    return seal
+
+
+def changes(records):
+    '''
+    Seal records and return entries for changes since they were last sealed.
+    Records are put in the order a replay of the entries gives, the caller
+    adds the SEAL entry for the new order.
+    '''
+    if not can_journal(records):
+        raise JournalError('Records without unique uids can not be journaled')
+    base = records.base()
+    changed = {records.uid(index) for index in range(len(records)) if
+               records.sealed(index) is None}
+    sealed = records.seal()
+    current = {uid for uid, _ in sealed}
+    entries = [(DELETE, uid, b'') for uid in base if uid not in current]
+    entries.extend([(PUT, uid, ciphertext) for uid, ciphertext in sealed
+                    if uid in changed])
+    kept = set(base)
+    records.reorder([uid for uid in base if uid in current] +
+                    [uid for uid, _ in sealed if uid not in kept])
+    records.rebase()
+    return entries
+
+
+def apply(sealed, entries):
+    '''
+    Apply entries to a sealed list, the same way replay does to records.
+    Returns the new sealed list and the last seal.
+    '''
+    uids = [uid for uid, _ in sealed]
+    if not all(uids) or len(set(uids)) != len(uids):
+        raise JournalError('Records without unique uids can not be journaled')
+    # Dicts keep insertion order, replaced values keep their position.
+    records = dict(sealed)
+    seal = None
+    for operation, uid, payload in entries:
+        if operation == PUT:
+            records[uid] = payload
+        elif operation == DELETE:
+            records.pop(uid, None)
+        elif operation == SEAL:
+            seal = payload
+        else:
+            raise JournalError(f'Unknown journal operation: {operation}')
+    if entries and entries[-1][0] != SEAL:
+        raise JournalError('Journal does not end with a seal')
+    return list(records.items()), seal
+
+
+def replay_order(base, uids):
+    '''Uids in the order a replay on base gives, kept ones first.'''
+    current = set(uids)
+    kept = [uid for uid in base if uid in current]
+    base = set(kept)
+    return kept + [uid for uid in uids if uid not in base]
+
+
+def diff(base, sealed):
+    '''
+    Entries that turn sealed list base in to sealed, which has to be in
+    replay order. The caller adds the SEAL entry.
+    '''
+    before = dict(base)
+    current = {uid for uid, _ in sealed}
+    entries = [(DELETE, uid, b'') for uid, _ in base if uid not in current]
+    entries.extend([(PUT, uid, ciphertext) for uid, ciphertext in sealed
+                    if before.get(uid) != ciphertext])
+    return entries
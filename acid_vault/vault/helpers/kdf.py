@@ -0,0 +1,182 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Key derivation functions.
+Each KDF knows its own parameters, can describe itself as a dict to be
+stored in the vault header and can calibrate itself against the host.
+'''
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf import scrypt
+
+DEFAULT_ITERATIONS = 1000000
+# Target time in seconds for one key derivation when calibrating.
+DEFAULT_TARGET = 0.3
+KEY_LENGTH = 32
+
+
+class KDFError(Exception):
+    '''Unknown KDF or bad KDF parameters.'''
+    pass
+
+
+class KDF():
+    '''Base class for key derivation functions.'''
+    name = None
+
+    def derive(self, password, salt):
+        '''Derive raw key bytes from password and salt.'''
+        raise NotImplementedError
+
+    @property
+    def params(self):
+        '''Parameters as a dict, without the name.'''
+        raise NotImplementedError
+
+    def to_dict(self):
+        '''Header representation of KDF.'''
+        return {'name': self.name, **self.params}
+
+    def cache_key(self):
+        '''Hashable representation, used to bind cached keys.'''
+        return tuple(sorted(self.to_dict().items()))
+
+    def __eq__(self, other):
+        return isinstance(other, KDF) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        params = ', '.join(f'{key}={value}' for
+                           key, value in self.params.items())
+        return f'{self.__class__.__name__}({params})'
+
+    @classmethod
+    def calibrate(cls, target=DEFAULT_TARGET):
+        '''Return an instance that derives a key in about target seconds.'''
+        raise NotImplementedError
+
+
+class PBKDF2(KDF):
+    '''PBKDF2-HMAC-SHA256.'''
+    name = 'pbkdf2-sha256'
+    min_iterations = 100000
+
+    def __init__(self, iterations=DEFAULT_ITERATIONS):
+        if int(iterations) < 1:
+            raise KDFError(f'Bad iteration count: {iterations}')
+        self.iterations = int(iterations)
+
+    @property
+    def params(self):
+        return {'iterations': self.iterations}
+
+    def derive(self, password, salt):
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=KEY_LENGTH,
+            salt=salt,
+            iterations=self.iterations,
+            backend=default_backend()
+            )
+        return kdf.derive(bytearray(password, 'utf-8'))
+
+    @classmethod
+    def calibrate(cls, target=DEFAULT_TARGET):
+        # Cost is linear in iterations so one sample is enough.
+        sample = cls(20000)
+        elapsed = _time(sample)
+        iterations = int(sample.iterations * target / elapsed)
+        return cls(max(cls.min_iterations, iterations))
+
+
+class Scrypt(KDF):
+    '''Scrypt, memory hard.'''
+    name = 'scrypt'
+    min_n = 2**14
+    max_n = 2**20
+
+    def __init__(self, n=2**15, r=8, p=1):
+        n, r, p = int(n), int(r), int(p)
+        if n < 2 or n & (n - 1) or r < 1 or p < 1:
+            raise KDFError(f'Bad scrypt parameters: {n=}, {r=}, {p=}')
+        self.n = n
+        self.r = r
+        self.p = p
+
+    @property
+    def params(self):
+        return {'n': self.n, 'r': self.r, 'p': self.p}
+
+    def derive(self, password, salt):
+        kdf = scrypt.Scrypt(salt=salt,
+                            length=KEY_LENGTH,
+                            n=self.n,
+                            r=self.r,
+                            p=self.p,
+                            backend=default_backend())
+        return kdf.derive(bytearray(password, 'utf-8'))
+
+    @classmethod
+    def calibrate(cls, target=DEFAULT_TARGET):
+        # n has to be a power of two, double it until next step overshoots.
+        kdf = cls(cls.min_n)
+        elapsed = _time(kdf)
+        while kdf.n < cls.max_n and elapsed * 2 <= target:
+            kdf = cls(kdf.n * 2)
+            elapsed *= 2
+        return kdf
+
+
+KDFS = {kdf.name: kdf for kdf in (PBKDF2, Scrypt)}
+
+
+def _time(kdf):
+    start = time.perf_counter()
+    kdf.derive('calibration', b'\0' * 16)
+    return max(time.perf_counter() - start, 1e-6)
+
+
+def from_dict(params):
+    '''Create KDF from its header representation.'''
+    params = dict(params)
+    name = params.pop('name', PBKDF2.name)
+    try:
+        return KDFS[name](**params)
+    except KeyError:
+        raise KDFError(f'Unknown KDF: {name}')
+    except TypeError as err:
+        raise KDFError(f'Bad parameters for {name}: {err}')
+
+
+def from_header(data):
+    '''
+    Get KDF used by vault data, headers from before the KDF was stored
+    are PBKDF2 with an optional iteration count.
+    '''
+    if data.get('kdf'):
+        return from_dict(data['kdf'])
+    return PBKDF2(data.get('iterations', DEFAULT_ITERATIONS))
+
+
+def calibrate(name=PBKDF2.name, target=DEFAULT_TARGET):
+    '''Benchmark host and return a KDF that takes about target seconds.'''
+    try:
+        return KDFS[name].calibrate(target)
+    except KeyError:
+        raise KDFError(f'Unknown KDF: {name}')
@@ -0,0 +1,80 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Cache of the last derived key.
+Key derivation is slow on purpose, so a lock/save/unlock cycle should only
+pay for it once.
+'''
+import hashlib
+import hmac
+import os
+import time
+
+
+class KeyCache():
+    """
+    Holds one derived key bound to (password digest, salt, kdf params).
+    The password itself is never stored, only a keyed digest of it.
+    """
+    def __init__(self, ttl=300, enabled=True):
+        self.ttl = ttl
+        self.enabled = enabled
+        # Per process secret so the digest is useless outside of it.
+        self._secret = os.urandom(32)
+        self._binding = None
+        self._key = None
+        self._expires = 0
+
+    def _bind(self, password, salt, params):
+        digest = hmac.new(self._secret,
+                          password.encode('utf-8'),
+                          hashlib.sha256).digest()
+        return digest, bytes(salt), params
+
+    def get(self, password, salt, params):
+        """Return cached key if it matches binding and has not expired."""
+        if not self.enabled or self._key is None:
+            return
+        if time.monotonic() > self._expires:
+            self.wipe()
+            return
+        binding = self._bind(password, salt, params)
+        if (hmac.compare_digest(binding[0], self._binding[0]) and
+                binding[1:] == self._binding[1:]):
+            return bytes(self._key)
+
+    def put(self, password, salt, params, key):
+        """Store key, replacing any earlier key."""
+        if not self.enabled:
+            return
+        self.wipe()
+        self._binding = self._bind(password, salt, params)
+        self._key = bytearray(key)
+        self._expires = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        """Forget the cached key, alias for wipe."""
+        self.wipe()
+
+    def wipe(self):
+        """Overwrite the cached key in memory and drop it."""
+        if self._key is not None:
+            for index in range(len(self._key)):
+                self._key[index] = 0
+        self._key = None
+        self._binding = None
+        self._expires = 0
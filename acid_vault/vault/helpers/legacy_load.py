@@ -1,4 +1,26 @@
 '''Handling of old formats.'''
+import io
+import pickle
+
+# Only these may be created when reading old pickled vaults.
+SAFE_CLASSES = {('uuid', 'UUID'),
+                ('uuid', 'SafeUUID'),
+                ('datetime', 'datetime'),
+                ('datetime', 'date'),
+                ('datetime', 'timedelta')}
+
+
+class SafeUnpickler(pickle.Unpickler):
+    '''Unpickler that refuses anything but plain data, uuids and dates.'''
+    def find_class(self, module, name):
+        if (module, name) in SAFE_CLASSES:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed')
+
+
+def safe_loads(data):
+    '''Unpickle old vault data without running arbitrary code.'''
+    return SafeUnpickler(io.BytesIO(data)).load()
 
 
 def legacy_load(obj):
@@ -0,0 +1,88 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Vault files kept on several replicas.
+Writes go to all replicas in parallel and are done once a write quorum of
+them has acknowledged, the rest finish in the background. Reads ask all
+replicas and wait for a read quorum, replicas - write quorum + 1, so at
+least one of the answers is from a replica that has the last write.
+'''
+import concurrent.futures
+import threading
+
+MAX_WORKERS = 8
+
+_executor = None
+_lock = threading.Lock()
+
+
+class QuorumError(Exception):
+    '''
+    Too few replicas succeeded. results are those that did, errors the
+    exceptions of those that failed.
+    '''
+    def __init__(self, results, needed, errors):
+        super().__init__(f'{len(results)} replicas succeeded, {needed} '
+                         f'needed: {"; ".join(str(err) for err in errors)}')
+        self.results = results
+        self.needed = needed
+        self.errors = errors
+
+
+def executor():
+    '''Thread pool shared by all replica operations.'''
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                MAX_WORKERS, thread_name_prefix='replica')
+        return _executor
+
+
+def write_quorum(count, quorum=None):
+    '''Replicas that have to acknowledge a write, a majority if None.'''
+    if not quorum:
+        return count // 2 + 1
+    if not 1 <= quorum <= count:
+        raise ValueError(f'Quorum has to be 1 to {count}: {quorum}')
+    return quorum
+
+
+def read_quorum(count, quorum=None):
+    '''Replicas to read so one of them is in every write quorum.'''
+    return count - write_quorum(count, quorum) + 1
+
+
+def first(calls, needed):
+    '''
+    Run calls in parallel, returns (index, result) of the first needed of
+    them to succeed, in the order they finished. Calls still running when
+    enough have succeeded are left to finish in the background.
+    Raises QuorumError if fewer than needed succeed.
+    '''
+    futures = {executor().submit(call): index for
+               index, call in enumerate(calls)}
+    results = []
+    errors = []
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            results.append((futures[future], future.result()))
+        except Exception as err:
+            errors.append(err)
+        if len(results) >= needed:
+            return results
+    raise QuorumError(results, needed, errors)
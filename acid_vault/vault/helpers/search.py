@@ -0,0 +1,234 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Trigram search over system, user and notes of records.
+Words are padded with spaces before they are split in to trigrams, so short
+queries match the start of words and the last word of a query is matched
+as a prefix, as it may not be typed in full yet.
+Matches are ranked on number of trigrams matched, trigrams matched in system
+count twice.
+The password field is never indexed.
+
+Each record gets a small int id and every common trigram a bitmask of the
+ids having it, so a query is a handful of big int operations per trigram
+however many records match. Rare trigrams keep a list of ids instead, a
+bitmask costs memory in proportion to the highest id in it.
+'''
+import math
+import re
+
+from . import codec
+
+INDEXED = tuple(codec.FIELDS.index(name) for
+                name in ('system', 'user', 'notes'))
+SYSTEM = codec.FIELDS.index('system')
+DELETED = codec.FIELDS.index('deleted')
+# Part of the query trigrams a record has to match, lower is fuzzier.
+MIN_MATCH = 0.5
+DEFAULT_LIMIT = 20
+# Trigrams with more ids than this are kept as bitmasks.
+MAX_LIST = 64
+WORD = re.compile(r'\w+')
+
+
+def trigrams(text, prefix=False):
+    '''Trigrams of the words in text, last word as a prefix if prefix.'''
+    words = WORD.findall(text.lower())
+    grams = set()
+    last = len(words) - 1
+    for index, word in enumerate(words):
+        if prefix and index == last:
+            padded = '  ' + word
+        else:
+            padded = '  ' + word + ' '
+        grams.update([padded[i:i + 3] for i in range(len(padded) - 2)])
+    return grams
+
+
+def _mask(ids):
+    '''Bitmask of ids kept as a list or a bitmask.'''
+    if isinstance(ids, int):
+        return ids
+    if len(ids) <= MAX_LIST:
+        mask = 0
+        for record_id in ids:
+            mask |= 1 << record_id
+        return mask
+    bits = bytearray((max(ids) >> 3) + 1)
+    for record_id in ids:
+        bits[record_id >> 3] |= 1 << (record_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def _add(planes, mask):
+    '''Add one to the bit sliced counters of all ids in mask.'''
+    for index, plane in enumerate(planes):
+        if not mask:
+            return
+        planes[index], mask = plane ^ mask, plane & mask
+    if mask:
+        planes.append(mask)
+
+
+def _equal(planes, value):
+    '''Mask of ids whose counter is value, may be negative (all ids).'''
+    if value >> len(planes):
+        return 0
+    mask = -1
+    for index, plane in enumerate(planes):
+        mask &= plane if value >> index & 1 else ~plane
+    return mask
+
+
+class SearchIndex():
+    '''Trigram index, records are identified by uid.'''
+    def __init__(self, records=()):
+        # Trigram to ids, for all fields and for system only.
+        self._ids = {}
+        self._system_ids = {}
+        # Uid to id and trigrams, id to uid.
+        # Trigrams are kept as tuples of shared strings, sets are big.
+        self._records = {}
+        self._grams = {}
+        self._uids = []
+        self._free = []
+        self.extend(records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _new(self, record):
+        """Give record an id and trigrams, None if it is not to be indexed."""
+        if not codec.is_record(record):
+            return
+        uid = record[0].bytes
+        self.remove(uid)
+        if record[DELETED]:
+            return
+        if self._free:
+            record_id = self._free.pop()
+            self._uids[record_id] = uid
+        else:
+            record_id = len(self._uids)
+            self._uids.append(uid)
+        share = self._grams.setdefault
+        system_grams = tuple(share(gram, gram) for
+                             gram in trigrams(record[SYSTEM]))
+        grams = set(system_grams)
+        for position in INDEXED:
+            if position != SYSTEM:
+                grams.update(trigrams(record[position]))
+        grams = tuple(share(gram, gram) for gram in grams)
+        self._records[uid] = (record_id, grams, system_grams)
+        return record_id, grams, system_grams
+
+    def add(self, record):
+        '''Add or update record, deleted records are removed.'''
+        new = self._new(record)
+        if not new:
+            return
+        record_id, grams, system_grams = new
+        for index, keys in ((self._ids, grams),
+                            (self._system_ids, system_grams)):
+            for gram in keys:
+                ids = index.get(gram)
+                if ids is None:
+                    index[gram] = [record_id]
+                elif isinstance(ids, int):
+                    index[gram] = ids | 1 << record_id
+                elif len(ids) < MAX_LIST:
+                    ids.append(record_id)
+                else:
+                    index[gram] = _mask(ids) | 1 << record_id
+
+    def extend(self, records):
+        '''Add many records, faster than one at a time.'''
+        added = {}
+        added_system = {}
+        # Last record wins if a uid is given more than once.
+        latest = {}
+        for record in records:
+            if codec.is_record(record):
+                latest[record[0].bytes] = record
+        for record in latest.values():
+            new = self._new(record)
+            if not new:
+                continue
+            record_id, grams, system_grams = new
+            for gram in grams:
+                added.setdefault(gram, []).append(record_id)
+            for gram in system_grams:
+                added_system.setdefault(gram, []).append(record_id)
+        for index, new_ids in ((self._ids, added),
+                               (self._system_ids, added_system)):
+            for gram, ids in new_ids.items():
+                current = index.get(gram, [])
+                if isinstance(current, list):
+                    ids = current + ids
+                    if len(ids) <= MAX_LIST:
+                        index[gram] = ids
+                        continue
+                index[gram] = _mask(current) | _mask(ids)
+
+    def remove(self, uid):
+        '''Remove record with uid, if indexed.'''
+        if uid not in self._records:
+            return
+        record_id, grams, system_grams = self._records.pop(uid)
+        self._uids[record_id] = None
+        self._free.append(record_id)
+        for index, keys in ((self._ids, grams),
+                            (self._system_ids, system_grams)):
+            for gram in keys:
+                ids = index[gram]
+                if isinstance(ids, int):
+                    ids &= ~(1 << record_id)
+                    index[gram] = ids
+                else:
+                    ids.remove(record_id)
+                if not ids:
+                    del index[gram]
+                    if gram not in self._ids:
+                        self._grams.pop(gram, None)
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        '''Uids of records matching query, best match first.'''
+        grams = trigrams(query, prefix=True)
+        if not grams:
+            return []
+        matched = []
+        score = []
+        for gram in grams:
+            mask = _mask(self._ids.get(gram, ()))
+            _add(matched, mask)
+            _add(score, mask)
+            _add(score, _mask(self._system_ids.get(gram, ())))
+        enough = 0
+        for count in range(math.ceil(len(grams) * MIN_MATCH),
+                           len(grams) + 1):
+            enough |= _equal(matched, count)
+        uids = []
+        for level in range(2 * len(grams), 0, -1):
+            if len(uids) >= limit or not enough:
+                break
+            mask = enough & _equal(score, level)
+            enough &= ~mask
+            while mask and len(uids) < limit:
+                low = mask & -mask
+                uids.append(self._uids[low.bit_length() - 1])
+                mask ^= low
+        return uids
@@ -17,212 +17,424 @@
 """
 Handle files on Remote server through ssh.
 Wrapper around Paramiko sftp server.
+Connections are kept in a pool and reused by the next SFTPBackend to the
+same host, port and user, so repeated syncs skip handshake and login.
 """
 import os
 import paramiko
-import tempfile
-import tkinter.messagebox
+import shlex
+import threading
+import time
 
+from . import cache
 from . import constants
+from . import instrument
+from . import storage
+from .storage import identity
 
 LOCK_PATH = r'.lock/vault.lock'
+HOLDERS_PATH = LOCK_PATH + '.holders'
+# Seconds a lock lease lasts without a heartbeat.
+LEASE_TTL = 60
+HEARTBEAT_INTERVAL = LEASE_TTL / 4
+# Bytes written before a flush, writes are pipelined so a flush does not
+# wait for each request to be acknowledged.
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Seconds an unused connection is kept open.
+IDLE_TIMEOUT = 5 * 60
 
 
-class MissingKeyError(Exception):
-    def __init__(self, client, hostname, key):
-        super().__init__(f'{hostname}: {key.get_base64()} '
-                         'is missing in hostfile')
-        self.client = client
+class ConnectionPool():
+    """
+    Idle ssh clients, with their sftp channel, keyed by (host, port, user).
+    A client is lent to one SFTPBackend at a time.
+    """
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Healthy idle (client, sftp) for key, None if there is none."""
+        self.prune()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return
+                client, sftp, _ = idle.pop()
+            if is_alive(client):
+                return client, sftp
+            close_client(client, sftp)
+
+    def release(self, key, client, sftp):
+        """Give back client to be reused, closed if it is not healthy."""
+        if not is_alive(client, probe=False):
+            close_client(client, sftp)
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(
+                (client, sftp, time.monotonic()))
+        self.prune()
+
+    def prune(self):
+        """Close connections that have been idle too long."""
+        expired = []
+        limit = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                expired.extend(entry for entry in idle if entry[2] < limit)
+                idle[:] = [entry for entry in idle if entry[2] >= limit]
+                if not idle:
+                    del self._idle[key]
+        for client, sftp, _ in expired:
+            close_client(client, sftp)
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = [entry for entries in self._idle.values() for
+                    entry in entries]
+            self._idle = {}
+        for client, sftp, _ in idle:
+            close_client(client, sftp)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+
+def is_alive(client, probe=True):
+    """True if client is connected, probe sends an ignore message."""
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    if probe:
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+    return True
+
+
+def close_client(client, sftp=None):
+    for con in (sftp, client):
+        try:
+            con and con.close()
+        except Exception:
+            pass
+
+
+POOL = ConnectionPool()
+
+# Run remotely with bash as one command, takes the lock and holds it while
+# heartbeats (lines on stdin) keep coming. The lock is a flock held by the
+# shell, it is released as soon as the shell exits for whatever reason.
+# Each holder writes "pid identity last-heartbeat" in its holder file.
+LEASE_SCRIPT = r'''
+mkdir -p {holders} {file_dir} || exit 1
+exec 9>>{lock}
+if ! flock {options} 9; then
+    echo "BUSY $(cat {holders}/* 2>/dev/null | cut -d' ' -f2 | tr '\n' ' ')"
+    exit 1
+fi
+holder={holders}/$$
+echo "$$ {identity} $(date +%s)" > "$holder"
+echo "OK $(stat -c '%X %Y %s' {path} 2>/dev/null) {digest}"
+while read -r -t {ttl} line && [ "$line" != quit ]; do
+    echo "$$ {identity} $(date +%s)" > "$holder"
+done
+rm -f "$holder"
+'''
+
+# Kills holders that have missed their heartbeats but still hold the lock.
+BREAK_SCRIPT = r'''
+now=$(date +%s)
+lock=$(readlink -f {lock})
+for holder in {holders}/*; do
+    [ -f "$holder" ] || continue
+    read -r pid identity beat < "$holder"
+    [ $((now - beat)) -gt {ttl} ] || continue
+    if [ "$(readlink /proc/$pid/fd/9)" = "$lock" ]; then
+        kill "$pid" 2>/dev/null && echo "$identity"
+    fi
+    rm -f "$holder"
+done
+'''
+
+
+def lease_command(path, options='-e -w 15', ttl=LEASE_TTL, digest=False):
+    """
+    Command that locks, makes directory of path and prints its times and
+    size, and its sha256 if digest.
+    """
+    digest = digest and (f'$(sha256sum {shlex.quote(path)} 2>/dev/null | '
+                         "cut -d' ' -f1)")
+    script = LEASE_SCRIPT.format(
+        digest=digest or '',
+        holders=shlex.quote(HOLDERS_PATH),
+        lock=shlex.quote(LOCK_PATH),
+        file_dir=shlex.quote(os.path.dirname(path) or '.'),
+        path=shlex.quote(path),
+        options=options,
+        identity=shlex.quote(identity()),
+        ttl=int(ttl))
+    return f'bash -c {shlex.quote(script)}'
+
+
+def break_command(ttl=LEASE_TTL):
+    """Command that breaks stale leases and prints their holders."""
+    script = BREAK_SCRIPT.format(holders=shlex.quote(HOLDERS_PATH),
+                                 lock=shlex.quote(LOCK_PATH),
+                                 ttl=int(ttl))
+    return f'bash -c {shlex.quote(script)}'
+
+
+class HostKeyError(Exception):
+    """Host key of server is unknown or does not match the known one."""
+    title = 'Host Key'
+
+    def __init__(self, hostname, key, message):
+        super().__init__(message)
         self.hostname = hostname
         self.key = key
 
 
-class RemoteFile():
+class MissingKeyError(HostKeyError):
+    title = 'Missing Host Key'
+
+    def __init__(self, hostname, key):
+        super().__init__(hostname, key, f'{hostname}: {key.get_base64()} '
+                         'is missing in hostfile')
+
+
+class BadKeyError(HostKeyError):
+    title = 'Bad Host Key'
+
+    def __init__(self, hostname, key):
+        super().__init__(hostname, key, f'{hostname}: host key does not '
+                         'match the known key\n '
+                         'This may be a Man In the Middle attack')
+
+
+class SFTPBackend(storage.StorageBackend):
     """
-    Class to handle remote files through ssh.
-    Implements context manager.
+    Files on an ssh server through sftp.
+    Locks are leases held by a remote command (see LEASE_SCRIPT), the
+    connection is taken from the pool on first use and given back on close.
     """
-    def __init__(self, ssh_params, filepath, *args, **kwargs):
-        host, port, username, password = [ssh_params.get(x) for x in
-                                          ('host',
-                                           'port',
-                                           'username',
-                                           'password')]
-        self.safe_write = None
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(RejectKeyPolicy())
-        self.known_hosts = os.path.join(constants.data_dir(), '.know_hosts')
-        try:
-            self.ssh.load_host_keys(self.known_hosts)
-        except FileNotFoundError:
-            os.makedirs(constants.data_dir(), exist_ok=True)
-            with open(self.known_hosts, 'w'):
-                pass
-            self.ssh.load_host_keys(self.known_hosts)
-        self._connect(host, port, username, password)
-        self.filepath = filepath
+    def __init__(self, ssh_params, buffer_size=WRITE_BUFFER_SIZE):
+        self.ssh_params = ssh_params
+        self.host, port, self.username, self.password = [
+            ssh_params.get(x) for x in
+            ('host', 'port', 'username', 'password')]
+        self.port = int(port)
+        self.pool_key = (self.host, self.port, self.username)
+        self.buffer_size = ssh_params.get('buffer_size') or buffer_size
+        self.ssh = None
         self.sftp = None
-        self.stat = None
-        self.lock = None
-        self.lock_script_path = '/tmp/lock_script_v1.0.0.cmd'
-        self.fh = self._open(*args, **kwargs)
+        # True once a file has been opened.
+        self.touched = False
 
-    def __enter__(self):
-        return self.fh
+    def cache_key(self, path):
+        return cache.key(self.ssh_params, path)
 
-    def __exit__(self, *args):
-        self.close()
+    def _client(self):
+        if self.ssh is None:
+            pooled = POOL.acquire(self.pool_key)
+            if pooled:
+                self.ssh, self.sftp = pooled
+            else:
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(RejectKeyPolicy())
+                load_host_keys(client)
+                with instrument.span('ssh.connect', host=self.host):
+                    self._connect(client)
+                self.ssh, self.sftp = client, None
+        return self.ssh
 
-    def _connect(self, host, port, username, password):
+    def _connect(self, client):
         try:
-            self.ssh.connect(host, int(port), username, password)
+            client.connect(
+                self.host, self.port, self.username, self.password)
         except paramiko.ssh_exception.BadHostKeyException as err:
-            if tkinter.messagebox.askokcancel(
-                    'Bad Host Key',
-                    f'{err}\n '
-                    'This may be a Man In the Middle attack\n '
-                    'Continue anyway?'):
-                keys = self.ssh.get_host_keys()
-                hostname = (err.hostname if err.hostname in keys else
-                            f'[{err.hostname}]:{port}')
-                if hostname not in keys:
-                    raise
-                self.add_key(hostname, err.key)
-                self._connect(host, port, username, password)
-                return
+            client.close()
+            keys = client.get_host_keys()
+            hostname = (err.hostname if err.hostname in keys else
+                        f'[{err.hostname}]:{self.port}')
+            if hostname not in keys:
+                raise
+            raise BadKeyError(hostname, err.key)
+        except BaseException:
+            client.close()
+            raise
 
-        except paramiko.ssh_exception.SSHException as err:
-            if str(err) == 'Authentication failed.':
-                tkinter.messagebox.showerror('Authentication failed.',
-                                             'Authentication failed.')
-        except MissingKeyError as err:
-            if tkinter.messagebox.askokcancel(
-                    'Missing Host Key',
-                    f'{err}\n '
-                    'Continue anyway?'):
-                self.add_key(err.hostname, err.key)
-                self._connect(host, port, username, password)
-                return
-        else:
-            # All OK
-            return
-        # If we have here an exception has happened
-        self.ssh.close()
-
-    def add_key(self, hostname, key):
-        """Adds keys to host file."""
-        keys = self.ssh.get_host_keys()
-        keys.pop(hostname, '')
-        keys.add(hostname, 'ssh-rsa', key)
-        keys.save(self.known_hosts)
-
-    def _makedirs(self, path):
-        current_path = ''
-        for p in path.split('/'):
-            current_path = (current_path and f'{current_path}/{p}') or p
-            try:
-                self.sftp.stat(current_path)
-            except FileNotFoundError:
-                self.sftp.mkdir(current_path)
+    def _sftp(self):
+        self._client()
+        if not self.sftp:
+            with instrument.span('ssh.open'):
+                self.sftp = self.ssh.open_sftp()
+        return self.sftp
 
-    def close(self):
-        """Close all open handles in the correct order."""
-        if self.safe_write:
-            self.ssh.exec_command(f'mv {self.filepath}.bak {self.filepath}')
-        if self.stat:
-            self.sftp.utime(self.filepath, (self.stat.st_atime,
-                                            self.stat.st_mtime))
-        try:
-            self.fh.close()
-        except Exception:
-            pass
-        if self.lock:
-            try:
-                self.lock.write('quit')
-            except Exception as error:
-                print(f'Failed to close lock: {error}')
-        for con in ('sftp', 'ssh'):
-            try:
-                getattr(self, con).close()
-            except Exception:
-                pass
+    def _open_file(self, path, mode, *args):
+        self.touched = True
+        return self._sftp().open(path, mode, *args)
 
+    def _run(self, command):
+        _, stdout, stderr = self._client().exec_command(command)
+        # Wait for it, the connection is reused by the next command.
+        if stdout.channel.recv_exit_status():
+            raise storage.StorageError(stderr.read().decode().strip())
 
-    def _open(self, mode='r', *args, timeout=15, **kwargs):
-        """Open remote path."""
-        path = kwargs.pop('path', self.filepath)
-        transport = self.ssh.get_transport()
-        try:
-            transport.send_ignore()
-        except Exception:
-            return
-        self.sftp = self.ssh.open_sftp()
-        self._makedirs(os.path.dirname(path))
+    def stat(self, path):
         try:
-            self.stat = self.sftp.stat(path)
+            stat = self._sftp().stat(path)
         except FileNotFoundError:
-            pass
-        if [x for x in args if 'w' in x] or 'w' in kwargs.get('mode', ''):
-            options = f'-e -w {timeout}'
-        else:
-            options = f'-s -w {timeout}'
-        self.lock = self.aquire_lock(options)
-        if not self.lock:
-            print('Failed to aquire lock')
-            return
-        if 'w' in mode and self.filepath == path:
-            self.safe_write = True
-            path = f'{path}.bak'
-        return self.sftp.open(path, *args, mode=mode, **kwargs)
+            return None
+        return storage.FileStat(stat.st_atime, stat.st_mtime, stat.st_size)
+
+    def read(self, path, size=None):
+        return storage.ReadAheadFile(
+            lambda: self._open_file(path, 'rb'), size)
+
+    def write(self, path):
+        fh = self._open_file(path, 'wb', self.buffer_size)
+        fh.set_pipelined(True)
+        return fh
+
+    def update(self, path):
+        fh = self._open_file(path, 'r+b', self.buffer_size)
+        # In place appends wait for each write, their prefix rewrite
+        # is only a commit if the entries are known to be written.
+        fh.set_pipelined(False)
+        return fh
+
+    def replace(self, source, path):
+        self._run(f'mv {shlex.quote(source)} {shlex.quote(path)}')
+
+    def remove(self, path):
+        self._run(f'rm -f {shlex.quote(path)}')
+
+    def lock(self, path, exclusive=True, timeout=storage.LOCK_TIMEOUT,
+             digest=False):
+        """
+        Take the remote lock with one command, it also creates the
+        directory of path and reports its times, size and hash.
+        Heartbeats are sent until unlocked.
+        """
+        options = f'{"-e" if exclusive else "-s"} -w {int(timeout)}'
+        with instrument.span('ssh.lock'):
+            stdin, stdout, _ = self._client().exec_command(
+                lease_command(path, options, digest=digest))
+            status, _, rest = stdout.readline().strip().partition(' ')
+        if status != 'OK':
+            stdin.channel.close()
+            raise storage.LockError(rest.strip() or None)
+        values = rest.split()
+        stat = None
+        if len(values) >= 3:
+            stat = storage.FileStat(*[int(value) for value in values[:3]],
+                                    *values[3:4])
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat,
+                         args=(stdin, stop),
+                         daemon=True).start()
+        return storage.Lease(path, exclusive, stat, (stdin, stop))
+
+    @staticmethod
+    def _heartbeat(pipe, stop):
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                pipe.write('\n')
+                pipe.flush()
+            except Exception:
+                return
 
-    def create_lock_script(self):
+    def unlock(self, lease):
+        pipe, stop = lease.handle
+        stop.set()
         try:
-            self.sftp.stat(self.lock_script_path)
-        except (IOError, FileNotFoundError):
-            fh, file_path = tempfile.mkstemp(text=True)
-            with self.sftp.open(self.lock_script_path, 'w') as fh:
-                print('#!/bin/bash\n'
-                      'echo "OK"\n'
-                      "INPUT='start'\n"
-                      'START=$(date +%s)\n'
-                      'while [ "$INPUT" != \'quit\' ] && (( $(date +%s) - $START > 60 ))\n'
-                      '    do\n'
-                      '        read INPUT\n'
-                      '        sleep 0.5\n'
-                      '    done\n',
-                      file=fh)
-            self.ssh.exec_command(f'chmod +x {self.lock_script_path}')
-
-    def aquire_lock(self, options='-e -w 15'):
-        self.create_lock_script()
-        self.ssh.exec_command(
-            f'mkdir -p {os.path.dirname(LOCK_PATH)}')
-        stdin, stdout, stderr = self.ssh.exec_command(
-            f'flock {options} {LOCK_PATH} -c {self.lock_script_path}')
-        if stdout.readline():
-            return stdin
-
-    def release_lock(self, pipe):
-        pipe.write('quit')
-
-
-def force_lock(host, port, user, password=None):
-    client = paramiko.SSHClient()
-    client.connect(host, int(port), user, password)
-    client.exec_command(f'rm {LOCK_PATH}')
-    client.close()
+            pipe.write('quit\n')
+            pipe.flush()
+            pipe.channel.shutdown_write()
+            pipe.channel.close()
+        except Exception as error:
+            print(f'Failed to close lock: {error}')
+
+    def restore_times(self, path, stat):
+        if self.touched:
+            self._sftp().utime(path, (stat.st_atime, stat.st_mtime))
+
+    def break_lock(self, ttl=LEASE_TTL):
+        """Break leases that have missed heartbeats, returns holders."""
+        _, stdout, _ = self._client().exec_command(break_command(ttl))
+        return [line.strip() for line in stdout.readlines() if line.strip()]
+
+    def close(self):
+        if self.ssh is not None:
+            # Connection is kept for the next backend to the same host.
+            POOL.release(self.pool_key, self.ssh, self.sftp)
+        self.ssh = self.sftp = None
+        self.touched = False
+
+
+def replicas(ssh_params):
+    """
+    Params of each replica, ssh_params itself and one for each of its
+    comma separated replicas "[user@]host[:port]", they share password.
+    """
+    params = [ssh_params]
+    for replica in (ssh_params.get('replicas') or '').split(','):
+        replica = replica.strip()
+        if not replica:
+            continue
+        username, _, host = replica.rpartition('@')
+        host, _, port = host.partition(':')
+        params.append({**ssh_params,
+                       'host': host,
+                       'port': port or ssh_params.get('port') or 22,
+                       'username': username or ssh_params.get('username'),
+                       'replicas': ''})
+    return params
+
+
+def break_lock(ssh_params, ttl=LEASE_TTL):
+    """
+    Break stale remote locks, a lease is stale when its holder has not
+    sent a heartbeat for ttl seconds. Returns identities of broken holders.
+    """
+    backend = SFTPBackend(ssh_params)
+    try:
+        return backend.break_lock(ttl)
+    finally:
+        backend.close()
+
+
+def known_hosts():
+    return os.path.join(constants.data_dir(), '.know_hosts')
 
 
 def load_host_keys(client):
-    data_dir = constants.data_dir()
     try:
-        client.load_host_keys(os.path.join(data_dir, '.know_hosts'))
+        client.load_host_keys(known_hosts())
     except FileNotFoundError:
-        os.makedirs(data_dir, exist_ok=True)
-        with open(os.path.join(data_dir, '.know_hosts'), 'w'):
+        os.makedirs(constants.data_dir(), exist_ok=True)
+        with open(known_hosts(), 'w'):
             pass
 
 
+def add_host_key(hostname, key):
+    """Trust key for hostname from now on, replacing any earlier key."""
+    keys = paramiko.HostKeys()
+    try:
+        keys.load(known_hosts())
+    except FileNotFoundError:
+        os.makedirs(constants.data_dir(), exist_ok=True)
+    keys.pop(hostname, None)
+    keys.add(hostname, key.get_name(), key)
+    keys.save(known_hosts())
+
+
 def upload_pub_key(
         host, port, user, password, key_path, accept_unknown_host=False,
         comment=False):
@@ -260,4 +472,4 @@ def read_key(key_path):
 
 class RejectKeyPolicy(paramiko.client.MissingHostKeyPolicy):
     def missing_host_key(self, client, hostname, key):
-        raise MissingKeyError(client, hostname, key)
+        raise MissingKeyError(hostname, key)
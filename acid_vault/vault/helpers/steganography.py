@@ -20,55 +20,308 @@
 Steganography
 Hides data within an image so that its not obvious that the data is
 there.
+
+Format 2 starts with a header in the first pixels
+
+    magic     4 bytes, MAGIC
+    version   1 byte, FORMAT_VERSION
+    bits      1 byte, bits per channel value of the data
+    channels  1 byte, channels per pixel used for the data
+    length    uint32 length of data in bytes
+    checksum  crc32 of data
+
+followed by the data, filled pixel by pixel over the channels a few bits
+per value, see MODES. Each value differs from the original by the bits it
+holds, added or subtracted if adding would go past 255, so only pixels up
+to the end of data change.
+The header always has one bit per R, G and B value.
+Images without the magic are format 1, data in band R then G then B and
+every value after it raised by 2 (clipped at 255) to mark the end.
+
+Decoded originals are kept in CARRIERS, so a sync does not decode the
+same jpg again.
 '''
+import collections
+import hashlib
+import io
+import os
+import struct
+import threading
+import zlib
 
+import numpy
 from PIL import Image
 
+from . import instrument
+
+MAGIC = b'AVSG'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('>4sBBBII')
+# Pixels the header takes, one bit in each of R, G and B.
+HEADER_PIXELS = -(-HEADER.size * 8 // 3)
+# Channels used and bits per value, more bits are more visible.
+MODES = ('rgb1', 'rgb2', 'rgb3', 'rgb4', 'rgba1', 'rgba2', 'rgba3', 'rgba4')
+DEFAULT_MODE = 'rgb1'
+# Rows compared at a time when looking for the end of format 1 data.
+ROWS = 64
+# Memory decoded originals may take, a 12 megapixel jpg takes 36 MB.
+MAX_CARRIER_BYTES = 128 * 1024 * 1024
+
 
 class SteganographyError(Exception):
     '''StganographyError for various error situations.'''
     pass
 
 
-def write(fh, original, data):
+def parse_mode(mode):
+    '''Bits per value and channels per pixel of mode, e.g. rgb2.'''
+    if mode not in MODES:
+        raise SteganographyError(f'Unknown mode: {mode}')
+    return int(mode[-1]), len(mode) - 1
+
+
+def _rgb(image):
+    '''Image as RGB or RGBA, the modes data can be written in.'''
+    mode = 'RGBA' if 'A' in image.getbands() else 'RGB'
+    if image.mode == mode:
+        return image
+    return image.convert(mode)
+
+
+class CarrierCache():
+    '''
+    Decoded original images as read only RGB or RGBA arrays, keyed by
+    path, size, mtime and sha256 of content. Least recently used are
+    dropped to stay within max_bytes.
+    '''
+    def __init__(self, max_bytes=MAX_CARRIER_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._carriers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        '''Pixels of image at path, decoded unless cached.'''
+        with open(path, 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            content = fh.read()
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+               hashlib.sha256(content).digest())
+        with self._lock:
+            pixels = self._carriers.get(key)
+            if pixels is not None:
+                self._carriers.move_to_end(key)
+                self.hits += 1
+                return pixels
+            self.misses += 1
+        with instrument.span('stego.decode') as span, \
+                Image.open(io.BytesIO(content)) as image:
+            span.add_bytes(len(content))
+            pixels = numpy.array(_rgb(image))
+        pixels.flags.writeable = False
+        with self._lock:
+            # Older versions of the file will not be asked for again.
+            for old in [old for old in self._carriers if old[0] == key[0]]:
+                del self._carriers[old]
+            self._carriers[key] = pixels
+            while self.size() > self.max_bytes:
+                self._carriers.popitem(last=False)
+        return pixels
+
+    def size(self):
+        '''Bytes taken by cached images.'''
+        return sum([pixels.nbytes for pixels in self._carriers.values()])
+
+    def clear(self):
+        '''Drop all cached images.'''
+        with self._lock:
+            self._carriers.clear()
+
+
+CARRIERS = CarrierCache()
+
+
+def _space(pixels, alpha, bits, channels):
+    '''Bytes of data that fit in image of pixels, alpha if it has alpha.'''
+    if channels == 4 and not alpha:
+        raise SteganographyError('Image has no alpha channel')
+    pixels -= HEADER_PIXELS
+    if pixels < 0:
+        raise SteganographyError('Image is too small')
+    return pixels * channels * bits // 8
+
+
+def capacity(image_path, mode=DEFAULT_MODE):
+    '''Bytes of data that can be written with image as original.'''
+    bits, channels = parse_mode(mode)
+    with Image.open(image_path) as image:
+        return _space(image.size[0] * image.size[1],
+                      'A' in image.getbands(), bits, channels)
+
+
+def _embed(values, bits):
+    '''Values with bits added, subtracted where adding would overflow.'''
+    values = values.astype(numpy.int16)
+    added = values + bits
+    return numpy.where(added > 255, values - bits, added).astype(numpy.uint8)
+
+
+def _put(pixels, data, bits, channels):
+    '''Hide data in pixels, bits at a time in the first channels.'''
+    data = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+    data = numpy.concatenate([
+        data,
+        numpy.zeros(len(pixels) * channels * bits - data.size,
+                    dtype=numpy.uint8)])
+    # Most significant bit first.
+    values = data.reshape(-1, bits).dot(1 << numpy.arange(bits)[::-1])
+    pixels[:, :channels] = _embed(pixels[:, :channels].reshape(-1),
+                                  values).reshape(-1, channels)
+
+
+def write(fh, original, data, mode=DEFAULT_MODE):
     '''
     Combine data with data from original (image (tested on jpg))
     and write it as a .png image in opened file.
     '''
-    with Image.open(original) as image:
-        mask = [int(y) for y in ''.join([str(format(x, 'b')).zfill(8) for
-                                         x in data])]
-        bands = image.split()
-        for band_index in (0, 1, 2):
-            new_band = []
-            for index, x in enumerate(image.getdata(band_index)):
-                new_band.append((x + (mask.pop(0) if mask else 2) % 255))
-            bands[band_index].putdata(new_band)
-            if not mask:
-                break
-        else:
-            raise SteganographyError('Ran out of image space')
-        i = Image.merge(image.mode, bands)
-        i.save(fh, 'png')
+    bits, channels = parse_mode(mode)
+    with instrument.span('stego.write') as span:
+        span.add_bytes(len(data))
+        pixels = numpy.array(CARRIERS.get(original))
+        flat = pixels.reshape(-1, pixels.shape[-1])
+        space = _space(len(flat), flat.shape[-1] == 4, bits, channels)
+        if len(data) > space:
+            raise SteganographyError(
+                f'Ran out of image space, {space} bytes fit in mode {mode}')
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, bits, channels,
+                             len(data), zlib.crc32(data))
+        _put(flat[:HEADER_PIXELS], header, 1, 3)
+        stop = HEADER_PIXELS + -(-len(data) * 8 // (bits * channels))
+        _put(flat[HEADER_PIXELS:stop], data, bits, channels)
+        Image.fromarray(pixels).save(fh, 'png')
+
+
+def _values(pixels, start, stop, channels):
+    '''Values of the first channels of pixels start to stop, flat.'''
+    return pixels.reshape(-1, pixels.shape[-1])[
+        start:stop, :channels].reshape(-1).astype(numpy.int16)
 
 
-def read(fh, original):
+def _rows(image, start, stop):
+    '''Pixels of rows start to stop of opened image.'''
+    return numpy.asarray(image.crop((0, start, image.size[0], stop)))
+
+
+def _get(mask, orig, start, stop, bits, channels):
+    '''
+    Bits hidden in pixels start to stop of mask image, orig is pixels of
+    the original. Only the rows holding the pixels are read from mask.
+    '''
+    width = orig.shape[1]
+    first = start // width
+    rows = _rows(mask, first, -(-stop // width))
+    offset = first * width
+    values = numpy.abs(
+        _values(rows, start - offset, stop - offset, channels) -
+        _values(orig, start, stop, channels))
+    if numpy.any(values >> bits):
+        raise SteganographyError('Image does not match original')
+    return (values[:, None] >> numpy.arange(bits)[::-1] & 1).reshape(-1)
+
+
+def _read_header(mask, orig):
+    '''Bits, channels, length and checksum, None if image is format 1.'''
+    if orig.shape[0] * orig.shape[1] < HEADER_PIXELS:
+        return None
+    try:
+        raw = _get(mask, orig, 0, HEADER_PIXELS, 1, 3)
+    except SteganographyError:
+        return None
+    magic, version, bits, channels, length, checksum = HEADER.unpack(
+        numpy.packbits(raw[:HEADER.size * 8]).tobytes())
+    if magic != MAGIC:
+        return None
+    if version != FORMAT_VERSION:
+        raise SteganographyError(f'Unsupported format: {version}')
+    if (not 1 <= bits <= 4 or channels not in (3, 4) or
+            channels > orig.shape[-1]):
+        raise SteganographyError(f'Unsupported mode: {bits}, {channels}')
+    return bits, channels, length, checksum
+
+
+def _diff(mask, orig, band_index, start, stop):
+    '''Difference of band between images in rows start to stop, flat.'''
+    return (_rows(mask, start, stop)[:, :, band_index].astype(numpy.int16) -
+            orig[start:stop, :, band_index]).reshape(-1)
+
+
+def _bits(mask, orig, wanted):
+    '''
+    Differences between format 1 images up to the end of data, at most
+    wanted of them. Rows are compared a block at a time so only rows up to
+    the end of data are touched.
+    '''
+    height, width = orig.shape[:2]
+    bits = []
+    count = 0
+    for band_index in (0, 1, 2):
+        start = 0
+        while start < height:
+            if wanted:
+                if count >= wanted:
+                    return bits
+                stop = start - (count - wanted) // width
+            else:
+                stop = start + ROWS
+            stop = min(height, stop)
+            values = _diff(mask, orig, band_index, start, stop)
+            if wanted:
+                values = values[:wanted - count]
+            end = numpy.flatnonzero((values == 2) | (values == -254))
+            if end.size:
+                bits.append(values[:end[0]])
+                return bits
+            bits.append(values)
+            count += values.size
+            start = stop
+    return bits
+
+
+def _read_legacy(mask, orig, size):
+    '''Data of format 1 image.'''
+    bits = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int16)] +
+        _bits(mask, orig, size * 8 if size else None))
+    bits = bits[:bits.size - bits.size % 8]
+    if numpy.any(bits > 1):
+        raise SteganographyError('Image does not match original')
+    # Values wrapped below zero were ones.
+    return numpy.packbits(bits != 0).tobytes()
+
+
+def read(fh, original, size=None):
     '''
     Read data from opened file and compare it to orignal to get stored data.
+    If size is given stop after that many bytes.
     '''
-    def convert_result(result):
-        return int(''.join(result), 2).to_bytes(len(result) // 8,
-                                                byteorder='big')
-    with Image.open(original) as orig, Image.open(fh) as mask:
-        result = []
-        for band_index in (0, 1, 2):
-            orig_data = list(orig.getdata(band_index))
-            mask_data = list(mask.getdata(band_index))
-            for x, y in zip(mask_data, orig_data):
-                value = x - y
-                if value in (2, -254):
-                    return convert_result(result)
-                if value < 0:
-                    value = 1
-                result.append(str(value))
-        return convert_result(result)
+    with instrument.span('stego.read') as span, Image.open(fh) as mask:
+        orig = CARRIERS.get(original)
+        mask = _rgb(mask)
+        if mask.size != (orig.shape[1], orig.shape[0]):
+            raise SteganographyError('Image does not match original')
+        header = _read_header(mask, orig)
+        if header is None:
+            result = _read_legacy(mask, orig, size)
+        else:
+            bits, channels, length, checksum = header
+            wanted = min(size, length) if size else length
+            stop = HEADER_PIXELS + -(-wanted * 8 // (bits * channels))
+            if stop > orig.shape[0] * orig.shape[1]:
+                raise SteganographyError('Data length does not fit image')
+            raw = _get(mask, orig, HEADER_PIXELS, stop, bits, channels)
+            result = numpy.packbits(raw[:wanted * 8]).tobytes()
+            if wanted == length and zlib.crc32(result) != checksum:
+                raise SteganographyError('Checksum does not match data')
+        span.add_bytes(len(result))
+        return result
@@ -0,0 +1,521 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Storage backends, where vault files are kept.
+
+A backend can stat, read and write files, atomically replace a file with
+another and lock files, see StorageBackend.
+
+    LocalBackend   files on this computer
+    SFTPBackend    files on an ssh server, see helpers.ssh
+    MemoryBackend  files in memory with a latency and bandwidth model, so
+                   the remote code paths can be tested and benchmarked on
+                   one machine without a network
+
+StoredFile opens a file the way Vault uses files, with its lock held.
+'''
+import getpass
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+
+from . import instrument
+
+# Seconds to wait for a lock.
+LOCK_TIMEOUT = 15
+# Reads within this many bytes from the start are served by one request,
+# without fetching the whole file (enough for the container prefix).
+HEAD_SIZE = 4096
+
+
+class StorageError(Exception):
+    '''File could not be read, written or replaced.'''
+    pass
+
+
+class LockError(StorageError):
+    '''Lock could not be acquired, holder is who has it if known.'''
+    def __init__(self, holder=None):
+        super().__init__('Could not acquire lock' +
+                         (f', held by {holder}' if holder else ''))
+        self.holder = holder
+
+
+def identity():
+    '''Who holds a lock, user@host:pid.'''
+    return f'{getpass.getuser()}@{socket.gethostname()}:{os.getpid()}'
+
+
+def writes(mode):
+    '''True if file mode writes, including in place appends.'''
+    return bool(set(mode) & set('wa+'))
+
+
+class FileStat():
+    '''Times and size, like the result of os.stat, and content hash.'''
+    def __init__(self, st_atime, st_mtime, st_size, sha256=None):
+        self.st_atime = st_atime
+        self.st_mtime = st_mtime
+        self.st_size = st_size
+        self.sha256 = sha256
+
+
+class Lease():
+    '''Lock held on path, stat of path is taken while holding it.'''
+    def __init__(self, path, exclusive, stat=None, handle=None):
+        self.path = path
+        self.exclusive = exclusive
+        self.stat = stat
+        # Backend specific state of the lock.
+        self.handle = handle
+
+
+class StorageBackend():
+    '''Base class for storage backends.'''
+    def cache_key(self, path):
+        '''Key to cache path under locally, None if it is not cached.'''
+        return None
+
+    def stat(self, path):
+        '''FileStat of path, None if it does not exist.'''
+        raise NotImplementedError
+
+    def read(self, path, size=None):
+        '''Open path for reading, size is the size of the file if known.'''
+        raise NotImplementedError
+
+    def write(self, path):
+        '''Open path for writing, it is truncated.'''
+        raise NotImplementedError
+
+    def update(self, path):
+        '''Open existing path for writing in place (r+b).'''
+        raise NotImplementedError
+
+    def replace(self, source, path):
+        '''Move source in place of path in one atomic step.'''
+        raise NotImplementedError
+
+    def remove(self, path):
+        '''Remove path if it exists.'''
+        raise NotImplementedError
+
+    def lock(self, path, exclusive=True, timeout=LOCK_TIMEOUT, digest=False):
+        '''
+        Lock path, exclusive or shared, make its directory and stat it,
+        with its sha256 if digest. Returns a Lease.
+        Raises LockError if the lock is not acquired within timeout.
+        '''
+        raise NotImplementedError
+
+    def unlock(self, lease):
+        '''Release lock of lease.'''
+        raise NotImplementedError
+
+    def restore_times(self, path, stat):
+        '''Set times of path back to those in stat if it was opened.'''
+        pass
+
+    def break_lock(self):
+        '''Break stale locks, returns who held them.'''
+        return []
+
+    def close(self):
+        '''Release connections, they are opened again on next use.'''
+        pass
+
+
+class LocalBackend(StorageBackend):
+    '''Files on this computer, they are not locked.'''
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return FileStat(stat.st_atime, stat.st_mtime, stat.st_size)
+
+    def read(self, path, size=None):
+        return open(path, 'rb')
+
+    def write(self, path):
+        return open(path, 'wb')
+
+    def update(self, path):
+        return open(path, 'r+b')
+
+    def replace(self, source, path):
+        os.replace(source, path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def lock(self, path, exclusive=True, timeout=LOCK_TIMEOUT, digest=False):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        stat = self.stat(path)
+        if stat and digest:
+            with open(path, 'rb') as fh:
+                stat.sha256 = hashlib.sha256(fh.read()).hexdigest()
+        return Lease(path, exclusive, stat)
+
+    def unlock(self, lease):
+        pass
+
+
+class StoredFile():
+    '''
+    File in a backend opened with its lock held, implements context manager.
+    Writes go to path.bak which replaces the file on a clean close, so the
+    file is never seen half written. The lock is released on close.
+    '''
+    def __init__(self, backend, path, mode='rb', digest=False,
+                 timeout=LOCK_TIMEOUT):
+        self.backend = backend
+        self.path = path
+        self.mode = mode
+        self.lease = backend.lock(path, writes(mode), timeout, digest)
+        self.stat = self.lease.stat
+        self._temp = None
+        try:
+            if not writes(mode):
+                self.fh = backend.read(path, self.stat and self.stat.st_size)
+            elif 'w' in mode:
+                self._temp = f'{path}.bak'
+                self.fh = backend.write(self._temp)
+            else:
+                self.fh = backend.update(path)
+        except BaseException:
+            backend.unlock(self.lease)
+            raise
+
+    def __enter__(self):
+        return self.fh
+
+    def __exit__(self, exc_type, *args):
+        self.close(failed=exc_type is not None)
+
+    def close(self, failed=False):
+        '''Close file, if failed a write does not replace the file.'''
+        try:
+            try:
+                # Buffered writes are flushed here, before the file is moved.
+                self.fh.close()
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                if self._temp and failed:
+                    self.backend.remove(self._temp)
+                elif self._temp:
+                    self.backend.replace(self._temp, self.path)
+            if self.stat and not failed:
+                self.backend.restore_times(self.path, self.stat)
+        finally:
+            self.backend.unlock(self.lease)
+
+
+class ReadAheadFile():
+    '''
+    Read only file on top of a remote file, opened by open_remote on the
+    first read, so a file that is never read is never opened.
+    Reads in the first HEAD_SIZE bytes take one request, anything else
+    fetches the rest of the file with pipelined requests (prefetch) and
+    is served from memory.
+    '''
+    def __init__(self, open_remote, size=None):
+        self._open_remote = open_remote
+        self._remote = None
+        self._size = size
+        self._head = None
+        self._data = None
+        self._position = 0
+
+    def _in_head(self, size):
+        return (self._data is None and
+                size is not None and
+                0 <= size and
+                self._position + size <= HEAD_SIZE)
+
+    def read(self, size=-1):
+        if self._in_head(size):
+            if self._head is None:
+                with instrument.span('storage.read') as span:
+                    self._head = self._file().read(HEAD_SIZE)
+                    span.add_bytes(len(self._head))
+                if len(self._head) < HEAD_SIZE:
+                    # Small file, it has been read as a whole.
+                    self._data = io.BytesIO(self._head)
+                    self._data.seek(self._position)
+                    return self._data.read(size)
+            data = self._head[self._position:self._position + size]
+            self._position += len(data)
+            return data
+        self._fetch()
+        return self._data.read(size)
+
+    def read_range(self, offset, size):
+        '''Read size bytes at offset without fetching the rest of the file.'''
+        if self._data is not None:
+            return self._data.getvalue()[offset:offset + size]
+        if self._head is not None and offset + size <= len(self._head):
+            return self._head[offset:offset + size]
+        with instrument.span('storage.read') as span:
+            # readv pipelines the requests of a large range.
+            data = b''.join(self._file().readv([(offset, size)]))
+            span.add_bytes(len(data))
+        return data
+
+    def _file(self):
+        if self._remote is None:
+            self._remote = self._open_remote()
+        return self._remote
+
+    def _fetch(self):
+        if self._data is not None:
+            return
+        head = self._head or b''
+        with instrument.span('storage.read') as span:
+            if self._size is None or self._size > len(head):
+                remote = self._file()
+                remote.seek(len(head))
+                remote.prefetch(self._size)
+                head += remote.read()
+            span.add_bytes(len(head) - len(self._head or b''))
+        self._data = io.BytesIO(head)
+        self._data.seek(self._position)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self._data is None:
+            if whence == io.SEEK_CUR:
+                offset, whence = self._position + offset, io.SEEK_SET
+            if whence == io.SEEK_SET:
+                self._position = offset
+                return offset
+            self._fetch()
+        return self._data.seek(offset, whence)
+
+    def tell(self):
+        return self._position if self._data is None else self._data.tell()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def getvalue(self):
+        '''Content of the whole file if it has been read, else None.'''
+        return None if self._data is None else self._data.getvalue()
+
+    def close(self):
+        if self._remote is not None:
+            self._remote.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemoryBackend(StorageBackend):
+    '''
+    Files in memory, for tests and benchmarks.
+    Every request waits latency seconds plus the time to move its bytes at
+    bandwidth bytes per second, reads are made like sftp reads (see
+    ReadAheadFile) and only in place writes wait for each write.
+    Locks are per path and are held by thread. Files are cached locally
+    like remote ones if the backend has a name.
+    '''
+    def __init__(self, latency=0.0, bandwidth=None, name=None,
+                 sleep=time.sleep):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.name = name
+        self.sleep = sleep
+        # Requests fail with ConnectionRefusedError when not online.
+        self.online = True
+        self.files = {}
+        self.mtimes = {}
+        self.requests = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._locks = {}
+        self._lock = threading.Condition()
+
+    def request(self, read=0, written=0):
+        '''Count a request and wait for it.'''
+        if not self.online:
+            raise ConnectionRefusedError('Memory backend is offline')
+        with self._lock:
+            self.requests += 1
+            self.bytes_read += read
+            self.bytes_written += written
+        delay = self.latency
+        if self.bandwidth:
+            delay += (read + written) / self.bandwidth
+        if delay:
+            self.sleep(delay)
+
+    def _store(self, path, data):
+        with self._lock:
+            self.files[path] = data
+            self.mtimes[path] = time.time()
+
+    def cache_key(self, path):
+        return self.name and ('memory', self.name, path)
+
+    def stat(self, path):
+        self.request()
+        return self._stat(path)
+
+    def _stat(self, path, digest=False):
+        with self._lock:
+            data = self.files.get(path)
+            mtime = self.mtimes.get(path)
+        if data is None:
+            return None
+        return FileStat(mtime, mtime, len(data),
+                        digest and hashlib.sha256(data).hexdigest() or None)
+
+    def read(self, path, size=None):
+        def open_remote():
+            self.request()
+            data = self.files.get(path)
+            if data is None:
+                raise FileNotFoundError(path)
+            return _MemoryRemoteFile(self, data)
+        return ReadAheadFile(open_remote, size)
+
+    def write(self, path):
+        self.request()
+        return _MemoryWriteFile(self, path, b'', pipelined=True)
+
+    def update(self, path):
+        self.request()
+        data = self.files.get(path)
+        if data is None:
+            raise FileNotFoundError(path)
+        return _MemoryWriteFile(self, path, data, pipelined=False)
+
+    def replace(self, source, path):
+        self.request()
+        with self._lock:
+            self.files[path] = self.files.pop(source)
+            self.mtimes[path] = self.mtimes.pop(source)
+
+    def remove(self, path):
+        self.request()
+        with self._lock:
+            self.files.pop(path, None)
+            self.mtimes.pop(path, None)
+
+    def lock(self, path, exclusive=True, timeout=LOCK_TIMEOUT, digest=False):
+        self.request()
+        holder = f'{identity()}/{threading.current_thread().name}'
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                holders = self._locks.setdefault(path, [])
+                if not holders or not (exclusive or
+                                       any(held for _, held in holders)):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LockError(
+                        ' '.join(name for name, _ in holders))
+                self._lock.wait(remaining)
+            holders.append((holder, exclusive))
+        return Lease(path, exclusive, self._stat(path, digest),
+                     (holder, exclusive))
+
+    def unlock(self, lease):
+        with self._lock:
+            self._locks[lease.path].remove(lease.handle)
+            self._lock.notify_all()
+
+    def holders(self, path):
+        '''Who holds the lock of path.'''
+        with self._lock:
+            return [name for name, _ in self._locks.get(path, ())]
+
+
+class _MemoryRemoteFile():
+    '''Open file of a MemoryBackend, with the calls of an sftp file.'''
+    def __init__(self, backend, data):
+        self._backend = backend
+        self._data = data
+        self._position = 0
+
+    def read(self, size=None):
+        end = len(self._data) if size is None else self._position + size
+        data = self._data[self._position:end]
+        self._position += len(data)
+        self._backend.request(read=len(data))
+        return data
+
+    def readv(self, chunks):
+        data = [self._data[offset:offset + size] for offset, size in chunks]
+        self._backend.request(read=sum(len(chunk) for chunk in data))
+        return data
+
+    def seek(self, position):
+        self._position = position
+
+    def prefetch(self, size=None):
+        # Pipelined, the following read is one request.
+        pass
+
+    def close(self):
+        pass
+
+
+class _MemoryWriteFile(io.BytesIO):
+    '''
+    File being written to a MemoryBackend, stored on close.
+    Pipelined writes are one request on close, others one request each.
+    '''
+    def __init__(self, backend, path, data, pipelined):
+        super().__init__(data)
+        self._backend = backend
+        self._path = path
+        self._pipelined = pipelined
+        self._pending = 0
+
+    def write(self, data):
+        if self._pipelined:
+            self._pending += len(data)
+        else:
+            self._backend.request(written=len(data))
+        return super().write(data)
+
+    def close(self):
+        if not self.closed:
+            if self._pending:
+                self._backend.request(written=self._pending)
+            self._backend._store(self._path, self.getvalue())
+        super().close()
@@ -0,0 +1,291 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+'''
+Column store for vault records.
+Each field of the records is kept in its own column, uids as bytes, dates
+as int64 microseconds and flags in one byte, system and user names are
+shared between records. Records are created from the columns when they are
+accessed and are not kept.
+Anything not in the current record layout is kept as is.
+'''
+import array
+import collections.abc
+import datetime
+import operator
+import uuid
+
+from . import codec
+from . import search
+
+FIELDS = codec.FIELDS
+DELETED_FLAG = codec.DELETED_FLAG
+NO_DATE_FLAG = codec.NO_DATE_FLAG
+# Row is a placeholder without content, see envelope.SealedRecords.
+EMPTY_FLAG = 4
+_MICRO = datetime.timedelta(microseconds=1)
+STRING_COLUMNS = {'system': '_systems',
+                  'user': '_users',
+                  'password': '_passwords',
+                  'notes': '_notes'}
+
+
+class Record(tuple):
+    '''Record as a tuple, with fields by name as well as by position.'''
+    __slots__ = ()
+
+
+for _position, _name in enumerate(FIELDS):
+    setattr(Record, _name, property(operator.itemgetter(_position)))
+
+
+def record_uid(record):
+    '''Raw bytes of record uid, empty if record has none.'''
+    if isinstance(record, (tuple, list)) and record:
+        if isinstance(record[0], uuid.UUID):
+            return record[0].bytes
+    return b''
+
+
+def _field(record, position):
+    if isinstance(record, (tuple, list)) and len(record) > position:
+        return record[position]
+
+
+class RecordStore(collections.abc.MutableSequence):
+    '''List of records kept in columns.'''
+    def __init__(self, records=()):
+        self._uids = []
+        self._dates = array.array('q')
+        self._flags = bytearray()
+        self._systems = []
+        self._users = []
+        self._passwords = []
+        self._notes = []
+        # Records not in the current layout, None for all others.
+        self._other = []
+        self._strings = {}
+        # Uid to position, rebuilt on lookup after removals and moves.
+        self._index = None
+        # Search index, built on first search.
+        self._search = None
+        self.extend(records)
+
+    def _columns(self):
+        return (self._uids, self._dates, self._flags, self._systems,
+                self._users, self._passwords, self._notes, self._other)
+
+    def _row(self, record):
+        '''Column values of record.'''
+        if (not codec.is_record(record) or
+                (record[1] and record[1].tzinfo)):
+            return (record_uid(record), 0, 0, '', '', '', '', record)
+        uid, date, system, user, password, notes, deleted = record
+        flags = DELETED_FLAG if deleted else 0
+        if date:
+            micros = (date - codec.EPOCH) // _MICRO
+        else:
+            micros = 0
+            flags |= NO_DATE_FLAG
+        share = self._strings.setdefault
+        return (uid.bytes, micros, flags, share(system, system),
+                share(user, user), password, notes, None)
+
+    @staticmethod
+    def _empty_row(uid):
+        return (uid, 0, EMPTY_FLAG, '', '', '', '', None)
+
+    def _record(self, index):
+        other = self._other[index]
+        if other is not None:
+            return other
+        flags = self._flags[index]
+        return Record((
+            codec.new_uuid(int.from_bytes(self._uids[index], 'big')),
+            ('' if flags & NO_DATE_FLAG else
+             codec.EPOCH + self._dates[index] * _MICRO),
+            self._systems[index],
+            self._users[index],
+            self._passwords[index],
+            self._notes[index],
+            flags & DELETED_FLAG == DELETED_FLAG))
+
+    def _set_row(self, index, row):
+        for column, value in zip(self._columns(), row):
+            column[index] = value
+
+    def _insert_row(self, index, row):
+        for column, value in zip(self._columns(), row):
+            column.insert(index, value)
+
+    def _take(self, order):
+        '''Keep rows at positions in order, in that order.'''
+        self._uids = [self._uids[index] for index in order]
+        self._dates = array.array('q', [self._dates[index] for
+                                        index in order])
+        self._flags = bytearray([self._flags[index] for index in order])
+        self._systems = [self._systems[index] for index in order]
+        self._users = [self._users[index] for index in order]
+        self._passwords = [self._passwords[index] for index in order]
+        self._notes = [self._notes[index] for index in order]
+        self._other = [self._other[index] for index in order]
+
+    def copy(self):
+        '''Copy of store, changes to one of them do not show in the other.'''
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other._take(range(len(self)))
+        other._strings = dict(self._strings)
+        other._index = None
+        other._search = None
+        return other
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._record(index)
+
+    def __setitem__(self, index, record):
+        if isinstance(index, slice):
+            raise TypeError('Slice assignment not supported')
+        row = self._row(record)
+        old_uid = self._uids[index]
+        if row[0] != old_uid:
+            self._index = None
+        self._set_row(index, row)
+        self._reindex(old_uid, record)
+
+    def __delitem__(self, index):
+        index = range(len(self))[index]
+        old_uid = self._uids[index]
+        for column in self._columns():
+            del column[index]
+        self._unindex(index, old_uid)
+        self._reindex(old_uid, None)
+
+    def delete(self, indices):
+        '''Remove records at positions in indices, in one pass.'''
+        drop = set(indices)
+        if not drop:
+            return
+        for index in drop:
+            self._reindex(self._uids[index], None)
+        self._take([index for index in range(len(self)) if index not in drop])
+        # Rebuilt once, on next find.
+        self._index = None
+
+    def __iter__(self):
+        # Same as _record, with lookups moved out of the loop.
+        new = object.__new__
+        UUID = uuid.UUID
+        set_int = codec._set_int
+        set_is_safe = codec._set_is_safe
+        unknown = uuid.SafeUUID.unknown
+        from_bytes = int.from_bytes
+        epoch = codec.EPOCH
+        micro = _MICRO
+        make = tuple.__new__
+        for (uid, micros, flags, system, user, password, notes,
+             other) in zip(*self._columns()):
+            if other is not None:
+                yield other
+                continue
+            uuid_obj = new(UUID)
+            set_int(uuid_obj, from_bytes(uid, 'big'))
+            set_is_safe(uuid_obj, unknown)
+            yield make(Record,
+                       (uuid_obj,
+                        '' if flags & NO_DATE_FLAG else epoch + micros * micro,
+                        system,
+                        user,
+                        password,
+                        notes,
+                        flags & DELETED_FLAG == DELETED_FLAG))
+
+    def insert(self, index, record):
+        if index < len(self):
+            self._index = None
+        row = self._row(record)
+        self._add_to_index(row[0])
+        self._insert_row(index, row)
+        self._reindex(b'', record)
+
+    def _add_to_index(self, uid):
+        # Only called before appending.
+        if self._index is not None and uid:
+            self._index.setdefault(uid, len(self._uids))
+
+    def _unindex(self, index, uid):
+        '''Fix up uid index after row at index, holding uid, is deleted.'''
+        if self._index is None:
+            return
+        first = self._index.get(uid) == index
+        if first:
+            del self._index[uid]
+        if index < len(self._uids):
+            for key, position in self._index.items():
+                if position > index:
+                    self._index[key] = position - 1
+            if first and uid in self._uids:
+                # A later record with the same uid is found instead.
+                self._index[uid] = self._uids.index(uid, index)
+
+    def _reindex(self, old_uid, record):
+        if self._search is not None:
+            if old_uid:
+                self._search.remove(old_uid)
+            if record is not None:
+                self._search.add(record)
+
+    def find(self, uid):
+        '''Index of first record with uid, None if missing.'''
+        if not uid:
+            return None
+        if self._index is None:
+            self._index = {}
+            for index, current in enumerate(self._uids):
+                if current:
+                    self._index.setdefault(current, index)
+        return self._index.get(uid)
+
+    def search(self, query, limit=search.DEFAULT_LIMIT):
+        '''
+        Records matching query on system, user or notes, best match first.
+        Deleted records are not included.
+        '''
+        if self._search is None:
+            self._search = search.SearchIndex(self)
+        return [self[self.find(uid)] for
+                uid in self._search.search(query, limit)]
+
+    def column(self, name):
+        '''Values of one field for all records, as a new list.'''
+        position = FIELDS.index(name)
+        if name in STRING_COLUMNS:
+            values = list(getattr(self, STRING_COLUMNS[name]))
+        elif name == 'deleted':
+            values = [flags & DELETED_FLAG == DELETED_FLAG for
+                      flags in self._flags]
+        else:
+            return [_field(record, position) for record in self]
+        if self._other.count(None) != len(self._other):
+            for index, other in enumerate(self._other):
+                if other is not None:
+                    values[index] = _field(other, position)
+        return values
@@ -18,7 +18,10 @@
 """Encrypts and decrypts data."""
 import ast
 import base64
+import copy
 import datetime
+import functools
+import io
 import os
 import pickle
 import random
@@ -27,17 +30,29 @@ import uuid
 
 from cryptography.fernet import Fernet
 from cryptography.fernet import InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from .helpers import cache
+from .helpers import container
+from .helpers import envelope
+from .helpers import instrument
+from .helpers import journal
+from .helpers import kdf
+from .helpers import keycache
+from .helpers import replicas
 from .helpers import ssh
 from .helpers import steganography
+from .helpers import storage
+from .helpers.legacy_load import safe_loads
 from .helpers import version
-from .constants import VERSION, KEEP_DAYS
+from .constants import VERSION, KEEP_DAYS, KEY_CACHE_TTL
+from .constants import JOURNAL_MAX_SIZE, JOURNAL_MAX_DAYS
 from .constants import UUID, DATE, SYSTEM, USER, PASSWORD, NOTES, DELETED
 
 
+# Header fields that journal entries can not change.
+HEADER_KEYS = ('kdf', 'iterations', 'salt', 'dek')
+
+
 class VaultError(Exception):
     """Vault related errors."""
     pass
@@ -49,20 +64,69 @@ class Vault:
                  data_path=None,
                  ssh_params=None,
                  path_to_original=None,
-                 update=True):
+                 update=True,
+                 cache_key=True,
+                 key_derivation=None,
+                 use_journal=True,
+                 progress=None,
+                 use_cache=True,
+                 backend=None,
+                 quorum=None,
+                 stego_mode=steganography.DEFAULT_MODE):
         self._locked = False
+        # Storage backend for all files, when None it is local files or
+        # sftp if there are ssh_params. A list of backends (or of
+        # ssh_params) are replicas, see helpers.replicas.
+        self.backend = backend
+        # Replicas that have to acknowledge a save, a majority when None.
+        self.quorum = quorum
+        # Called with the name of each slow phase (kdf, transfer, stego,
+        # decode, decrypt) as it starts, it may raise to abort.
+        # It is never called while a file is open for writing.
+        self.progress = progress
+        # Remote files are kept in a local cache, see helpers.cache.
+        self.use_cache = use_cache
+        # True if loaded from cache as the remote could not be reached.
+        self.offline = False
         # When loaded from local file do not update.
         self.update = update
+        self.key_cache = keycache.KeyCache(KEY_CACHE_TTL, cache_key)
+        # Save appends changes to the file instead of rewriting it.
+        self.use_journal = use_journal
+        # Density of data in steganography image, see
+        # steganography.MODES. Load reads it from the image.
+        self.stego_mode = stego_mode
+        # Journal entries not yet saved, None when a snapshot is needed.
+        self._pending = None
+        # Sealed records as they are in file at data['digest'], the base
+        # for delta sync. None if the file can not be synced by delta.
+        self._synced = None
+        # Header fields as they are in file, see HEADER_KEYS. Entries are
+        # only appended if they are unchanged.
+        self._file_header = None
 
         if data_path:
             self.load(data_path, ssh_params, path_to_original)
         else:
+            key_derivation = key_derivation or kdf.PBKDF2()
             self.data = {'salt': os.urandom(16),
-                         'iterations': 1000000,
+                         'kdf': key_derivation.to_dict(),
                          'vault': [],
                          'timestamp': datetime.datetime.utcnow(),
                          'version': VERSION}
 
+    def copy(self):
+        """
+        Copy that can be changed, e.g. synced in the background, while this
+        one is in use. Records are copied, settings and caches are shared.
+        """
+        other = copy.copy(self)
+        other.data = dict(self.data)
+        other.data['vault'] = self.data['vault'].copy()
+        if self._pending is not None:
+            other._pending = list(self._pending)
+        return other
+
     @property
     def locked(self):
         """Locked status of the vault"""
@@ -72,19 +136,167 @@ class Vault:
     def timestamp(self):
         return self.data.get('timestamp')
 
-    def _open(self, file_path, ssh_params, path_to_original, mode, call):
+    @property
+    def needs_compaction(self):
+        """True if the journal in file should be folded in to a snapshot."""
+        if not self.data.get('journal_size'):
+            return False
+        if self.data['journal_size'] > JOURNAL_MAX_SIZE:
+            return True
+        snapshot = container.from_micros(self.data.get('snapshot'))
+        max_age = datetime.timedelta(days=JOURNAL_MAX_DAYS)
+        return not snapshot or snapshot + max_age < datetime.datetime.utcnow()
+
+    def _progress(self, phase):
+        if self.progress:
+            self.progress(phase)
+
+    def _backends(self, ssh_params):
+        """Backend of each replica."""
+        if isinstance(self.backend, (list, tuple)):
+            return list(self.backend)
+        if self.backend:
+            return [self.backend]
+        if isinstance(ssh_params, (list, tuple)):
+            return [ssh.SFTPBackend(params) for params in ssh_params]
         if ssh_params:
-            with ssh.RemoteFile(ssh_params, file_path, mode) as fh:
-                if not fh:
-                    raise VaultError('Could not acquire lock')
-                return call(fh, path_to_original)
+            return [ssh.SFTPBackend(ssh_params)]
+        return [storage.LocalBackend()]
+
+    def _open(self, file_path, ssh_params, path_to_original, mode, call):
+        self._progress('transfer')
+        backends = self._backends(ssh_params)
+        if len(backends) == 1:
+            backend = backends[0]
+        elif mode == 'rb':
+            backend = self._freshest(backends, file_path, path_to_original)
         else:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, mode) as fh:
-                return call(fh, path_to_original)
+            raise VaultError('Replicas are only written by save')
+        return self._on_replica(
+            backend, file_path, path_to_original, mode, call)
+
+    def _on_replica(self, backend, file_path, path_to_original, mode, call):
+        try:
+            return self._open_stored(
+                backend, file_path, path_to_original, mode, call)
+        finally:
+            backend.close()
+
+    def _freshest(self, backends, file_path, path_to_original):
+        """
+        Replica with the newest file among the first read quorum to
+        answer, the first of them if several are as new.
+        """
+        def probe(fh, path_to_original):
+            if path_to_original:
+                prefix = steganography.read(io.BytesIO(fh.read()),
+                                            path_to_original,
+                                            container.PREFIX.size)
+            else:
+                prefix = fh.read(container.PREFIX.size)
+            probe = self._probe(prefix)
+            return probe and probe['timestamp']
+        calls = [functools.partial(self._on_replica, backend, file_path,
+                                   path_to_original, 'rb', probe) for
+                 backend in backends]
+        try:
+            answers = replicas.first(
+                calls, replicas.read_quorum(len(backends), self.quorum))
+        except replicas.QuorumError as err:
+            if not err.results:
+                raise err.errors[0]
+            # Better the newest that can be read than nothing.
+            answers = err.results
+        index, _ = max(answers,
+                       key=lambda answer: answer[1] or datetime.datetime.min)
+        return backends[index]
+
+    def _open_stored(self, backend, file_path, path_to_original, mode,
+                     call):
+        cache_key = self.use_cache and backend.cache_key(file_path)
+        try:
+            stored = storage.StoredFile(
+                backend, file_path, mode,
+                digest=bool(cache_key) and mode == 'rb')
+        except storage.LockError as err:
+            raise VaultError(err)
+        with stored as fh:
+            if not cache_key:
+                return self._call(fh, path_to_original, mode, call)
+            if mode == 'rb':
+                cached = stored.stat and cache.get(cache_key, stored.stat)
+                if cached is not None:
+                    # Unchanged since last read or write, file not opened.
+                    with instrument.span('vault.cache'):
+                        return self._call(io.BytesIO(cached),
+                                          path_to_original, mode, call)
+                result = self._call(fh, path_to_original, mode, call)
+                data = fh.getvalue()
+                if data is not None and stored.stat:
+                    cache.put(cache_key, data)
+                return result
+            cache.discard(cache_key)
+            if mode != 'wb':
+                return self._call(fh, path_to_original, mode, call)
+            buffer = io.BytesIO()
+            result = self._call(buffer, path_to_original, mode, call)
+            fh.write(buffer.getvalue())
+        # Only cached once the file has been moved in place.
+        cache.put(cache_key, buffer.getvalue())
+        return result
+
+    def _load_cached(self, file_path, ssh_params, read, path_to_original):
+        """Read cached copy of remote file, False if there is none."""
+        for backend in self._backends(ssh_params):
+            cache_key = backend.cache_key(file_path)
+            data = self.use_cache and cache_key and cache.get(cache_key)
+            if data:
+                read(io.BytesIO(data), path_to_original)
+                return True
+        return False
+
+    @staticmethod
+    def _call(fh, path_to_original, mode, call):
+        with instrument.span('vault.io', mode=mode) as span:
+            result = call(fh, path_to_original)
+            try:
+                span.add_bytes(fh.tell())
+            except (OSError, ValueError):
+                pass
+            return result
+
+    @property
+    def key_derivation(self):
+        """Key derivation function used by the vault."""
+        return kdf.from_header(self.data)
+
+    def set_kdf(self, key_derivation):
+        """
+        Change key derivation function, takes effect on next lock.
+        Vault has to be unlocked as the content is encrypted with the old key.
+        """
+        if self.locked:
+            raise VaultError('Vault is locked, unlock first!')
+        self.data['kdf'] = key_derivation.to_dict()
+        self.data.pop('iterations', None)
+        # Header changes, journal entries can not hold that.
+        self._pending = None
+
+    def calibrate_kdf(self, name=kdf.PBKDF2.name, target=kdf.DEFAULT_TARGET):
+        """Pick KDF parameters so unlock takes about target seconds here."""
+        key_derivation = kdf.calibrate(name, target)
+        self.set_kdf(key_derivation)
+        return key_derivation
 
-    def force_lock(self, ssh_params):
-        ssh.force_lock(**ssh_params)
+    def break_lock(self, ssh_params):
+        """Break stale remote locks, returns who held them."""
+        holders = []
+        for backend in self._backends(ssh_params):
+            try:
+                holders.extend(backend.break_lock())
+            finally:
+                backend.close()
+        return holders
 
     def update_version(self, password):
         if not self.update:
@@ -124,16 +336,41 @@ class Vault:
                     if isinstance(record[1], str) and record[1]:
                         record[1] = datetime.datetime.fromisoformat(record[1])
             self.data['vault'][index] = tuple(record)
+        if version.is_greater_version('1.2.0', current_version):
+            self.set_kdf(kdf.from_header(self.data))
         if lock_status:
             self.lock(password)
         return True
 
     def check_remote(self, file_path, ssh_params, path_to_original):
+        """
+        Get remote data if it is newer than vault.
+        Only the fixed size prefix of the remote file is parsed unless
+        the remote has changed. If journal entries have been appended
+        since last load or save only those are read, and returned as
+        data with a delta, see merge.
+        """
         def check(fh, path_to_original):
             if path_to_original:
-                data = pickle.loads(steganography.read(fh, path_to_original))
+                raw = io.BytesIO(fh.read())
+                prefix = steganography.read(
+                    raw, path_to_original, container.PREFIX.size)
+                probe = self._probe(prefix)
+
+                def read_all():
+                    raw.seek(0)
+                    return self._read(raw, path_to_original)
             else:
-                data = pickle.load(fh)
+                prefix = fh.read(container.PREFIX.size)
+                probe = self._probe(prefix)
+
+                def read_all():
+                    try:
+                        return container.read(fh, probe, prefix)
+                    except container.ContainerError as err:
+                        raise VaultError(err)
+            # Files from before the container have no prefix.
+            data = probe or read_all()
             remote_ts = data.get('timestamp')
             remote_ver = data.get('version')
             local_ts = self.data.get('timestamp')
@@ -144,54 +381,393 @@ class Vault:
                     version.same_minor_version(remote_ver, local_ver)):
                 raise VaultError(
                     f'Version missmatch: {remote_ver=}, {local_ver=}')
+            if probe and probe['digest'] == self.data.get('digest'):
+                # Same content as last loaded or saved.
+                return
+            delta = (probe and
+                     not path_to_original and
+                     self._synced is not None and
+                     container.read_tail(fh,
+                                         probe,
+                                         self.data['digest'],
+                                         self.data['length']))
+            if delta:
+                # Merged by record dates, so also when older than vault.
+                return {**probe, 'delta': delta}
             if remote_ts and local_ts and remote_ts > local_ts:
-                return data
-        return self._open(file_path, ssh_params, path_to_original, 'rb', check)
+                return read_all() if probe else data
+        with instrument.span('vault.check_remote'):
+            return self._open(
+                file_path, ssh_params, path_to_original, 'rb', check)
+
+    @staticmethod
+    def _probe(prefix):
+        try:
+            return container.parse_probe(prefix)
+        except container.ContainerError as err:
+            raise VaultError(err)
 
     def merge(self, password, data, file_path, ssh_params, path_to_original):
-        self.unlock(password)
+        """
+        Merge newer remote data in to vault and save it.
+        Records with the same ciphertext on both sides are never decrypted.
+        """
+        if 'delta' in data:
+            return self._merge_delta(
+                password, data, file_path, ssh_params, path_to_original)
+        lock_status = self.locked
+        if not self.unlock(password):
+            raise VaultError('Could not unlock vault')
         data = self._unlock(password, data)
-        updated = False
-        current = {obj[UUID]: obj for obj in self.data['vault']}
-        for obj in data:
-            obj_id = obj[UUID]
-            if obj_id not in current:
-                self.add(obj)
-                updated = True
+        if not data:
+            raise VaultError('Could not unlock remote vault')
+        records = self._records()
+        remote = data['vault']
+        changed = []
+        for index in range(len(remote)):
+            uid = remote.uid(index)
+            if not uid:
+                continue
+            local_index = records.find(uid)
+            if local_index is None:
+                changed.append(remote[index])
+            elif remote.sealed(index) == records.sealed(local_index):
+                continue
             # Checking date.
-            elif obj[DATE] > current[obj_id][DATE]:
-                self.replace(obj)
-                updated = True
+            elif remote[index][DATE] > records[local_index][DATE]:
+                changed.append(remote[index])
+        updated = bool(self.upsert(changed))
         updated = self.remove_deleted() or updated
         self.lock(password)
         if updated:
             self.save(file_path, ssh_params, path_to_original)
+        if not lock_status:
+            self.unlock(password)
+
+    def _merge_delta(self, password, data, file_path, ssh_params,
+                     path_to_original):
+        """
+        Merge journal entries appended to remote since last sync and append
+        the local changes, only records that differ are decrypted and sent.
+        Remote records changed since last sync win over records unchanged
+        here, otherwise the newest one wins.
+        """
+        lock_status = self.locked
+        if not self.unlock(password):
+            raise VaultError('Could not unlock vault')
+        records = self._records()
+        try:
+            remote, seal = journal.apply(self._synced, data['delta'])
+            envelope.verify_seal(records.data_key, remote, seal)
+        except (envelope.EnvelopeError, journal.JournalError) as err:
+            raise VaultError(f'Vault has been tampered with: {err}')
+        synced = dict(self._synced)
+        changed = envelope.SealedRecords(
+            records.data_key,
+            [(uid, ciphertext) for uid, ciphertext in remote if
+             synced.get(uid) != ciphertext])
+        for index in range(len(changed)):
+            uid = changed.uid(index)
+            local_index = records.find(uid)
+            if (local_index is None or
+                    records.sealed(local_index) == synced.get(uid) or
+                    changed[index][DATE] > records[local_index][DATE]):
+                # Ciphertext is kept so it is not sent back.
+                records.put_sealed(uid, changed.sealed(index))
+        current = dict(remote)
+        removed = []
+        for uid, ciphertext in self._synced:
+            index = records.find(uid)
+            if (uid not in current and
+                    index is not None and
+                    records.sealed(index) == ciphertext):
+                removed.append(index)
+        records.delete(removed)
+        self.remove_deleted()
+        records.reorder(journal.replay_order(
+            [uid for uid, _ in remote],
+            [records.uid(index) for index in range(len(records))]))
+        journaled = self.use_journal and journal.can_journal(records)
+        self._pending = None
+        self.lock(password)
+        self.data['journal_size'] += data['length'] - self.data['length']
+        self.data['digest'] = data['digest']
+        self.data['length'] = data['length']
+        self._synced = remote
+        self._pending = [] if journaled else None
+        if self.data['vault'] != remote:
+            if journaled:
+                self._pending = journal.diff(remote, self.data['vault'])
+                self._pending.append((journal.SEAL, b'', self.data['seal']))
+            self.save(file_path, ssh_params, path_to_original)
+        if not lock_status:
+            self.unlock(password)
 
     def load(self, file_path, ssh_params=None, path_to_original=None):
         def read(fh, path_to_original):
-            if path_to_original:
-                data = pickle.loads(
-                    steganography.read(fh, path_to_original))
-            else:
-                data = pickle.load(fh)
+            data = self._read(fh, path_to_original)
             # Loaded data has a version that is higher than program.
-            if version.is_greater_version(data['version'], VERSION):
+            if (data.get('version') and
+                    version.is_greater_version(data['version'], VERSION)):
                 raise VaultError(f'Version missmatch: Please update Vault to latest version.')
             else:
                 self.data = data
-        self._open(file_path, ssh_params, path_to_original, 'rb', read)
+                self._synced = self._file_records(data)
+                self._file_header = self._header(data)
+        with instrument.span('vault.load'):
+            try:
+                self._open(
+                    file_path, ssh_params, path_to_original, 'rb', read)
+                self.offline = False
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # Remote could not be reached, use the last copy of it.
+                if not self._load_cached(
+                        file_path, ssh_params, read, path_to_original):
+                    raise
+                self.offline = True
         self._locked = True
+        self._pending = []
 
     def save(self, file_path, ssh_params=None, path_to_original=None):
-        def write(fh, path_to_original):
-            if path_to_original:
-                steganography.write(
-                    fh, path_to_original, pickle.dumps(self.data))
-            else:
-                fh.write(pickle.dumps(self.data))
+        """
+        Save locked vault to file.
+        With use_journal changes since last load or save are appended to
+        the file if it has not been changed by someone else.
+        """
+        with instrument.span('vault.save'):
+            self._save(file_path, ssh_params, path_to_original)
+
+    def _save(self, file_path, ssh_params, path_to_original):
+        if isinstance(self.data['vault'], envelope.SealedRecords):
+            raise VaultError('Vault is unlocked, lock before saving!')
+        backends = self._backends(ssh_params)
+        if len(backends) > 1:
+            return self._save_replicas(backends, file_path, path_to_original)
+        batch = self._batch(path_to_original)
+        if batch:
+            timestamp = datetime.datetime.utcnow()
+            try:
+                if self._open(file_path, ssh_params, path_to_original, 'r+b',
+                              lambda fh, _: self._append(
+                                  fh, timestamp, *batch)):
+                    return
+            except FileNotFoundError:
+                pass
+
         self.data['timestamp'] = datetime.datetime.utcnow()
         self.data['version'] = VERSION
+        image = None
+        if path_to_original:
+            # Encoded before the file is opened, so it is not held open
+            # (and locked) while the image is made.
+            self._progress('stego')
+            buffer = io.BytesIO()
+            self._write(buffer)
+            image = io.BytesIO()
+            steganography.write(image, path_to_original, buffer.getvalue(),
+                                self.stego_mode)
+
+        def write(fh, path_to_original):
+            if image:
+                fh.write(image.getvalue())
+            else:
+                self._write(fh)
         self._open(file_path, ssh_params, path_to_original, 'wb', write)
+        self._pending = []
+
+    def compact(self, file_path, ssh_params=None, path_to_original=None):
+        """Save locked vault as a new snapshot, dropping the journal."""
+        self._pending = None
+        self.save(file_path, ssh_params, path_to_original)
+
+    def synced_copy(self, password, file_path, ssh_params=None,
+                    path_to_original=None):
+        """
+        Copy of vault with newer remote data merged in and the journal
+        compacted if due, returned with True if anything was merged.
+        None if there is nothing to do. The vault itself is not changed,
+        the copy is locked if the vault is.
+        """
+        params = (file_path, ssh_params, path_to_original)
+        data = self.check_remote(*params)
+        if not data and not self.needs_compaction:
+            return None
+        synced = self.copy()
+        if data:
+            synced.merge(password, data, *params)
+        if synced.needs_compaction:
+            # Fold journal in to a new snapshot.
+            locked = synced.locked
+            synced.lock(password)
+            synced.compact(*params)
+            if not locked:
+                synced.unlock(password)
+        return synced, bool(data)
+
+    def _save_replicas(self, backends, file_path, path_to_original):
+        """
+        Save to all replicas in parallel, done once a write quorum has it.
+        Replicas with the same file as the vault get the journal appended,
+        the others a snapshot.
+        """
+        timestamp = datetime.datetime.utcnow()
+        # Replicas still being written after the quorum is reached must
+        # not see later changes to the vault.
+        batch = self._batch(path_to_original)
+        content, digest, length = self._snapshot(timestamp, path_to_original)
+        self._progress('transfer')
+
+        def put(backend):
+            if batch:
+                try:
+                    appended = self._on_replica(
+                        backend, file_path, None, 'r+b',
+                        lambda fh, _: self._append_entries(
+                            fh, timestamp, *batch))
+                except FileNotFoundError:
+                    appended = None
+                if appended:
+                    return appended
+            self._on_replica(backend, file_path, path_to_original, 'wb',
+                             lambda fh, _: fh.write(content))
+        quorum = replicas.write_quorum(len(backends), self.quorum)
+        try:
+            results = replicas.first(
+                [functools.partial(put, backend) for backend in backends],
+                quorum)
+        except replicas.QuorumError as err:
+            raise VaultError(f'Save failed on replicas: {err}')
+        appended = [result for _, result in results if result]
+        if appended:
+            self._appended(*appended[0], timestamp)
+            return
+        self.data['timestamp'] = timestamp
+        self.data['version'] = VERSION
+        if digest:
+            self.data['digest'] = digest
+            self.data['length'] = length
+            self.data['snapshot'] = container.to_micros(timestamp)
+            self.data['journal_size'] = 0
+        self._synced = self._file_records(self.data)
+        self._file_header = self._header(self.data)
+        self._pending = []
+
+    def _snapshot(self, timestamp, path_to_original):
+        """
+        Content of a new snapshot file made at timestamp, and its digest
+        and length (None if not a container).
+        """
+        data = dict(self.data, timestamp=timestamp, version=VERSION)
+        buffer = io.BytesIO()
+        digest = length = None
+        if container.is_container(data):
+            with instrument.span('vault.encode') as span:
+                digest, length = container.write(buffer, data)
+                span.add_bytes(length)
+        else:
+            buffer.write(pickle.dumps(data))
+        content = buffer.getvalue()
+        if path_to_original:
+            self._progress('stego')
+            image = io.BytesIO()
+            steganography.write(image, path_to_original, content,
+                                self.stego_mode)
+            content = image.getvalue()
+        return content, digest, length
+
+    def _batch(self, path_to_original):
+        """
+        Pending entries and the digest and length the file has to have for
+        them to be appended, None if a snapshot has to be saved.
+        """
+        if (not self.use_journal or
+                self._pending is None or
+                path_to_original or
+                not self.data.get('length') or
+                self._header(self.data) != self._file_header):
+            return None
+        return list(self._pending), self.data['digest'], self.data['length']
+
+    def _append(self, fh, timestamp, entries, digest, length):
+        appended = self._append_entries(
+            fh, timestamp, entries, digest, length)
+        if not appended:
+            return False
+        self._appended(*appended, timestamp)
+        return True
+
+    @staticmethod
+    def _append_entries(fh, timestamp, entries, digest, length):
+        """
+        Append entries if file has digest and length, i.e. is the one last
+        loaded or saved. Returns new digest and length, None if not
+        appended.
+        """
+        try:
+            probe, _ = container.read_probe(fh)
+        except container.ContainerError:
+            return None
+        if (not probe or
+                probe['digest'] != digest or
+                probe['length'] != length):
+            # Changed by someone else, the snapshot wins.
+            return None
+        return container.append(fh, probe, entries, timestamp, VERSION)
+
+    def _appended(self, digest, length, timestamp):
+        self.data['digest'] = digest
+        self.data['journal_size'] += length - self.data['length']
+        self.data['length'] = length
+        self.data['timestamp'] = timestamp
+        self.data['version'] = VERSION
+        self._pending = []
+        self._synced = self.data['vault']
+
+    @staticmethod
+    def _header(data):
+        """Fields of data that are only written with a snapshot."""
+        return {key: data.get(key) for key in HEADER_KEYS}
+
+    @staticmethod
+    def _file_records(data):
+        """Sealed records of read data after its journal, or None."""
+        if not data.get('digest'):
+            return None
+        try:
+            return journal.apply(data['vault'], data.get('journal', ()))[0]
+        except journal.JournalError:
+            return None
+
+    def _read(self, fh, path_to_original):
+        if path_to_original:
+            self._progress('stego')
+            fh = io.BytesIO(steganography.read(fh, path_to_original))
+        self._progress('decode')
+        with instrument.span('vault.decode') as span:
+            try:
+                data = container.read(fh)
+            except container.ContainerError as err:
+                raise VaultError(err)
+            span.add_bytes(data.get('length') or 0)
+            return data
+
+    def _write(self, fh):
+        if container.is_container(self.data):
+            with instrument.span('vault.encode') as span:
+                self.data['digest'], self.data['length'] = container.write(
+                    fh, self.data)
+                span.add_bytes(self.data['length'])
+            self.data['snapshot'] = container.to_micros(
+                self.data['timestamp'])
+            self.data['journal_size'] = 0
+            self._synced = self._file_records(self.data)
+        else:
+            # Locked with a version without envelope encryption.
+            fh.write(pickle.dumps(self.data))
+            self._synced = None
+        self._file_header = self._header(self.data)
 
     def load_clear(self, fh):
         """Load data from open file containing clear text data."""
@@ -212,13 +788,43 @@ class Vault:
         """Lock vault with password."""
         if self._locked:
             return
-        data = pickle.dumps(self.data['vault'])
-        key = self.create_key(password,
-                              self.data['salt'],
-                              self.data.get('iterations', 1000000))
-        self.data['vault'] = Fernet(key).encrypt(data)
+        key = self.derive_key(password, self.data)
+        records = self._records()
+        self.data['dek'] = self._wrap_key(key, records.data_key)
+        entries = None
+        if (self.use_journal and
+                self._pending is not None and
+                journal.can_journal(records)):
+            entries = journal.changes(records)
+        # Only records changed since last lock are encrypted again.
+        with instrument.span('vault.encrypt', records=records.changed):
+            self.data['vault'] = records.seal()
+            self.data['seal'] = envelope.make_seal(
+                records.data_key, self.data['vault'])
+        # Journal is part of vault now.
+        self.data['journal'] = []
+        if entries is None:
+            self._pending = None
+        elif entries:
+            self._pending.extend(entries)
+            self._pending.append((journal.SEAL, b'', self.data['seal']))
         self._locked = True
 
+    def _wrap_key(self, key, data_key):
+        """
+        Data key wrapped with key. The wrapped key in file is kept if it
+        still is right, wrapping again would change the header.
+        """
+        header = self._file_header
+        if (header and header['dek'] and
+                self._header(dict(self.data, dek=header['dek'])) == header):
+            try:
+                if envelope.unwrap_key(key, header['dek']) == data_key:
+                    return header['dek']
+            except InvalidToken:
+                pass
+        return envelope.wrap_key(key, data_key)
+
     def unlock(self, password):
         """Unlock vault with password."""
         if not self._locked:
@@ -230,27 +836,77 @@ class Vault:
         return data
 
     def _unlock(self, password, data):
-        key = self.create_key(password,
-                              data['salt'],
-                              data.get('iterations', 1000000))
+        key = self.derive_key(password, data, remember=False)
+        self._progress('decrypt')
+        with instrument.span('vault.decrypt'):
+            records = self._open_records(key, data)
+        if records is None:
+            return
+        data['vault'] = records
+        # Only remember keys that are proven to be correct.
+        self.key_cache.put(password,
+                           data['salt'],
+                           kdf.from_header(data).cache_key(),
+                           key)
+        return data
+
+    @staticmethod
+    def _open_records(key, data):
+        """Records of locked data, None if key is wrong."""
         try:
-            data['vault'] = pickle.loads(Fernet(key).decrypt(data['vault']))
-            return data
+            if data.get('dek'):
+                data_key = envelope.unwrap_key(key, data['dek'])
+                records = envelope.SealedRecords(data_key, data['vault'])
+                seal = (journal.replay(records, data.get('journal', ())) or
+                        data.get('seal'))
+                if seal:
+                    envelope.verify_seal(data_key, records.seal(), seal)
+            else:
+                # Before envelope encryption, whole vault as one token.
+                records = envelope.SealedRecords.from_records(
+                    envelope.new_data_key(),
+                    safe_loads(Fernet(key).decrypt(data['vault'])))
         except InvalidToken:
-            pass
+            return
+        except (envelope.EnvelopeError, journal.JournalError) as err:
+            raise VaultError(f'Vault has been tampered with: {err}')
+        return records
+
+    def derive_key(self, password, data, remember=True):
+        """Get key for data, from key cache if possible."""
+        salt = data['salt']
+        key_derivation = kdf.from_header(data)
+        key = self.key_cache.get(password, salt, key_derivation.cache_key())
+        if key:
+            return key
+        self._progress('kdf')
+        with instrument.span('vault.kdf', kdf=key_derivation.name):
+            key = self.create_key(
+                password, salt, key_derivation=key_derivation)
+        if remember:
+            self.key_cache.put(
+                password, salt, key_derivation.cache_key(), key)
+        return key
+
+    def forget_key(self):
+        """Wipe cached key from memory."""
+        self.key_cache.wipe()
 
     @staticmethod
-    def create_key(password, salt, iterations=1000000):
-        """Create a key to be used."""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=iterations,
-            backend=default_backend()
-            )
-        return base64.urlsafe_b64encode(
-            kdf.derive(bytearray(password, 'utf-8')))
+    def create_key(password, salt, iterations=kdf.DEFAULT_ITERATIONS,
+                   key_derivation=None):
+        """Create a key to be used, PBKDF2 unless key_derivation is given."""
+        key_derivation = key_derivation or kdf.PBKDF2(iterations)
+        return base64.urlsafe_b64encode(key_derivation.derive(password, salt))
+
+    def _records(self):
+        """Unlocked records, as envelope encrypted records."""
+        records = self.data['vault']
+        if not isinstance(records, envelope.SealedRecords):
+            records = envelope.SealedRecords.from_records(
+                envelope.new_data_key(), records)
+            self.data['vault'] = records
+        return records
 
     def get_objects(self):
         """Get objects in their current state in vault."""
@@ -259,35 +915,82 @@ class Vault:
     def set_objects(self, objs):
         """Set vault content to input."""
         if not self.locked:
-            self.data['vault'] = []
-            for obj in objs:
-                self.add(obj)
+            # Unchanged records keep their ciphertext.
+            self._records().assign(objs)
+            self.data['timestamp'] = datetime.datetime.utcnow()
+
+    def get(self, uid):
+        """Record with uid, a UUID or its bytes. None if missing."""
+        if self.locked:
+            raise VaultError('Vault is locked, unlock first!')
+        records = self._records()
+        index = records.find(uid.bytes if isinstance(uid, uuid.UUID) else uid)
+        if index is not None:
+            return records[index]
+
+    def search(self, query, limit=20):
+        """
+        Records matching query on system, user or notes, best match first.
+        Matching is fuzzy, passwords are never searched.
+        """
+        if self.locked:
+            raise VaultError('Vault is locked, unlock first!')
+        return self._records().search(query, limit)
 
     def add(self, obj):
         """Add to vault content."""
-        self.data['vault'].append(obj)
+        self._records().append(obj)
         self.data['timestamp'] = datetime.datetime.utcnow()
 
     def replace(self, obj):
-        for index, current_obj in enumerate(self.data['vault']):
-            if current_obj['uid'] == obj['uid']:
-                self.data['vault'][index] = obj
-                self.data['timestamp'] = datetime.datetime.utcnow()
-                return True
+        """Replace record with the same uid as obj."""
+        records = self._records()
+        index = records.find(envelope.record_uid(obj))
+        if index is not None:
+            records[index] = obj
+            self.data['timestamp'] = datetime.datetime.utcnow()
+            return True
+
+    def upsert(self, objs):
+        """
+        Replace records with the same uid and add the rest.
+        Returns number of records added or changed.
+        """
+        if self.locked:
+            raise VaultError('Vault is locked, unlock first!')
+        records = self._records()
+        updated = 0
+        for obj in objs:
+            index = records.find(envelope.record_uid(obj))
+            if index is None:
+                records.append(obj)
+            elif tuple(records[index]) != tuple(obj):
+                records[index] = obj
+            else:
+                continue
+            updated += 1
+        if updated:
+            self.data['timestamp'] = datetime.datetime.utcnow()
+        return updated
 
     def remove_password(self, obj):
         """Remove obj from vault if it exists."""
-        self.data['vault'].remove(obj)
+        records = self._records()
+        index = records.find(envelope.record_uid(obj))
+        if index is not None and tuple(records[index]) == tuple(obj):
+            del records[index]
+        else:
+            # Records without uid.
+            records.remove(obj)
 
     def remove_deleted(self):
         now = datetime.datetime.now()
         keep = datetime.timedelta(days=KEEP_DAYS)
-        before = len(self.data['vault'])
-        self.data['vault'] = [record for record in self.data['vault']
-                              if not (record[DELETED] and
-                                      record[DATE] + keep < now)
-                              ]
-        return not before == len(self.data['vault'])
+        records = self._records()
+        removed = [index for index, record in enumerate(records)
+                   if record[DELETED] and record[DATE] + keep < now]
+        records.delete(removed)
+        return bool(removed)
 
 
 def generate_password(password_type='alpha', n=10):
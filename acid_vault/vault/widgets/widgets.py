@@ -28,6 +28,8 @@ import uuid
 
 from ..helpers.version import __version__, __author__, __email__  # noqa:F401,E501 These are actually used
 from ..helpers.version import __license__, __uri__, __summary__  # noqa:F401,E501 These are actually used
+from ..helpers.steganography import DEFAULT_MODE, MODES
+from ..helpers.steganography import SteganographyError, capacity
 from ..vault import generate_password
 from ..constants import VALID_PASSWORD_TYPES
 
@@ -38,16 +40,23 @@ DEFAULT_PROFILE = {
                     'port': '',
                     'username': '',
                     'password': '',
+                    'replicas': '',
+                    'quorum': '',
                     'clear_on_exit': True},
                 'file_config': {
                     'sync': True,
                     'file_location': '',
                     'original_file': '',
                     'use_steganography': False,
+                    'stego_mode': DEFAULT_MODE,
+                    'use_journal': True,
                     'clear_on_exit': True},
                 'last_update': None},
             'widgets': {'file_location': 'Local'}}
 
+# Checkbox texts that say more than the name of the setting.
+FILE_LABELS = {'use_journal': 'Use Journal (needed for delta sync)'}
+
 
 class Dialog(tkinter.Toplevel):
     """
@@ -303,11 +312,16 @@ class SetupSSH(Dialog):
                                             variable=self.clear_on_exit,
                                             anchor='w')
         clear_on_exit.pack(expand=1, fill=tkinter.X)
-        for key in ('host', 'port', 'username', 'password'):
+        for key, name in (('host', 'Host'),
+                          ('port', 'Port'),
+                          ('username', 'Username'),
+                          ('password', 'Password'),
+                          ('replicas', 'Replicas, user@host:port, ...'),
+                          ('quorum', 'Quorum, default majority')):
             setattr(self, key, tkinter.StringVar())
             e = LabelEntry(master,
                            width=50,
-                           label=key.title().replace('_', ' '),
+                           label=name,
                            textvariable=getattr(self, key))
             e.pack()
             if key == 'password':
@@ -321,8 +335,8 @@ class SetupSSH(Dialog):
     def apply(self):
         """Set result upon OK button press."""
         self.result = {key: getattr(self, key).get() for
-                       key in ('host', 'port', 'username',
-                               'password', 'clear_on_exit')}
+                       key in ('host', 'port', 'username', 'password',
+                               'replicas', 'quorum', 'clear_on_exit')}
 
 
 class SetupFiles(Dialog):
@@ -330,6 +344,7 @@ class SetupFiles(Dialog):
     def body(self, master, initial_data):
         # Checkboxes.
         for key, default in (('use_steganography', False),
+                             ('use_journal', True),
                              ('clear_on_exit', True),
                              ('sync', True)):
             value = initial_data.get(key, default)
@@ -337,7 +352,7 @@ class SetupFiles(Dialog):
                 self, name=key, value=value))
             c = tkinter.Checkbutton(
                 master,
-                text=key.replace('_', ' ').title(),
+                text=FILE_LABELS.get(key, key.replace('_', ' ').title()),
                 variable=getattr(self, key),
                 anchor='w')
             c.pack(expand=1, fill=tkinter.X)
@@ -357,10 +372,34 @@ class SetupFiles(Dialog):
                            textvariable=getattr(self, key))
             e.pack()
 
+        # Steganography density and how much fits in original file.
+        f = tkinter.Frame(master)
+        f.pack(fill=tkinter.X)
+        self.stego_mode = tkinter.StringVar(
+            self, value=initial_data.get('stego_mode', DEFAULT_MODE))
+        tkinter.Label(f, text='Steganography mode').pack(side='left')
+        tkinter.OptionMenu(f, self.stego_mode, *MODES).pack(side='left')
+        self.capacity = tkinter.Label(f)
+        self.capacity.pack(side='left')
+        self.stego_mode.trace_add('write', self.show_capacity)
+        self.original_file.trace_add('write', self.show_capacity)
+        self.show_capacity()
+
+    def show_capacity(self, *_):
+        """Show bytes that fit in original file with selected mode."""
+        try:
+            size = capacity(self.original_file.get(), self.stego_mode.get())
+        except (OSError, ValueError, SteganographyError):
+            text = ''
+        else:
+            text = f'{size // 1024} KiB fits'
+        self.capacity.configure(text=text)
+
     def apply(self):
         self.result = {key: getattr(self, key).get() for
                        key in ('sync', 'file_location', 'original_file',
-                               'use_steganography', 'clear_on_exit')}
+                               'use_steganography', 'stego_mode',
+                               'use_journal', 'clear_on_exit')}
 
 
 class About(Dialog):
@@ -0,0 +1,74 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+"""
+Compare record codec against pickle.
+Run from repository root: python -m benchmarks.bench_codec
+"""
+import datetime
+import pickle
+import random
+import string
+import time
+import uuid
+
+from acid_vault.vault.helpers import codec
+
+
+def make_records(n):
+    words = [''.join(random.choices(string.ascii_lowercase, k=8))
+             for _ in range(200)]
+    now = datetime.datetime.utcnow()
+    return [(uuid.uuid4(),
+             now - datetime.timedelta(seconds=random.randint(0, 10**8)),
+             f'{random.choice(words)}.example.com',
+             f'{random.choice(words)}@example.com',
+             ''.join(random.choices(string.printable[:94], k=16)),
+             ' '.join(random.choices(words, k=3)),
+             random.random() < 0.05)
+            for _ in range(n)]
+
+
+def best_of(call, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    print(f'{"records":>8} {"":>6} {"encode ms":>10} {"decode ms":>10} '
+          f'{"bytes":>10}')
+    for n in (1000, 10000, 100000):
+        records = make_records(n)
+        pickled = pickle.dumps(records)
+        encoded = codec.encode_records(records)
+        assert codec.decode_records(encoded) == records
+        for name, data, dumps, loads in (
+                ('pickle', pickled, pickle.dumps, pickle.loads),
+                ('codec', encoded, codec.encode_records,
+                 codec.decode_records)):
+            encode = best_of(lambda: dumps(records)) * 1000
+            decode = best_of(lambda: loads(data)) * 1000
+            print(f'{n:>8} {name:>6} {encode:>10.1f} {decode:>10.1f} '
+                  f'{len(data):>10}')
+
+
+if __name__ == '__main__':
+    main()
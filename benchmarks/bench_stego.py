@@ -0,0 +1,83 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+"""
+Time steganography write and read on generated jpg carriers.
+Run from repository root: python -m benchmarks.bench_stego
+"""
+import io
+import os
+import tempfile
+import time
+
+import numpy
+from PIL import Image
+
+from acid_vault.vault.helpers import steganography
+
+# Width and height of carriers, 2 and 12 megapixels.
+SIZES = ((1600, 1200), (4000, 3000))
+
+
+def make_carrier(path, size):
+    '''
+    Noisy jpg of size, pixel values kept well away from 255 where the
+    encoding clips.
+    '''
+    width, height = size
+    rng = numpy.random.default_rng(1)
+    pixels = rng.integers(64, 192, (height, width, 3), dtype=numpy.uint8)
+    Image.fromarray(pixels).save(path, 'jpeg', quality=95)
+
+
+def changed(out, carrier):
+    '''Number of pixels that differ from carrier.'''
+    with Image.open(out) as image, Image.open(carrier) as original:
+        return int(numpy.any(numpy.asarray(image) !=
+                             numpy.asarray(original), 2).sum())
+
+
+def timed(call):
+    start = time.perf_counter()
+    result = call()
+    return time.perf_counter() - start, result
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        print(f'{"carrier":>10} {"payload":>10} {"write ms":>9} '
+              f'{"read ms":>8} {"changed":>9}')
+        for size in SIZES:
+            carrier = os.path.join(folder, f'{size[0]}x{size[1]}.jpg')
+            make_carrier(carrier, size)
+            # 40 KB vault and a payload filling the image.
+            full = (size[0] * size[1] - steganography.HEADER_PIXELS) * 3 // 8
+            for length in (40 * 1024, full):
+                data = os.urandom(length)
+                out = io.BytesIO()
+                write_time, _ = timed(
+                    lambda: steganography.write(out, carrier, data))
+                out.seek(0)
+                read_time, result = timed(
+                    lambda: steganography.read(out, carrier, length))
+                assert result == data
+                print(f'{size[0]}x{size[1]:<5} {length:>10} '
+                      f'{write_time * 1000:>9.0f} {read_time * 1000:>8.0f} '
+                      f'{changed(out, carrier):>9}')
+
+
+if __name__ == '__main__':
+    main()
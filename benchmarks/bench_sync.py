@@ -0,0 +1,83 @@
+###############################################################################
+# Acid Vault                                                                  #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU Affero General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or           #
+# (at your option) any later version.                                         #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU Affero General Public License for more details.                         #
+#                                                                             #
+# You should have received a copy of the GNU Affero General Public License    #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+###############################################################################
+"""
+Time remote vault operations over a simulated link, see MemoryBackend.
+Run from repository root: python -m benchmarks.bench_sync
+"""
+import time
+
+from acid_vault.vault import vault
+from acid_vault.vault.helpers import storage
+from benchmarks.bench_codec import make_records
+
+PATH = 'vault.bin'
+PASSWORD = 'benchmark'
+# Round trip and bytes per second of a slow link.
+LATENCY = 0.03
+BANDWIDTH = 1024 * 1024
+
+
+def edit(v, index):
+    record = v.get_objects()[index]
+    v.replace(record[:2] + ('edited',) + record[3:])
+
+
+def main():
+    for n in (1000, 10000):
+        backend = storage.MemoryBackend(LATENCY, BANDWIDTH)
+        v = vault.Vault(use_journal=True, backend=backend)
+        v.upsert(make_records(n))
+        # Old deleted records would be removed by the first merge.
+        v.remove_deleted()
+        steps = []
+
+        def step(name, call):
+            requests, moved = backend.requests, (backend.bytes_read +
+                                                 backend.bytes_written)
+            start = time.perf_counter()
+            call()
+            steps.append((name,
+                          time.perf_counter() - start,
+                          backend.requests - requests,
+                          backend.bytes_read + backend.bytes_written - moved))
+        v.lock(PASSWORD)
+        step('save snapshot', lambda: v.save(PATH))
+        other = vault.Vault(PATH, use_journal=True, backend=backend)
+        other.unlock(PASSWORD)
+        step('check unchanged',
+             lambda: other.check_remote(PATH, None, None))
+        v.unlock(PASSWORD)
+        edit(v, 0)
+        v.lock(PASSWORD)
+        step('save one edit', lambda: v.save(PATH))
+        edit(other, 1)
+
+        def sync():
+            data = other.check_remote(PATH, None, None)
+            other.merge(PASSWORD, data, PATH, None, None)
+        step('delta sync', sync)
+        step('load', lambda: vault.Vault(PATH, backend=backend))
+        print(f'{n} records, {LATENCY * 1000:.0f} ms latency, '
+              f'{BANDWIDTH // 1024} KiB/s')
+        print(f'{"":>16} {"ms":>8} {"requests":>9} {"bytes":>10}')
+        for name, elapsed, requests, moved in steps:
+            print(f'{name:>16} {elapsed * 1000:>8.0f} {requests:>9} '
+                  f'{moved:>10}')
+
+
+if __name__ == '__main__':
+    main()
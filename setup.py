@@ -26,6 +26,7 @@ setuptools.setup(
     ],
     python_requires='>=3.6',
     install_requires=['cryptography>=3.0',
+                      'numpy>=1.17',
                       'paramiko>=2.7',
                       'pillow>=7.0']
 )
@@ -1,5 +1,7 @@
+import datetime
 import os
 import pickle
+import uuid
 import pytest
 
 @pytest.fixture
@@ -20,3 +22,10 @@ def locked_file(tmpdir, vault_data_locked):
     with open(file, 'bw') as fh:
         pickle.dump(vault_data_locked, fh)
     return file
+
+def record(system='system', user='user', password='password', notes='notes',
+           deleted=False, date=None):
+    '''Password record with a new uid, dated now unless date is given.'''
+    if date is None:
+        date = datetime.datetime.utcnow()
+    return (uuid.uuid4(), date, system, user, password, notes, deleted)
@@ -0,0 +1,80 @@
+import os
+from tests.fixtures import *
+from acid_vault.vault.helpers import cache
+from acid_vault.vault.helpers import storage
+import acid_vault.vault.vault as vault
+
+KEY = cache.key({'host': 'host', 'port': '22', 'username': 'user'},
+                'vault.bin')
+
+@pytest.fixture
+def data_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache.constants, 'data_dir', lambda: str(tmpdir))
+    return tmpdir
+
+def test_hash_match(data_dir):
+    cache.put(KEY, b'data')
+    digest = cache.hashlib.sha256(b'data').hexdigest()
+    assert cache.get(KEY, storage.FileStat(1, 2, 4, digest)) == b'data'
+    assert cache.get(KEY, storage.FileStat(1, 2, 4, 'other')) is None
+    assert cache.get(KEY, storage.FileStat(1, 2, 5, digest)) is None
+    assert cache.get(KEY, storage.FileStat(1, 2, 4)) is None
+    assert cache.get(KEY) == b'data'
+    assert cache.get(('other', 22, 'user', 'vault.bin')) is None
+
+def test_mtime_not_trusted(data_dir):
+    # Entry from before, a same size rewrite has its times put back.
+    digest = cache.hashlib.sha256(b'data').hexdigest()
+    meta = {'size': 4, 'sha256': digest, 'mtime': 2}
+    assert not cache.matches(meta, storage.FileStat(1, 2, 4))
+    assert cache.matches(meta, storage.FileStat(1, 2, 4, digest))
+
+def test_damaged_and_discarded(data_dir):
+    cache.put(KEY, b'data')
+    data_path, _ = cache._paths(KEY)
+    with open(data_path, 'wb') as fh:
+        fh.write(b'evil')
+    assert cache.get(KEY) is None
+    cache.put(KEY, b'data')
+    cache.discard(KEY)
+    assert cache.get(KEY) is None
+
+@pytest.fixture
+def backend(data_dir):
+    return storage.MemoryBackend(name='remote')
+
+def test_vault_load_from_cache(backend):
+    f = 'remote/vault.bin'
+    v = vault.Vault(backend=backend)
+    v.add(('system', 'user', 'password', 'notes'))
+    v.lock('testpass')
+    v.save(f)
+    # Written content is cached, unchanged remote is not read.
+    v = vault.Vault(f, backend=backend)
+    assert backend.bytes_read == 0 and not v.offline
+    assert v.unlock('testpass')
+    # Changed remote is read and cached again.
+    v.add(('other', 'user', 'password', 'notes'))
+    v.lock('testpass')
+    v.use_cache = False
+    v.save(f)
+    changed = backend.files[f]
+    v = vault.Vault(f, backend=backend)
+    assert backend.bytes_read == len(changed)
+    assert cache.get(backend.cache_key(f)) == changed
+    assert len(v.unlock('testpass')['vault']) == 2
+
+def test_vault_offline(backend):
+    f = 'vault.bin'
+    v = vault.Vault(backend=backend)
+    v.add(('system', 'user', 'password', 'notes'))
+    v.lock('testpass')
+    v.save(f)
+    backend.online = False
+    v = vault.Vault(f, backend=backend)
+    assert v.offline
+    assert v.unlock('testpass')
+    assert v.get_objects()[0][0] == 'system'
+    cache.discard(backend.cache_key(f))
+    with pytest.raises(ConnectionRefusedError):
+        vault.Vault(f, backend=backend)
@@ -0,0 +1,44 @@
+import datetime
+import os
+import uuid
+from tests.fixtures import *
+from acid_vault.vault.helpers import codec
+from acid_vault.vault.helpers import legacy_load
+
+RECORDS = [
+    (uuid.uuid4(), datetime.datetime(2020, 11, 16, 10, 30, 0, 123456),
+     'system', 'user', 'password', 'notes', False),
+    (uuid.uuid4(), '', 'sÿstem', 'üser', 'pässword ✓', '', True),
+    (uuid.uuid4(), datetime.datetime(1969, 1, 1), '', '', '', '', False),
+]
+
+def test_record_roundtrip():
+    for record in RECORDS:
+        assert codec.decode_record(codec.encode_record(record)) == record
+
+def test_records_roundtrip():
+    data = codec.encode_records(RECORDS)
+    assert codec.decode_records(data) == RECORDS
+    assert len(data) < len(pickle.dumps(RECORDS))
+
+def test_literal_record():
+    assert codec.decode_records(codec.encode_records(['test', ('test', )])) == [
+        'test', ('test', )]
+
+def test_unencodable_record():
+    with pytest.raises(codec.CodecError):
+        codec.encode_record(object())
+
+def test_truncated():
+    data = codec.encode_records(RECORDS)
+    with pytest.raises(codec.CodecError):
+        codec.decode_records(data[:-1])
+
+class Exploit:
+    def __reduce__(self):
+        return (os.system, ('echo pwned',))
+
+def test_safe_loads():
+    assert legacy_load.safe_loads(pickle.dumps(RECORDS)) == RECORDS
+    with pytest.raises(pickle.UnpicklingError):
+        legacy_load.safe_loads(pickle.dumps(Exploit()))
@@ -0,0 +1,67 @@
+import datetime
+import io
+import uuid
+from tests.fixtures import *
+from acid_vault.vault.helpers import container
+import acid_vault.vault.vault as vault
+
+def locked_vault(n=3):
+    v = vault.Vault()
+    for x in range(n):
+        v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+               str(x), 'user', 'password', 'notes', False))
+    v.lock('testpass')
+    return v
+
+def test_roundtrip():
+    v = locked_vault()
+    v.data['timestamp'] = datetime.datetime(2020, 1, 1, 12, 0, 0, 1)
+    fh = io.BytesIO()
+    v.data['digest'], v.data['length'] = container.write(fh, v.data)
+    fh.seek(0)
+    data = container.read(fh)
+    assert data.pop('journal_size') == 0
+    assert data.pop('snapshot') == container.to_micros(v.data['timestamp'])
+    assert data == v.data
+
+def test_legacy_pickle(vault_data_locked):
+    fh = io.BytesIO(pickle.dumps(vault_data_locked))
+    assert container.read(fh) == vault_data_locked
+
+def test_truncated():
+    v = locked_vault()
+    fh = io.BytesIO()
+    container.write(fh, v.data)
+    fh = io.BytesIO(fh.getvalue()[:-1])
+    with pytest.raises(container.ContainerError):
+        container.read(fh)
+
+def test_dropped_record(tmpdir):
+    v = locked_vault()
+    v.data['vault'] = v.data['vault'][1:]
+    f = tmpdir.join('testfile.bin')
+    v.save(f)
+    v2 = vault.Vault()
+    v2.load(f)
+    with pytest.raises(vault.VaultError):
+        v2.unlock('testpass')
+
+class CountingFile(io.BytesIO):
+    read_bytes = 0
+
+    def read(self, *args):
+        data = super().read(*args)
+        self.read_bytes += len(data)
+        return data
+
+def open_file_object(self, fh, ssh_params, path_to_original, mode, call):
+    return call(fh, path_to_original)
+
+def test_check_remote_reads_prefix_only(monkeypatch):
+    monkeypatch.setattr(vault.Vault, '_open', open_file_object)
+    v = locked_vault(100)
+    fh = CountingFile()
+    v.save(fh)
+    fh.seek(0)
+    assert v.check_remote(fh, None, None) is None
+    assert fh.read_bytes == container.PREFIX.size
@@ -0,0 +1,52 @@
+from tests.fixtures import *
+from acid_vault.vault.helpers import envelope
+
+def test_roundtrip():
+    records = [record(str(x)) for x in range(3)]
+    key = envelope.new_data_key()
+    sealed = envelope.SealedRecords.from_records(key, records).seal()
+    assert list(envelope.SealedRecords(key, sealed)) == records
+
+def test_lazy_decrypt(monkeypatch):
+    records = [record(str(x)) for x in range(3)]
+    key = envelope.new_data_key()
+    sealed = envelope.SealedRecords.from_records(key, records).seal()
+    calls = []
+    decrypt_record = envelope.decrypt_record
+
+    def counting_decrypt(*args):
+        calls.append(args)
+        return decrypt_record(*args)
+    monkeypatch.setattr(envelope, 'decrypt_record', counting_decrypt)
+    unsealed = envelope.SealedRecords(key, sealed)
+    assert unsealed[1] == records[1]
+    assert len(calls) == 1
+
+def test_only_changed_records_encrypted():
+    records = [record(str(x)) for x in range(3)]
+    key = envelope.new_data_key()
+    sealed = envelope.SealedRecords.from_records(key, records).seal()
+    unsealed = envelope.SealedRecords(key, sealed)
+    changed = (records[1][0], *records[1][1:3], 'new user', *records[1][4:])
+    unsealed.assign([records[0], changed, records[2]])
+    assert unsealed.changed() == 1
+    resealed = unsealed.seal()
+    assert resealed[0] == sealed[0] and resealed[2] == sealed[2]
+    assert resealed[1] != sealed[1]
+
+def test_swapped_record():
+    records = [record(str(x)) for x in range(2)]
+    key = envelope.new_data_key()
+    sealed = envelope.SealedRecords.from_records(key, records).seal()
+    swapped = [(sealed[0][0], sealed[1][1])]
+    with pytest.raises(envelope.EnvelopeError):
+        envelope.SealedRecords(key, swapped)[0]
+
+def test_delete_keeps_ciphertexts():
+    records = [record(str(x)) for x in range(4)]
+    key = envelope.new_data_key()
+    sealed = envelope.SealedRecords.from_records(key, records).seal()
+    unsealed = envelope.SealedRecords(key, sealed)
+    unsealed.delete([0, 2])
+    assert [unsealed.sealed(i) for i in range(2)] == [sealed[1][1], sealed[3][1]]
+    assert list(unsealed) == [records[1], records[3]]
@@ -0,0 +1,99 @@
+import io
+import json
+import os
+from tests.fixtures import *
+from acid_vault.vault.helpers import instrument
+import acid_vault.vault.vault as vault
+
+@pytest.fixture
+def tracing():
+    instrument.clear()
+    yield instrument
+    instrument.disable()
+    instrument.clear()
+
+def test_off_by_default(tracing):
+    assert instrument.span('test') is instrument.NO_SPAN
+    with instrument.span('test') as span:
+        span.add_bytes(10)
+    assert instrument.spans() == []
+
+def test_lazy_fields(tracing):
+    calls = []
+
+    def count():
+        calls.append(1)
+        return 3
+    with instrument.span('test', records=count):
+        pass
+    assert calls == []
+    instrument.enable()
+    with instrument.span('test', records=count):
+        pass
+    assert calls == [1]
+    assert instrument.spans('test')[0]['records'] == 3
+
+def test_nested_spans(tracing):
+    instrument.enable()
+    with instrument.span('outer', host='example') as outer:
+        with instrument.span('inner') as inner:
+            inner.add_bytes(10)
+        outer.add_bytes(5)
+    inner, outer = instrument.spans()
+    assert (inner['name'], inner['depth'], inner['parent']) == (
+        'inner', 1, 'outer')
+    assert (outer['name'], outer['depth'], outer['parent']) == (
+        'outer', 0, None)
+    assert inner['bytes'] == 10 and outer['bytes'] == 5
+    assert outer['host'] == 'example'
+    assert outer['wall'] >= inner['wall'] >= 0
+    assert instrument.summary()['inner'][0] == 1
+
+def test_error_is_recorded(tracing):
+    instrument.enable()
+    with pytest.raises(ValueError):
+        with instrument.span('broken'):
+            raise ValueError()
+    assert instrument.spans('broken')[0]['error'] == 'ValueError'
+
+def test_ring_buffer(tracing):
+    instrument.enable(size=3)
+    for index in range(5):
+        with instrument.span(str(index)):
+            pass
+    assert [record['name'] for record in instrument.spans()] == [
+        '2', '3', '4']
+    instrument.enable()
+
+def test_json_lines_and_profile(tmpdir, tracing):
+    path = str(tmpdir.join('trace.jsonl'))
+    profile_dir = str(tmpdir.join('profiles'))
+    instrument.enable(path, profile_dir)
+    with instrument.span('outer'):
+        with instrument.span('inner'):
+            pass
+    with open(path) as fh:
+        assert [json.loads(line)['name'] for line in fh] == [
+            'inner', 'outer']
+    fh = io.StringIO()
+    instrument.export(fh)
+    assert len(fh.getvalue().splitlines()) == 2
+    # Only outermost spans are profiled.
+    assert [name.split('-')[0] for name in os.listdir(profile_dir)] == [
+        'outer']
+
+def test_vault_phases(tmpdir, tracing):
+    f = str(tmpdir.join('testfile.bin'))
+    instrument.enable()
+    v = vault.Vault(cache_key=False)
+    v.add(('system', 'user', 'password', 'notes'))
+    v.lock('testpass')
+    v.save(f)
+    v = vault.Vault(f, cache_key=False)
+    v.unlock('testpass')
+    names = [record['name'] for record in instrument.spans()]
+    assert names == ['vault.kdf', 'vault.encrypt', 'vault.encode',
+                     'vault.io', 'vault.save', 'vault.decode', 'vault.io',
+                     'vault.load', 'vault.kdf', 'vault.decrypt']
+    decode, io_span = instrument.spans()[5:7]
+    assert decode['bytes'] == io_span['bytes'] == os.path.getsize(f)
@@ -0,0 +1,98 @@
+import datetime
+import threading
+import time
+import uuid
+from tests.fixtures import *
+from acid_vault.vault.helpers import jobs
+import acid_vault.vault.vault as vault
+
+def wait(runner):
+    while runner.busy:
+        runner.poll()
+        time.sleep(0.01)
+
+def test_done_and_progress_in_polling_thread():
+    runner = jobs.JobRunner()
+    calls = []
+
+    def work(job, value):
+        job.progress('first')
+        job.progress('second')
+        return value * 2
+    runner.submit(work, 21,
+                  on_progress=lambda job, phase: calls.append(
+                      (phase, threading.current_thread())),
+                  on_done=lambda job, result: calls.append(
+                      (result, threading.current_thread())))
+    wait(runner)
+    assert calls == [('first', threading.current_thread()),
+                     ('second', threading.current_thread()),
+                     (42, threading.current_thread())]
+    runner.shutdown()
+
+def test_error():
+    runner = jobs.JobRunner()
+    errors = []
+
+    def work(job):
+        raise ValueError('broken')
+    runner.submit(work, on_error=lambda job, err: errors.append(err))
+    wait(runner)
+    assert isinstance(errors[0], ValueError)
+    runner.submit(work)
+    with pytest.raises(ValueError):
+        wait(runner)
+    runner.shutdown()
+
+def test_cancel():
+    runner = jobs.JobRunner()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def work(job):
+        started.set()
+        release.wait()
+        job.progress('after cancel')
+        return 'not reached'
+    job = runner.submit(work, on_done=lambda job, result: errors.append(result),
+                        on_error=lambda job, err: errors.append(err))
+    started.wait()
+    job.cancel()
+    release.set()
+    wait(runner)
+    assert isinstance(errors[0], jobs.Cancelled)
+    runner.shutdown()
+
+def test_vault_phases(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    phases = []
+    v = vault.Vault(cache_key=False, progress=phases.append)
+    v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+           'system', 'user', 'password', 'notes', False))
+    v.lock('testpass')
+    v.save(f)
+    assert phases == ['kdf', 'transfer']
+    phases.clear()
+    v = vault.Vault(f, cache_key=False, progress=phases.append)
+    v.unlock('testpass')
+    assert phases == ['transfer', 'decode', 'kdf', 'decrypt']
+
+def test_cancelled_save_keeps_file(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = vault.Vault()
+    v.lock('testpass')
+    v.save(f)
+    with open(f, 'rb') as fh:
+        saved = fh.read()
+
+    def cancel(phase):
+        raise jobs.Cancelled(phase)
+    v.unlock('testpass')
+    v.add(('system', 'user', 'password', 'notes'))
+    v.lock('testpass')
+    v.progress = cancel
+    with pytest.raises(jobs.Cancelled):
+        v.save(f)
+    with open(f, 'rb') as fh:
+        assert fh.read() == saved
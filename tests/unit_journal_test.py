@@ -0,0 +1,241 @@
+import datetime
+import os
+from tests.fixtures import *
+from acid_vault.vault.helpers import journal
+from acid_vault.vault.helpers import kdf
+import acid_vault.vault.vault as vault
+
+def saved_vault(path, n=3):
+    v = vault.Vault(use_journal=True)
+    for x in range(n):
+        v.add(record(str(x)))
+    v.lock('testpass')
+    v.save(path)
+    v.unlock('testpass')
+    return v
+
+def edit(v):
+    records = v.get_objects()
+    records[0] = records[0][:2] + ('changed',) + records[0][3:]
+    del records[1]
+    v.add(record('new'))
+
+def reloaded(path):
+    v = vault.Vault(path, use_journal=True)
+    v.unlock('testpass')
+    return v
+
+def test_append_and_replay(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f, 100)
+    size = os.path.getsize(f)
+    edit(v)
+    v.lock('testpass')
+    v.save(f)
+    # Three entries and a seal, not a rewrite of all records.
+    assert 0 < os.path.getsize(f) - size < 1000
+    assert v.data['journal_size'] == os.path.getsize(f) - size
+    v.unlock('testpass')
+    assert list(reloaded(f).get_objects()) == list(v.get_objects())
+
+def test_appends_accumulate(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    for _ in range(3):
+        edit(v)
+        v.lock('testpass')
+        v.save(f)
+        v.unlock('testpass')
+    v2 = reloaded(f)
+    assert list(v2.get_objects()) == list(v.get_objects())
+    assert v2.data['journal_size'] == v.data['journal_size']
+
+def test_torn_append_ignored(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    with open(f, 'ab') as fh:
+        fh.write(b'\0' * 10)
+    assert list(reloaded(f).get_objects()) == list(v.get_objects())
+
+def test_changed_file_gets_snapshot(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    other = reloaded(f)
+    other.add(record('other'))
+    other.lock('testpass')
+    other.save(f)
+    edit(v)
+    v.lock('testpass')
+    v.save(f)
+    assert v.data['journal_size'] == 0
+    v.unlock('testpass')
+    assert list(reloaded(f).get_objects()) == list(v.get_objects())
+
+def test_kdf_change_gets_snapshot(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    v.set_kdf(kdf.PBKDF2(2000))
+    edit(v)
+    v.lock('testpass')
+    v.save(f)
+    assert v.data['journal_size'] == 0
+    v2 = vault.Vault(f)
+    assert v2.key_derivation == kdf.PBKDF2(2000)
+    assert v2.unlock('testpass')
+
+def test_password_change_gets_snapshot(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    v.lock('newpass')
+    v.save(f)
+    assert vault.Vault(f).unlock('newpass')
+    # Unchanged key keeps wrapped data key, so changes are appended.
+    v.unlock('newpass')
+    edit(v)
+    v.lock('newpass')
+    v.save(f)
+    assert v.data['journal_size'] > 0
+    assert vault.Vault(f).unlock('newpass')
+
+def test_replayed_entry_dropped(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    edit(v)
+    v.lock('testpass')
+    v.save(f)
+    v2 = vault.Vault(f)
+    v2.data['journal'] = v2.data['journal'][1:]
+    with pytest.raises(vault.VaultError):
+        v2.unlock('testpass')
+
+def test_compaction(tmpdir, monkeypatch):
+    f = str(tmpdir.join('testfile.bin'))
+    v = saved_vault(f)
+    assert not v.needs_compaction
+    monkeypatch.setattr(vault, 'JOURNAL_MAX_SIZE', 10)
+    edit(v)
+    v.lock('testpass')
+    v.save(f)
+    assert v.needs_compaction
+    v.compact(f)
+    assert not v.needs_compaction
+    v2 = reloaded(f)
+    assert v2.data['journal'] == []
+    v.unlock('testpass')
+    assert list(v2.get_objects()) == list(v.get_objects())
+
+def test_changes_order():
+    v = vault.Vault()
+    for x in range(3):
+        v.add(record(str(x)))
+    v.lock('testpass')
+    v.unlock('testpass')
+    records = v.get_objects()
+    records.insert(0, record('first'))
+    del records[2]
+    entries = journal.changes(records)
+    assert [operation for operation, _, _ in entries] == [journal.DELETE,
+                                                          journal.PUT]
+    assert records[-1][2] == 'first'
+
+def synced_pair(path, n=100):
+    saved_vault(path, n).lock('testpass')
+    return reloaded(path), reloaded(path)
+
+def changed(v, index, name):
+    old = v.get_objects()[index]
+    new = (old[0], datetime.datetime.utcnow(), name) + old[3:]
+    v.replace(new)
+    return new
+
+def test_delta_sync(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    ours = changed(a, 0, 'a')
+    gone = a.get_objects()[1]
+    a.remove_password(gone)
+    a.lock('testpass')
+    a.save(f)
+    theirs = changed(b, 5, 'b')
+    size = os.path.getsize(f)
+    data = b.check_remote(f, None, None)
+    # Only what was appended by a is read.
+    assert [operation for operation, _, _ in data['delta']] == [
+        journal.DELETE, journal.PUT, journal.SEAL]
+    b.merge('testpass', data, f, None, None)
+    # Only the record changed by b is sent.
+    assert 0 < os.path.getsize(f) - size < 500
+    assert b.get(ours[0]) == ours and b.get(gone[0]) is None
+    assert b.check_remote(f, None, None) is None
+    a.unlock('testpass')
+    a.merge('testpass', a.check_remote(f, None, None), f, None, None)
+    assert a.get(theirs[0]) == theirs
+    assert list(a.get_objects()) == list(b.get_objects())
+    assert list(reloaded(f).get_objects()) == list(b.get_objects())
+
+def test_delta_sync_conflict(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    changed(a, 0, 'older')
+    deleted = a.get_objects()[1]
+    a.remove_password(deleted)
+    a.lock('testpass')
+    a.save(f)
+    newer = changed(b, 0, 'newer')
+    kept = changed(b, 1, 'kept')
+    b.merge('testpass', b.check_remote(f, None, None), f, None, None)
+    # Newest change wins, records changed here are not deleted.
+    assert b.get(newer[0]) == newer and b.get(kept[0]) == kept
+    assert list(reloaded(f).get_objects()) == list(b.get_objects())
+
+def test_delta_needs_appended_file(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    changed(a, 0, 'a')
+    a.lock('testpass')
+    a.compact(f)
+    data = b.check_remote(f, None, None)
+    assert 'delta' not in data and data['vault']
+
+def test_longer_snapshot_read_in_full(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    added = [record(str(x)) for x in range(3)]
+    for obj in added:
+        a.add(obj)
+    a.lock('testpass')
+    a.compact(f)
+    assert os.path.getsize(f) > b.data['length']
+    data = b.check_remote(f, None, None)
+    assert 'delta' not in data and data['vault']
+    b.merge('testpass', data, f, None, None)
+    assert all(b.get(obj[0]) == obj for obj in added)
+
+def test_tampered_delta(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    changed(a, 0, 'a')
+    a.add(record('new'))
+    a.lock('testpass')
+    a.save(f)
+    data = b.check_remote(f, None, None)
+    data['delta'] = data['delta'][1:]
+    with pytest.raises(vault.VaultError):
+        b.merge('testpass', data, f, None, None)
+
+def test_synced_copy_while_locked(tmpdir, monkeypatch):
+    f = str(tmpdir.join('testfile.bin'))
+    a, b = synced_pair(f)
+    assert b.synced_copy('testpass', f) is None
+    new = record('new')
+    a.add(new)
+    a.lock('testpass')
+    a.save(f)
+    b.lock('testpass')
+    # Journal is compacted as well.
+    monkeypatch.setattr(vault, 'JOURNAL_MAX_SIZE', 0)
+    synced, merged = b.synced_copy('testpass', f)
+    assert merged and synced.locked and b.locked
+    assert not synced.needs_compaction
+    assert synced.unlock('testpass') and synced.get(new[0]) == new
+    assert b.unlock('testpass') and b.get(new[0]) is None
@@ -0,0 +1,29 @@
+from tests.fixtures import *
+import acid_vault.vault.helpers.kdf as kdf
+import acid_vault.vault.vault as vault
+
+def test_legacy_header():
+    assert kdf.from_header({'iterations': 1000}) == kdf.PBKDF2(1000)
+    assert kdf.from_header({}) == kdf.PBKDF2(kdf.DEFAULT_ITERATIONS)
+
+def test_header_roundtrip():
+    scrypt = kdf.Scrypt(n=2**14, r=8, p=1)
+    assert kdf.from_dict(scrypt.to_dict()) == scrypt
+
+def test_unknown_kdf():
+    with pytest.raises(kdf.KDFError):
+        kdf.from_dict({'name': 'rot13'})
+
+def test_calibrate():
+    pbkdf2 = kdf.calibrate(kdf.PBKDF2.name, target=0.01)
+    assert pbkdf2.iterations >= kdf.PBKDF2.min_iterations
+    scrypt = kdf.calibrate(kdf.Scrypt.name, target=0.01)
+    assert scrypt.n == kdf.Scrypt.min_n
+
+def test_scrypt_vault():
+    v = vault.Vault(key_derivation=kdf.Scrypt(n=2**14))
+    v.data['vault'] = ['test']
+    v.lock('testpass')
+    v.forget_key()
+    assert v.unlock('testpass')
+    assert 'test' in v.data['vault']
@@ -0,0 +1,127 @@
+import time
+from tests.fixtures import *
+from acid_vault.vault.helpers import replicas
+from acid_vault.vault.helpers import ssh
+from acid_vault.vault.helpers import storage
+import acid_vault.vault.vault as vault
+
+PATH = 'vault.bin'
+
+def saved(backends, name='first', **kwargs):
+    v = vault.Vault(backend=backends, use_journal=True, **kwargs)
+    v.add(record(name))
+    v.lock('testpass')
+    v.save(PATH)
+    return v
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+def test_quorum_sizes():
+    assert replicas.write_quorum(3) == 2
+    assert replicas.read_quorum(3) == 2
+    assert replicas.write_quorum(4) == 3
+    assert replicas.read_quorum(4, 1) == 4
+    with pytest.raises(ValueError):
+        replicas.write_quorum(2, 3)
+
+def test_first_quorum():
+    def fail():
+        raise OSError('down')
+    results = replicas.first([lambda: time.sleep(1), lambda: 1, fail,
+                              lambda: 3], 2)
+    assert sorted(results) == [(1, 1), (3, 3)]
+    with pytest.raises(replicas.QuorumError) as err:
+        replicas.first([fail, lambda: 1], 2)
+    assert err.value.results == [(1, 1)]
+
+def test_save_waits_for_quorum_only():
+    backends = [storage.MemoryBackend(),
+                storage.MemoryBackend(),
+                storage.MemoryBackend(latency=0.5)]
+    start = time.monotonic()
+    saved(backends)
+    assert time.monotonic() - start < 0.5
+    # Slow replica is written in the background.
+    wait_for(lambda: PATH in backends[2].files)
+    assert len({backend.files[PATH] for backend in backends}) == 1
+
+def test_slow_replica_gets_same_append():
+    backends = [storage.MemoryBackend() for _ in range(3)]
+    v = saved(backends)
+    wait_for(lambda: all(PATH in backend.files for backend in backends))
+    backends[2].latency = 0.2
+    v.unlock('testpass')
+    v.add(record('second'))
+    v.lock('testpass')
+    v.save(PATH)
+    assert v.data['journal_size'] > 0
+    # Vault has moved on before the slow replica is written.
+    v.unlock('testpass')
+    v.add(record('third'))
+    v.lock('testpass')
+    wait_for(lambda: backends[2].files[PATH] == backends[0].files[PATH])
+
+def test_save_fails_without_quorum():
+    backends = [storage.MemoryBackend() for _ in range(3)]
+    for backend in backends[1:]:
+        backend.online = False
+    with pytest.raises(vault.VaultError):
+        saved(backends)
+    saved(backends, quorum=1)
+
+def test_load_newest_and_fastest():
+    backends = [storage.MemoryBackend() for _ in range(3)]
+    v = saved(backends)
+    wait_for(lambda: all(PATH in backend.files for backend in backends))
+    old = backends[2].files[PATH]
+    backends[2].online = False
+    v.unlock('testpass')
+    v.add(record('second'))
+    v.lock('testpass')
+    v.save(PATH)
+    # Only appended to the two replicas that were reached.
+    assert backends[0].files[PATH] == backends[1].files[PATH] != old
+    backends[2].online = True
+    backends[0].latency = 0.5
+    requests = [backend.requests for backend in backends]
+    v = vault.Vault(PATH, backend=backends)
+    v.unlock('testpass')
+    assert len(v.get_objects()) == 2
+    # Probed (lock, open and read) and read from the fastest replica that
+    # has the newest file.
+    assert backends[1].requests - requests[1] == 6
+    assert backends[2].requests - requests[2] == 3
+
+def test_replica_catches_up():
+    backends = [storage.MemoryBackend() for _ in range(3)]
+    v = saved(backends)
+    wait_for(lambda: all(PATH in backend.files for backend in backends))
+    backends[2].files[PATH] = b'old'
+    v.unlock('testpass')
+    v.add(record('second'))
+    v.lock('testpass')
+    v.save(PATH)
+    # Changed replica gets a snapshot, the others the journal.
+    wait_for(lambda: backends[2].files[PATH] != b'old')
+    for backend in backends:
+        other = vault.Vault(PATH, backend=backend)
+        other.unlock('testpass')
+        assert list(other.get_objects()) == list(v.unlock('testpass')[
+            'vault'])
+        v.lock('testpass')
+
+def test_ssh_replicas():
+    params = {'host': 'main', 'port': '22', 'username': 'user',
+              'password': 'secret',
+              'replicas': 'other@backup:2222, mirror ,'}
+    main, backup, mirror = ssh.replicas(params)
+    assert main is params
+    assert (backup['host'], backup['port'], backup['username']) == (
+        'backup', '2222', 'other')
+    assert (mirror['host'], mirror['port'], mirror['username']) == (
+        'mirror', '22', 'user')
+    assert mirror['password'] == 'secret' and not mirror['replicas']
@@ -0,0 +1,56 @@
+from tests.fixtures import *
+from acid_vault.vault.helpers import search
+import acid_vault.vault.vault as vault
+
+@pytest.fixture
+def records():
+    return [record('Facebook', 'me@example.com'),
+            record('Gmail', 'me@gmail.com', notes='work account'),
+            record('GitHub', 'octocat'),
+            record('Bank', 'me', password='facebook'),
+            record('Old mail', deleted=True)]
+
+def systems(results):
+    return [result[2] for result in results]
+
+def test_prefix(records):
+    v = vault.Vault()
+    v.upsert(records)
+    assert systems(v.search('g')) == ['Gmail', 'GitHub']
+    assert systems(v.search('git')) == ['GitHub']
+
+def test_fuzzy(records):
+    index = search.SearchIndex(records)
+    assert index.search('facebok') == [records[0][0].bytes]
+
+def test_fields(records):
+    index = search.SearchIndex(records)
+    assert index.search('work') == [records[1][0].bytes]
+    assert index.search('octocat') == [records[2][0].bytes]
+
+def test_password_not_indexed(records):
+    index = search.SearchIndex(records)
+    assert records[3][0].bytes not in index.search('facebook')
+    assert not index.search('password')
+
+def test_deleted_not_found(records):
+    index = search.SearchIndex(records)
+    assert not index.search('old mail')
+
+def test_updates(records):
+    v = vault.Vault()
+    v.upsert(records)
+    assert systems(v.search('gmail')) == ['Gmail']
+    v.replace(records[1][:2] + ('Outlook', 'me') + records[1][4:])
+    assert not v.search('gmail')
+    assert systems(v.search('outlook')) == ['Outlook']
+    v.add(record('Gitlab'))
+    assert systems(v.search('gitl'))[0] == 'Gitlab'
+    v.remove_password(records[2])
+    assert systems(v.search('git')) == ['Gitlab']
+
+def test_extend_duplicate_uid(records):
+    changed = records[0][:2] + ('Twitter',) + records[0][3:]
+    index = search.SearchIndex(records + [changed])
+    assert not index.search('facebook')
+    assert index.search('twitter') == [records[0][0].bytes]
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+from tests.fixtures import *
+from acid_vault.vault.helpers import ssh
+
+class Transport():
+    def __init__(self):
+        self.active = True
+        self.ignores = 0
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        self.ignores += 1
+
+class Client():
+    def __init__(self):
+        self.transport = Transport()
+        self.closed = False
+
+    def get_transport(self):
+        return None if self.closed else self.transport
+
+    def close(self):
+        self.closed = True
+
+KEY = ('host', 22, 'user')
+
+def test_reuse():
+    pool = ssh.ConnectionPool()
+    client, sftp = Client(), Client()
+    assert pool.acquire(KEY) is None
+    pool.release(KEY, client, sftp)
+    assert len(pool) == 1
+    assert pool.acquire(('other', 22, 'user')) is None
+    assert pool.acquire(KEY) == (client, sftp)
+    # Health checked before it is lent out.
+    assert client.transport.ignores == 1
+    assert pool.acquire(KEY) is None
+    assert not client.closed
+
+def test_dead_connections_are_closed():
+    pool = ssh.ConnectionPool()
+    client, sftp = Client(), Client()
+    pool.release(KEY, client, sftp)
+    client.transport.active = False
+    assert pool.acquire(KEY) is None
+    assert client.closed and sftp.closed
+    client = Client()
+    client.transport.active = False
+    pool.release(KEY, client, None)
+    assert len(pool) == 0 and client.closed
+
+def test_idle_timeout_and_close_all():
+    pool = ssh.ConnectionPool(idle_timeout=0)
+    client = Client()
+    pool.release(KEY, client, None)
+    assert len(pool) == 0 and client.closed
+    pool.idle_timeout = 60
+    clients = [Client(), Client()]
+    for client in clients:
+        pool.release(KEY, client, None)
+    assert len(pool) == 2
+    pool.close_all()
+    assert len(pool) == 0 and all(client.closed for client in clients)
+
+def lease(tmpdir, path='vaults/vault.bin', options='-e -w 0', ttl=60):
+    command = shlex.split(ssh.lease_command(path, options, ttl))
+    process = subprocess.Popen(command, cwd=str(tmpdir), text=True,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process, process.stdout.readline().split()
+
+def holders(tmpdir):
+    return os.listdir(str(tmpdir.join(ssh.HOLDERS_PATH)))
+
+needs_flock = pytest.mark.skipif(not shutil.which('flock'),
+                                 reason='flock is not installed')
+
+@needs_flock
+def test_lease(tmpdir):
+    first, status = lease(tmpdir)
+    assert status == ['OK']
+    assert tmpdir.join('vaults').isdir()
+    assert holders(tmpdir) == [str(first.pid)]
+    second, status = lease(tmpdir)
+    assert status == ['BUSY', ssh.identity()]
+    assert second.wait() == 1
+    first.stdin.write('\nquit\n')
+    first.stdin.flush()
+    assert first.wait() == 0
+    assert holders(tmpdir) == []
+    tmpdir.join('vaults', 'vault.bin').write('data')
+    third, status = lease(tmpdir, options='-s -w 0')
+    # Shared leases can be held at the same time.
+    fourth, _ = lease(tmpdir, options='-s -w 0')
+    # Times and size of the file.
+    assert status == ['OK', *status[1:3], '4']
+    command = shlex.split(ssh.lease_command(
+        'vaults/vault.bin', '-s -w 0', digest=True))
+    with subprocess.Popen(command, cwd=str(tmpdir), text=True,
+                          stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE) as fifth:
+        assert fifth.stdout.readline().split()[4] == hashlib.sha256(
+            b'data').hexdigest()
+        fifth.stdin.close()
+    for process in (third, fourth):
+        process.stdin.close()
+        assert process.wait() == 0
+
+@needs_flock
+def test_lease_expires_without_heartbeat(tmpdir):
+    process, status = lease(tmpdir, ttl=1)
+    assert status == ['OK']
+    assert process.wait(timeout=5) == 0
+    assert holders(tmpdir) == []
+
+@needs_flock
+def test_break_stale_lease(tmpdir):
+    process, _ = lease(tmpdir)
+    command = shlex.split(ssh.break_command())
+    # Heartbeats are current, nothing is broken.
+    assert subprocess.check_output(command, cwd=str(tmpdir)) == b''
+    holder = tmpdir.join(ssh.HOLDERS_PATH, str(process.pid))
+    holder.write(f'{process.pid} {ssh.identity()} 0\n')
+    broken = subprocess.check_output(command, cwd=str(tmpdir), text=True)
+    assert broken.split() == [ssh.identity()]
+    process.wait(timeout=5)
+    assert holders(tmpdir) == []
+    process, status = lease(tmpdir)
+    assert status == ['OK']
+    process.stdin.close()
+    assert process.wait() == 0
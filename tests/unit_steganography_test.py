@@ -1,5 +1,6 @@
 import hashlib
 import PIL
+import numpy
 import pytest
 
 from tests.fixtures import *
@@ -7,7 +8,7 @@ import acid_vault.vault.helpers.steganography as steganography
 from acid_vault.vault.helpers.steganography import SteganographyError
 
 def test_write(tmpdir):
-    expected = 'ce91ce323ab4c03f705bc37c5071af1c'
+    expected = 'f90ffdccc2d03b498667ddf13b7a6289'
     data = b'Test string to write'
     file_path = tmpdir.join('outfile.png')
     original_path = os.path.join(os.path.dirname(__file__),
@@ -19,7 +20,7 @@ def test_write(tmpdir):
         assert hashlib.md5(fh.read()).hexdigest() == expected
 
 
-def test_read():
+def test_read_legacy():
     expected = b'Test string to write'
     original_path = os.path.join(os.path.dirname(__file__),
                                  "test_data",
@@ -40,3 +41,126 @@ def test_to_large(tmpdir):
     with open(file_path, 'bw') as fh:
         with pytest.raises(SteganographyError):
             steganography.write(fh, original_path, data)
+
+def test_read_legacy_size():
+    original_path = os.path.join(os.path.dirname(__file__),
+                                 "test_data",
+                                 "test.jpg")
+    written_path = os.path.join(os.path.dirname(__file__),
+                                "test_data",
+                                "test.png")
+    with open(written_path, 'rb') as fh:
+        assert steganography.read(fh, original_path, 4) == b'Test'
+
+def test_write_read(tmpdir):
+    # Bright pixels would overflow if bits were only added.
+    original_path = tmpdir.join('original.png')
+    PIL.Image.new('RGB', (40, 400), (255, 150, 0)).save(original_path)
+    data = os.urandom(40 * 400 // 8 + 1000)
+    file_path = tmpdir.join('outfile.png')
+    with open(file_path, 'bw') as fh:
+        steganography.write(fh, original_path, data)
+    with open(file_path, 'br') as fh:
+        assert steganography.read(fh, original_path) == data
+    with open(file_path, 'br') as fh:
+        assert steganography.read(fh, original_path, 2500) == data[:2500]
+
+def test_write_touches_prefix(tmpdir):
+    original_path = tmpdir.join('original.png')
+    PIL.Image.new('RGB', (100, 100), (100, 150, 200)).save(original_path)
+    file_path = tmpdir.join('outfile.png')
+    with open(file_path, 'bw') as fh:
+        steganography.write(fh, original_path, b'\xff' * 300)
+    with PIL.Image.open(original_path) as orig, \
+            PIL.Image.open(file_path) as mask:
+        changed = numpy.any(numpy.asarray(orig) != numpy.asarray(mask), 2)
+    used = steganography.HEADER_PIXELS + 300 * 8 // 3
+    assert changed.reshape(-1)[used - 1]
+    assert not changed.reshape(-1)[used:].any()
+
+def test_read_checksum(tmpdir):
+    original_path = tmpdir.join('original.png')
+    PIL.Image.new('RGB', (100, 100), (100, 150, 200)).save(original_path)
+    file_path = tmpdir.join('outfile.png')
+    with open(file_path, 'bw') as fh:
+        steganography.write(fh, original_path, b'\xff' * 300)
+    with PIL.Image.open(file_path) as image:
+        pixels = numpy.array(image)
+    pixels[1, 0, 0] -= 1
+    PIL.Image.fromarray(pixels).save(file_path)
+    with open(file_path, 'br') as fh:
+        # Only full reads can be checked.
+        assert steganography.read(fh, original_path, 10) == b'\xff' * 10
+    with open(file_path, 'br') as fh:
+        with pytest.raises(SteganographyError):
+            steganography.read(fh, original_path)
+
+@pytest.mark.parametrize('mode', steganography.MODES)
+def test_modes(tmpdir, mode):
+    original_path = tmpdir.join('original.png')
+    pixels = numpy.random.default_rng(1).integers(
+        0, 256, (30, 50, 4), dtype=numpy.uint8)
+    PIL.Image.fromarray(pixels, 'RGBA').save(original_path)
+    size = steganography.capacity(original_path, mode)
+    bits, channels = steganography.parse_mode(mode)
+    assert size == (30 * 50 - steganography.HEADER_PIXELS) * \
+        bits * channels // 8
+    data = os.urandom(size)
+    file_path = tmpdir.join('outfile.png')
+    with open(file_path, 'bw') as fh:
+        steganography.write(fh, original_path, data, mode)
+    with open(file_path, 'br') as fh:
+        assert steganography.read(fh, original_path) == data
+    with open(file_path, 'bw') as fh:
+        with pytest.raises(SteganographyError):
+            steganography.write(fh, original_path, data + b'a', mode)
+
+def test_mode_no_alpha():
+    original_path = os.path.join(os.path.dirname(__file__),
+                                 "test_data",
+                                 "test.jpg")
+    with pytest.raises(SteganographyError):
+        steganography.capacity(original_path, 'rgba1')
+    with pytest.raises(SteganographyError):
+        steganography.capacity(original_path, 'rgb5')
+
+def test_carrier_cache(tmpdir):
+    original_path = tmpdir.join('original.png')
+    PIL.Image.new('RGB', (100, 100), (100, 150, 200)).save(original_path)
+    cache = steganography.CarrierCache()
+    pixels = cache.get(original_path)
+    assert cache.get(original_path) is pixels
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not pixels.flags.writeable
+    # Same size and mtime, other content.
+    stat = os.stat(original_path)
+    PIL.Image.new('RGB', (100, 100), (100, 150, 201)).save(original_path)
+    os.utime(original_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.get(original_path)[0, 0, 2] == 201
+    assert cache.size() == pixels.nbytes
+    cache.clear()
+    assert cache.size() == 0
+
+def test_carrier_cache_bound(tmpdir):
+    paths = [tmpdir.join(f'original{index}.png') for index in range(3)]
+    for path in paths:
+        PIL.Image.new('RGB', (100, 100)).save(path)
+    cache = steganography.CarrierCache(max_bytes=2 * 100 * 100 * 3)
+    for path in paths:
+        cache.get(path)
+    cache.get(paths[2])
+    assert cache.hits == 1
+    cache.get(paths[0])
+    assert cache.misses == 4
+
+def test_read_write_cached(tmpdir):
+    original_path = tmpdir.join('original.png')
+    PIL.Image.new('RGB', (100, 100), (100, 150, 200)).save(original_path)
+    steganography.CARRIERS.clear()
+    hits = steganography.CARRIERS.hits
+    file_path = tmpdir.join('outfile.png')
+    with open(file_path, 'bw') as fh:
+        steganography.write(fh, original_path, b'data')
+    with open(file_path, 'br') as fh:
+        assert steganography.read(fh, original_path) == b'data'
+    assert steganography.CARRIERS.hits == hits + 1
@@ -0,0 +1,191 @@
+import datetime
+import threading
+import uuid
+from tests.fixtures import *
+from acid_vault.vault.helpers import storage
+import acid_vault.vault.vault as vault
+
+class SFTPFile():
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.requests = 0
+        self.prefetched = None
+        self.closed = False
+
+    def read(self, size=None):
+        self.requests += 1
+        end = len(self.data) if size is None else self.position + size
+        data = self.data[self.position:end]
+        self.position += len(data)
+        return data
+
+    def seek(self, position):
+        self.position = position
+
+    def prefetch(self, size):
+        self.prefetched = size
+
+    def readv(self, chunks):
+        self.requests += 1
+        return [self.data[offset:offset + size] for offset, size in chunks]
+
+    def close(self):
+        self.closed = True
+
+def test_read_ahead_head_only():
+    remote = SFTPFile(bytes(range(256)) * 100)
+    fh = storage.ReadAheadFile(lambda: remote, len(remote.data))
+    assert fh.read(4) == bytes(range(4))
+    assert fh.read(4) == bytes(range(4, 8))
+    fh.seek(0)
+    assert fh.read(8) == bytes(range(8))
+    assert fh.tell() == 8
+    # Prefix reads cost one request and nothing is prefetched.
+    assert remote.requests == 1 and remote.prefetched is None
+    assert fh.getvalue() is None
+    fh.close()
+    assert remote.closed
+
+def test_read_ahead_whole_file():
+    remote = SFTPFile(bytes(range(256)) * 100)
+    fh = storage.ReadAheadFile(lambda: remote, len(remote.data))
+    assert fh.read(10) == remote.data[:10]
+    assert fh.read() == remote.data[10:]
+    assert remote.prefetched == len(remote.data)
+    assert remote.requests == 2
+    fh.seek(-6, 2)
+    assert fh.read(3) == remote.data[-6:-3]
+    fh.seek(1)
+    assert fh.read(storage.HEAD_SIZE) == remote.data[1:storage.HEAD_SIZE + 1]
+    assert remote.requests == 2
+    assert fh.getvalue() == remote.data
+
+def test_read_ahead_small_file():
+    remote = SFTPFile(b'small')
+    fh = storage.ReadAheadFile(lambda: remote, None)
+    assert fh.read(2) == b'sm'
+    assert fh.read() == b'all'
+    assert fh.getvalue() == b'small'
+    assert remote.requests == 1 and remote.prefetched is None
+
+def test_read_ahead_range():
+    remote = SFTPFile(bytes(range(256)) * 100)
+    fh = storage.ReadAheadFile(lambda: remote, len(remote.data))
+    assert fh.read(8) == remote.data[:8]
+    assert fh.read_range(4, 4) == remote.data[4:8]
+    assert fh.read_range(20000, 100) == remote.data[20000:20100]
+    # Only the range is read, the rest is not fetched.
+    assert remote.requests == 2 and remote.prefetched is None
+    assert fh.getvalue() is None
+
+def test_read_ahead_opens_on_read():
+    opened = []
+    fh = storage.ReadAheadFile(lambda: opened.append(1), 10)
+    fh.close()
+    assert not opened
+
+@pytest.fixture(params=['local', 'memory'])
+def backend(request, tmpdir):
+    if request.param == 'local':
+        return storage.LocalBackend(), str(tmpdir.join('dir', 'file'))
+    return storage.MemoryBackend(), 'dir/file'
+
+def read(backend, path):
+    with storage.StoredFile(backend, path) as fh:
+        return fh.read()
+
+def test_stored_file(backend):
+    backend, path = backend
+    with storage.StoredFile(backend, path, 'wb') as fh:
+        fh.write(b'first')
+    assert read(backend, path) == b'first'
+    with pytest.raises(ValueError):
+        with storage.StoredFile(backend, path, 'wb') as fh:
+            fh.write(b'second')
+            raise ValueError()
+    # Failed write leaves file as it was, without temporary file.
+    assert read(backend, path) == b'first'
+    assert backend.stat(f'{path}.bak') is None
+    with storage.StoredFile(backend, path, 'r+b') as fh:
+        fh.seek(5)
+        fh.write(b' and more')
+    assert read(backend, path) == b'first and more'
+    assert backend.stat(path).st_size == 14
+
+def test_memory_cost_model():
+    waits = []
+    backend = storage.MemoryBackend(latency=0.01, bandwidth=1000,
+                                    sleep=waits.append)
+    with storage.StoredFile(backend, 'file', 'wb') as fh:
+        fh.write(b'x' * 100)
+        fh.write(b'x' * 400)
+    # Lock, open, pipelined writes in one request and replace.
+    assert backend.requests == 4 and backend.bytes_written == 500
+    assert waits[2] == pytest.approx(0.51)
+    waits.clear()
+    assert read(backend, 'file') == b'x' * 500
+    assert sum(waits) == pytest.approx(0.01 * 3 + 0.5)
+    backend.online = False
+    with pytest.raises(ConnectionRefusedError):
+        backend.stat('file')
+
+def test_memory_lock_contention():
+    backend = storage.MemoryBackend()
+    shared = [backend.lock('file', exclusive=False),
+              backend.lock('file', exclusive=False, timeout=0)]
+    with pytest.raises(storage.LockError) as err:
+        backend.lock('file', timeout=0.01)
+    assert err.value.holder.count('MainThread') == 2
+    for lease in shared:
+        threading.Timer(0.05, backend.unlock, [lease]).start()
+    # Waits for the shared locks to be released.
+    lease = backend.lock('file', timeout=5)
+    assert backend.holders('file') == [lease.handle[0]]
+    backend.unlock(lease)
+    assert backend.holders('file') == []
+
+def test_vault_on_memory_backend():
+    backend = storage.MemoryBackend()
+    v = vault.Vault(use_journal=True, backend=backend)
+    for x in range(1000):
+        v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+               'system', 'user', str(x), 'notes', False))
+    v.lock('testpass')
+    v.save('vault.bin')
+    size = len(backend.files['vault.bin'])
+    v = vault.Vault('vault.bin', use_journal=True, backend=backend)
+    assert backend.bytes_read == size
+    v.unlock('testpass')
+    v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+           'new', 'user', 'password', 'notes', False))
+    v.lock('testpass')
+    written = backend.bytes_written
+    v.save('vault.bin')
+    # Appended entry and prefix are written, not the whole file.
+    assert 0 < backend.bytes_written - written < 500
+    requests = backend.requests
+    assert v.check_remote('vault.bin', None, None) is None
+    # Lock, open and one read of the head.
+    assert backend.requests - requests == 3
+
+def test_default_delta_sync():
+    backend = storage.MemoryBackend()
+    v = vault.Vault(backend=backend)
+    for x in range(1000):
+        v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+               'system', 'user', str(x), 'notes', False))
+    v.lock('testpass')
+    v.save('vault.bin')
+    other = vault.Vault('vault.bin', backend=backend)
+    other.unlock('testpass')
+    v.unlock('testpass')
+    v.add((uuid.uuid4(), datetime.datetime.utcnow(),
+           'new', 'user', 'password', 'notes', False))
+    v.lock('testpass')
+    v.save('vault.bin')
+    read = backend.bytes_read
+    data = other.check_remote('vault.bin', None, None)
+    # Only the prefix and the appended entry are read, not the records.
+    assert 'delta' in data
+    assert 0 < backend.bytes_read - read < len(backend.files['vault.bin']) / 10
@@ -0,0 +1,72 @@
+from tests.fixtures import *
+from acid_vault.vault.helpers import store
+
+def test_roundtrip():
+    records = [record('a'), record('b', date=''), record('c', deleted=True),
+               ('test',), 'test']
+    records_store = store.RecordStore(records)
+    assert list(records_store) == records
+    assert [records_store[i] for i in range(len(records))] == records
+    assert records_store[-1] == 'test'
+
+def test_record_fields():
+    obj = record('a')
+    records_store = store.RecordStore([obj])
+    assert isinstance(records_store[0], tuple)
+    assert records_store[0].uid == obj[0]
+    assert records_store[0].system == 'a'
+    assert records_store[0].deleted is False
+
+def test_mutate():
+    records = [record(str(x)) for x in range(5)]
+    records_store = store.RecordStore(records)
+    del records_store[1]
+    del records[1]
+    records_store.insert(2, record('new'))
+    records.insert(2, records_store[2])
+    records_store[0] = record('changed')
+    records[0] = records_store[0]
+    assert list(records_store) == records
+
+def test_shared_strings():
+    records_store = store.RecordStore([record('system'), record('system')])
+    assert records_store[0].system is records_store[1].system
+
+def test_column():
+    records = [record('b'), ('test',), record('a', deleted=True)]
+    records_store = store.RecordStore(records)
+    assert records_store.column('system') == ['b', None, 'a']
+    assert records_store.column('deleted') == [False, None, True]
+    assert records_store.column('uid') == [records[0][0], 'test', records[2][0]]
+
+def test_copy():
+    records_store = store.RecordStore([record('a'), record('b')])
+    other = records_store.copy()
+    other[0] = record('c')
+    del other[1]
+    assert [r[2] for r in records_store] == ['a', 'b']
+    assert [r[2] for r in other] == ['c']
+    assert records_store.find(records_store[1][0].bytes) == 1
+
+def test_delete_keeps_index():
+    records = [record(str(x)) for x in range(5)]
+    records.insert(3, records[1])
+    records_store = store.RecordStore(records)
+    assert records_store.find(records[1][0].bytes) == 1
+    del records_store[1]
+    del records[1]
+    assert records_store._index is not None
+    for index, obj in enumerate(records):
+        assert records_store.find(obj[0].bytes) == index
+    del records_store[-1]
+    del records[-1]
+    assert [records_store.find(obj[0].bytes) for obj in records] == [0, 1, 2, 3]
+
+def test_delete_many():
+    records = [record(str(x)) for x in range(5)]
+    records_store = store.RecordStore(records)
+    records_store.find(records[0][0].bytes)
+    records_store.delete([3, 0, 3])
+    assert [r[2] for r in records_store] == ['1', '2', '4']
+    assert records_store.find(records[4][0].bytes) == 2
+    assert records_store.find(records[0][0].bytes) is None
@@ -1,5 +1,7 @@
+import datetime
 import pickle
 import os
+import uuid
 from tests.fixtures import *
 import acid_vault.vault.vault as vault
 
@@ -56,4 +58,89 @@ def test_load_clear(tmpdir, vault_data_unlocked):
     with open(f, 'r') as fh:
         v.load_clear(fh)
     assert ("test", ) in v.data['vault']
-    
+
+def test_key_cache_reused(vault_data_unlocked, monkeypatch):
+    calls = []
+    create_key = vault.Vault.create_key
+
+    def counting_create_key(*args, **kwargs):
+        calls.append(args)
+        return create_key(*args, **kwargs)
+    monkeypatch.setattr(
+        vault.Vault, 'create_key', staticmethod(counting_create_key))
+    v = vault.Vault()
+    v.data = vault_data_unlocked
+    v.lock('testpass')
+    v.unlock('testpass')
+    v.lock('testpass')
+    assert len(calls) == 1
+    v.forget_key()
+    v.unlock('testpass')
+    assert len(calls) == 2
+    assert 'test' in v.data['vault']
+
+def test_key_cache_wrong_password(vault_data_unlocked):
+    v = vault.Vault()
+    v.data = vault_data_unlocked
+    v.lock('testpass')
+    assert not v.unlock('wrongpass')
+    assert v.unlock('testpass')
+
+def test_get_replace_remove():
+    v = vault.Vault()
+    records = [record(str(x)) for x in range(5)]
+    for obj in records:
+        v.add(obj)
+    assert v.get(records[3][0]) == records[3]
+    assert v.get(records[3][0].bytes) == records[3]
+    assert v.get(uuid.uuid4()) is None
+    changed = records[3][:2] + ('changed',) + records[3][3:]
+    assert v.replace(changed)
+    assert not v.replace(record('missing'))
+    v.remove_password(records[1])
+    assert v.get(records[1][0]) is None
+    assert v.get(records[3][0]) == changed
+    assert len(v.get_objects()) == 4
+
+def test_upsert():
+    v = vault.Vault()
+    records = [record(str(x)) for x in range(3)]
+    v.upsert(records)
+    changed = records[0][:2] + ('changed',) + records[0][3:]
+    new = record('new')
+    assert v.upsert([changed, records[1], new]) == 2
+    assert list(v.get_objects()) == [changed, records[1], records[2], new]
+
+def test_merge(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = vault.Vault()
+    records = [record(str(x)) for x in range(3)]
+    v.upsert(records)
+    v.lock('testpass')
+    v.save(f)
+    remote = vault.Vault(f)
+    remote.unlock('testpass')
+    changed = (records[0][0], datetime.datetime.utcnow(),
+               'changed') + records[0][3:]
+    new = record('new')
+    remote.upsert([changed, new])
+    remote.lock('testpass')
+    v.merge('testpass', remote.data, f, None, None)
+    v.unlock('testpass')
+    assert list(v.get_objects()) == [changed, records[1], records[2], new]
+
+def test_copy(tmpdir):
+    f = str(tmpdir.join('testfile.bin'))
+    v = vault.Vault(use_journal=True)
+    records = [record(str(x)) for x in range(3)]
+    v.upsert(records)
+    v.lock('testpass')
+    v.save(f)
+    v.unlock('testpass')
+    other = v.copy()
+    other.add(record('new'))
+    other.lock('testpass')
+    other.save(f)
+    assert not v.locked
+    assert list(v.get_objects()) == records
+    assert len(vault.Vault(f).unlock('testpass')['vault']) == 4